@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Benchmark of the analysis and export of recorded events.
+
+Generates synthetic traces (see `synthetic_trace.py`) of increasing size, saves
+them as `.lkprof` files, and runs each analysis or export path on them in a
+fresh process, recording its wall time and peak RSS. The trace is memory-mapped
+by each process, so the RSS includes the pages of the trace it read.
+
+Paths that convert every event to a Python object are skipped for traces above
+`--slow-limit` events. Results are written as JSON:
+
+    python benchmarks/bench_analysis.py --events 1e5 1e6 1e7 -o analysis.json
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lock_profiler import LockProfiler, __version__
+from lock_profiler.analysis import analyze
+from lock_profiler.critical_path import critical_path
+from lock_profiler.flamegraph import collapsed_stacks, write_svg
+from lock_profiler.lod import build_lod, write_lod
+from lock_profiler.trace_export import write_chrome_trace, write_perfetto_trace
+from lock_profiler.trace_file import read_trace, write_trace
+
+# Whether the path handles every event in Python
+PATHS = {
+    "load": False,
+    "analyze_numpy": False,
+    "analyze_python": True,
+    "critical_path": True,
+    "lod": False,
+    "flamegraph": False,
+    "pycharm_dump": False,
+    "dump_stats_lkprof": True,
+    "dump_stats_json": True,
+    "generate_html": True,
+    "chrome_trace": True,
+    "perfetto_trace": True,
+}
+
+
+def run_path(path, trace, out_dir):
+    stats = read_trace(trace)
+    if path == "load":
+        return len(stats.lock_list)
+    if path == "analyze_numpy":
+        return analyze(stats, use_numpy=True)
+    if path == "analyze_python":
+        return analyze(stats, use_numpy=False)
+    if path == "critical_path":
+        return critical_path(stats)
+    if path == "lod":
+        return write_lod(os.path.join(out_dir, "trace.lkprof.lod"), build_lod(stats))
+    if path == "flamegraph":
+        return write_svg(os.path.join(out_dir, "wait.svg"), collapsed_stacks(stats, "wait"))
+    if path == "pycharm_dump":
+        # What runs at exit, see `LockProfiler._dump_stats_for_pycharm`
+        return LockProfiler._write_pycharm_stats(
+            os.path.join(out_dir, "stats.pclprof"), analyze(stats), stats.lock_hashes,
+        )
+    if path == "dump_stats_lkprof":
+        return LockProfiler.dump_stats(os.path.join(out_dir, "copy.lkprof"), stats)
+    if path == "dump_stats_json":
+        return LockProfiler.dump_stats(os.path.join(out_dir, "stats.json"), stats)
+    if path == "generate_html":
+        return LockProfiler.generate_html(os.path.join(out_dir, "trace.html"), stats)
+    if path == "chrome_trace":
+        return write_chrome_trace(os.path.join(out_dir, "trace.json"), stats)
+    if path == "perfetto_trace":
+        return write_perfetto_trace(os.path.join(out_dir, "trace.pftrace"), stats)
+    raise ValueError(f"Unknown path {path!r}")
+
+
+def max_rss():
+    """Peak RSS of this process in bytes."""
+    if sys.platform.startswith("linux"):
+        # ru_maxrss would include the parent's RSS from before the exec
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in KiB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def child(path, trace, out_dir):
+    start_rss = max_rss()
+    start = time.perf_counter()
+    run_path(path, trace, out_dir)
+    elapsed = time.perf_counter() - start
+    json.dump({"elapsed_s": elapsed, "peak_rss": max_rss(), "start_rss": start_rss}, sys.stdout)
+
+
+def measure(path, trace, out_dir):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", path, trace, out_dir],
+        stdout=subprocess.PIPE, check=True,
+    )
+    return json.loads(proc.stdout)
+
+
+def run(sizes, paths, slow_limit, generator_args, log=print):
+    import synthetic_trace
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        trace = os.path.join(tmp, "synthetic.lkprof")
+        for size in sizes:
+            start = time.perf_counter()
+            stats = synthetic_trace.generate(size, **generator_args)
+            n_events = len(stats.lock_list)
+            write_trace(trace, stats)
+            del stats
+            log(f"{n_events} events generated in {time.perf_counter() - start:.1f} s")
+            for path in paths:
+                if PATHS[path] and size > slow_limit:
+                    continue
+                result = {"path": path, "events": n_events, **generator_args, **measure(path, trace, tmp)}
+                result["events_per_second"] = n_events / result["elapsed_s"] if result["elapsed_s"] else None
+                results.append(result)
+                log(
+                    f"  {path:18} {result['elapsed_s']:9.3f} s  {result['events_per_second'] or 0:12.0f} events/s"
+                    f"  peak RSS {result['peak_rss'] / 2 ** 20:8.1f} MiB"
+                )
+    return results
+
+
+def metadata():
+    return {
+        "lock_profiler": __version__,
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def main(argv=None):
+    # This script is not profiled, don't write its stats at exit
+    atexit.unregister(LockProfiler._dump_stats_for_pycharm)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--child", nargs=3, metavar=("PATH", "TRACE", "OUT_DIR"), help=argparse.SUPPRESS)
+    parser.add_argument("-o", "--output", default="bench_analysis.json", help="JSON file to write the results to")
+    parser.add_argument(
+        "-e", "--events", type=float, nargs="+", default=[1e4, 1e5, 1e6], help="Approximate trace sizes, up to 1e8",
+    )
+    parser.add_argument("-p", "--paths", nargs="+", choices=PATHS, default=list(PATHS), help="Paths to run")
+    parser.add_argument(
+        "--slow-limit", type=float, default=1e6, help="Largest trace to run the per-event Python paths on",
+    )
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--locks", type=int, default=16)
+    parser.add_argument("--nesting", type=int, default=3, help="Maximum re-entrant acquisitions per critical section")
+    parser.add_argument("--contention", type=float, default=0.2, help="Probability to go for the hot lock")
+    parser.add_argument("--stacks", type=int, default=1000, help="Distinct call stacks")
+    parser.add_argument("--stack-depth", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(*args.child)
+        return 0
+
+    generator_args = {
+        "n_threads": args.threads,
+        "n_locks": args.locks,
+        "nesting": args.nesting,
+        "contention": args.contention,
+        "n_stacks": args.stacks,
+        "stack_depth": args.stack_depth,
+        "seed": args.seed,
+    }
+    results = run([int(n) for n in args.events], args.paths, args.slow_limit, generator_args)
+    with open(args.output, "w") as f:
+        json.dump({"metadata": metadata(), "results": results}, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
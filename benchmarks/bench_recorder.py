@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Benchmark of the recorder's overhead per lock acquisition.
+
+Times acquire/release loops over uninstrumented locks, locks calling the
+`LockProfiler` hooks, and native `ProfiledLock`s in each recorder mode, while
+varying the number of threads, the stack depth, the number of distinct locks
+and call sites, and whether the threads share (contend for) the locks.
+
+By default each parameter is swept on its own around a baseline configuration;
+`--full` runs their full product instead. Results are written as JSON, and
+`--compare` checks them against an earlier run to catch regressions:
+
+    python benchmarks/bench_recorder.py -o new.json --compare old.json
+"""
+import argparse
+import atexit
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from lock_profiler import LockProfiler, ProfiledLock, __version__
+
+THREADS = (1, 2, 4, 16, 64)
+DEPTHS = (5, 20, 50, 200)
+N_LOCKS = (1, 16, 256)
+N_SITES = (1, 16, 256)
+CONTENTION = ("uncontended", "contended")
+BASELINE = {"threads": 1, "depth": 5, "locks": 1, "sites": 1, "contention": "uncontended"}
+
+# (lock kind, recorder mode). Uninstrumented locks don't record anything.
+VARIANTS = (
+    ("bare", None),
+    ("hooks", "events"),
+    ("hooks", "aggregate"),
+    ("native", "events"),
+    ("native", "aggregate"),
+    ("native", "flight"),
+    ("native", "stream"),
+    ("native", "contention"),
+    ("native", "sampled"),
+)
+# Sampling rate of the "sampled" mode
+SAMPLING_RATE = 1 / 16
+# Events recorded per acquisition: wait, acquire, release
+EVENTS_PER_ACQUIRE = 3
+
+
+class HookedLock:
+    """Lock calling the profiler hooks around every operation, like a hand-instrumented wrapper would."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock_id = LockProfiler.register_lock(repr(self))
+
+    def __enter__(self):
+        recorded = LockProfiler.pre_acquire(self._lock_id)
+        self._lock.acquire()
+        self._recorded = recorded
+        if recorded:
+            LockProfiler.post_acquire(self._lock_id)
+
+    def __exit__(self, *args):
+        if self._recorded:
+            LockProfiler.pre_release(self._lock_id)
+        self._lock.release()
+
+
+def make_lock(kind):
+    if kind == "bare":
+        return threading.Lock()
+    if kind == "hooks":
+        return HookedLock()
+    return ProfiledLock()
+
+
+def make_sites(n_sites):
+    """Functions acquiring a lock, each one a distinct call site."""
+    source = "".join(f"def site_{i}(lock):\n    with lock:\n        pass\n" for i in range(n_sites))
+    namespace = {}
+    exec(compile(source, "<benchmark call sites>", "exec"), namespace)
+    return [namespace[f"site_{i}"] for i in range(n_sites)]
+
+
+def stack_depth():
+    depth = 0
+    frame = sys._getframe(1)
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def at_depth(depth, fn, *args):
+    """Call `fn` with about `depth` frames on the stack."""
+    if stack_depth() < depth:
+        return at_depth(depth, fn, *args)
+    return fn(*args)
+
+
+def loop(sites, locks, iterations):
+    n_sites, n_locks = len(sites), len(locks)
+    for i in range(iterations):
+        sites[i % n_sites](locks[i % n_locks])
+
+
+def set_mode(mode, stream_file):
+    LockProfiler.clear_trace()
+    LockProfiler.set_aggregate_only(mode == "aggregate")
+    LockProfiler.set_contention_only(mode == "contention")
+    LockProfiler.set_sampling(SAMPLING_RATE if mode == "sampled" else 1.0)
+    LockProfiler.set_buffer_limit(max_events=1 << 16 if mode == "flight" else None)
+    if mode == "stream":
+        LockProfiler.start_streaming(stream_file)
+
+
+def reset_mode(mode):
+    if mode == "stream":
+        LockProfiler.stop_streaming()
+    LockProfiler.set_aggregate_only(False)
+    LockProfiler.set_contention_only(False)
+    LockProfiler.set_sampling()
+    LockProfiler.set_buffer_limit()
+    LockProfiler.clear_trace()
+
+
+def run_config(config, kind, mode, acquires, stream_file):
+    n_threads = config["threads"]
+    sites = make_sites(config["sites"])
+    if config["contention"] == "contended":
+        shared = [make_lock(kind) for _ in range(config["locks"])]
+        thread_locks = [shared] * n_threads
+    else:
+        thread_locks = [[make_lock(kind) for _ in range(config["locks"])] for _ in range(n_threads)]
+    per_thread = max(1, acquires // n_threads)
+
+    set_mode(mode, stream_file)
+    try:
+        barrier = threading.Barrier(n_threads + 1)
+
+        def work(locks):
+            # Build the stack first, so it isn't timed
+            at_depth(config["depth"], lambda: (barrier.wait(), loop(sites, locks, per_thread)))
+
+        threads = [threading.Thread(target=work, args=(locks,)) for locks in thread_locks]
+        for t in threads:
+            t.start()
+        barrier.wait()
+        start = time.perf_counter_ns()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter_ns() - start
+    finally:
+        reset_mode(mode)
+
+    total = per_thread * n_threads
+    return {
+        **config,
+        "kind": kind,
+        "mode": mode,
+        "acquires": total,
+        "elapsed_ns": elapsed,
+        "ns_per_acquire": elapsed / total,
+        "events_per_second": EVENTS_PER_ACQUIRE * total / (elapsed / 1e9) if kind != "bare" else 0,
+    }
+
+
+def configs(full):
+    if full:
+        for values in itertools.product(THREADS, DEPTHS, N_LOCKS, N_SITES, CONTENTION):
+            yield dict(zip(BASELINE, values))
+        return
+    seen = set()
+    for name, values in zip(BASELINE, (THREADS, DEPTHS, N_LOCKS, N_SITES, CONTENTION)):
+        for value in values:
+            config = {**BASELINE, name: value}
+            key = tuple(config.values())
+            if key not in seen:
+                seen.add(key)
+                yield config
+    # Contention only shows with several threads
+    yield {**BASELINE, "threads": 4, "contention": "contended"}
+
+
+def run(acquires, repeat, full, variants=VARIANTS, log=print):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        stream_file = os.path.join(tmp, "bench.lkstream")
+        for config in configs(full):
+            bare = None
+            for kind, mode in variants:
+                # Best of `repeat`, to filter out noise from the rest of the system
+                result = min(
+                    (run_config(config, kind, mode, acquires, stream_file) for _ in range(repeat)),
+                    key=lambda r: r["elapsed_ns"],
+                )
+                if kind == "bare":
+                    bare = result["ns_per_acquire"]
+                result["overhead_ns"] = result["ns_per_acquire"] - bare if bare is not None else None
+                results.append(result)
+                log(
+                    f"{config} {kind:6} {mode or '-':9} {result['ns_per_acquire']:8.1f} ns/acquire"
+                    + (f"  {result['overhead_ns']:+.1f} ns" if kind != "bare" and bare is not None else "")
+                )
+    return results
+
+
+def metadata():
+    return {
+        "lock_profiler": __version__,
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "timer": LockProfiler.get_timer(),
+        "hook_overhead_ns": LockProfiler.get_overhead(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def _key(result):
+    return tuple(result[name] for name in (*BASELINE, "kind", "mode"))
+
+
+def compare(results, baseline_results, threshold):
+    """Return the results whose time per acquire grew by more than `threshold` (relative) since the baseline."""
+    baseline = {_key(r): r for r in baseline_results}
+    regressions = []
+    for result in results:
+        old = baseline.get(_key(result))
+        if old is None or result["kind"] == "bare":
+            continue
+        change = result["ns_per_acquire"] / old["ns_per_acquire"] - 1
+        if change > threshold:
+            regressions.append((result, old, change))
+    return regressions
+
+
+def main(argv=None):
+    # The benchmark's own locks would be dumped at exit
+    atexit.unregister(LockProfiler._dump_stats_for_pycharm)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="bench_recorder.json", help="JSON file to write the results to")
+    parser.add_argument("-n", "--acquires", type=int, default=100_000, help="Acquisitions per configuration")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per configuration, the fastest is kept")
+    parser.add_argument("--full", action="store_true", help="Run every combination of the parameters")
+    parser.add_argument("--timer", help="Timer backend, see LockProfiler.set_timer")
+    parser.add_argument("--compare", help="Results of an earlier run to check for regressions")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression (default 0.1)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.timer:
+        LockProfiler.set_timer(args.timer)
+    results = run(args.acquires, args.repeat, args.full)
+    with open(args.output, "w") as f:
+        json.dump({"metadata": metadata(), "results": results}, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for result, old, change in regressions:
+            print(
+                f"Regression: {dict((k, result[k]) for k in (*BASELINE, 'kind', 'mode'))} "
+                f"{old['ns_per_acquire']:.1f} -> {result['ns_per_acquire']:.1f} ns/acquire (+{change:.0%})"
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
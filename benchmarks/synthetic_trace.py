@@ -0,0 +1,147 @@
+"""
+Synthetic traces for benchmarking the analysis and export of recorded events.
+
+`generate` returns `LockStats` whose events behave like a real recording:
+threads repeatedly take a lock, possibly re-entrantly up to `nesting` deep, and
+hold it for a lognormal time; locks are mutually exclusive, so a thread arriving
+while another holds the lock waits for its release and is counted as blocked by
+the analysis. With probability `contention` a thread goes for the lock that is
+hot at that time, otherwise for a random one. Each outermost acquisition comes
+from one of `n_stacks` call stacks, picked with a Zipf-like skew, which share
+their outer frames like real call paths do.
+
+Events are generated with NumPy in columns. The generated trace takes about 40
+bytes per event, but generating it peaks at about 150, and the NumPy analysis
+needs about 140 more for its intermediates, so analyzing 10^8 events takes some
+30 GB. `SyntheticEvents` exposes them both as `LockEvent`s and, like an
+`EventArray`, as a structured array.
+"""
+import typing
+
+import numpy as np
+
+from lock_profiler._lock_profiler import EVENT_FIELDS, LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, \
+    PY_E_RELEASE
+
+EVENT_DTYPE = np.dtype([(name, np.int64) for name in EVENT_FIELDS])
+# Lognormal hold time and gap between critical sections, in ns
+HOLD_MEDIAN = 2_000
+GAP_MEDIAN = 5_000
+SIGMA = 1.0
+# Cost of an uncontended wait, in ns
+UNCONTENDED_WAIT = 100
+
+
+class SyntheticEvents:
+    """Generated events, sorted by timestamp."""
+
+    def __init__(self, arr: np.ndarray):
+        self._arr = arr
+
+    def as_numpy(self) -> np.ndarray:
+        return self._arr
+
+    def __len__(self):
+        return len(self._arr)
+
+    def __getitem__(self, i) -> LockEvent:
+        return LockEvent(*(int(v) for v in self._arr[i]))
+
+    def __iter__(self) -> typing.Iterator[LockEvent]:
+        for start in range(0, len(self._arr), 1 << 16):
+            yield from map(LockEvent._make, self._arr[start:start + (1 << 16)].tolist())
+
+
+def make_stacks(n_stacks: int, depth: int) -> typing.Dict[int, typing.List[StackFrame]]:
+    """Call stacks `depth` frames deep, innermost frame first, forming a binary call tree."""
+    stacks = {}
+    for stack_hash in range(1, n_stacks + 1):
+        frames = []
+        for level in range(depth):
+            # Node of the call tree at this level, counted from the outermost frame
+            shift = depth - 1 - level
+            node = (stack_hash - 1) >> shift if shift < 63 else 0
+            frames.append(StackFrame(f"app/module_{node % 97}.py", f"function_{level}_{node}", 10 + level))
+        frames.reverse()
+        stacks[stack_hash] = frames
+    return stacks
+
+
+def generate(
+    n_events: int = 1_000_000,
+    n_threads: int = 8,
+    n_locks: int = 16,
+    nesting: int = 3,
+    contention: float = 0.2,
+    n_stacks: int = 1000,
+    stack_depth: int = 20,
+    seed: int = 0,
+) -> LockStats:
+    """Generate about `n_events` events, see the module docstring."""
+    rng = np.random.default_rng(seed)
+    # Each critical section of depth d makes 3 * d events
+    mean_depth = (1 + nesting) / 2
+    n_rounds = max(1, round(n_events / (3 * mean_depth * n_threads)))
+    shape = (n_rounds, n_threads)
+
+    # In each round every thread takes one lock. Threads taking the same lock in a round are serialized.
+    hot = rng.integers(n_locks, size=(n_rounds, 1))
+    lock = np.where(rng.random(shape) < contention, hot, rng.integers(n_locks, size=shape))
+    arrive = rng.lognormal(np.log(GAP_MEDIAN), SIGMA, shape).astype(np.int64)
+    hold = rng.lognormal(np.log(HOLD_MEDIAN), SIGMA, shape).astype(np.int64)
+    depth = rng.integers(1, nesting + 1, size=shape)
+    hold = np.maximum(hold, 4 * depth + 4)
+
+    # Queue the threads of each (round, lock) by arrival time:
+    # acquire_k = max(arrive_k + wait, release_(k-1) + 1), with release = acquire + hold
+    arrive = arrive.ravel()
+    hold = hold.ravel()
+    order = np.lexsort((arrive, lock.ravel(), np.repeat(np.arange(n_rounds), n_threads)))
+    group = (np.repeat(np.arange(n_rounds), n_threads) * n_locks + lock.ravel())[order]
+    new_group = np.r_[True, group[1:] != group[:-1]]
+    group_id = np.cumsum(new_group) - 1
+    ready = arrive[order] + UNCONTENDED_WAIT
+    spacing = hold[order] + 1
+    # Total hold time of the threads ahead in the queue
+    held_before = np.cumsum(spacing) - spacing
+    held_before -= held_before[np.flatnonzero(new_group)][group_id]
+    # Running max within each group, offset so groups don't mix
+    offset = group_id * (int(ready.max()) + int(held_before.max()) + 1)
+    acquire_sorted = np.maximum.accumulate(ready - held_before + offset) - offset + held_before
+    acquire = np.empty_like(acquire_sorted)
+    acquire[order] = acquire_sorted
+    release = acquire + hold
+
+    # Rounds start when everything in the previous round was released
+    arrive = arrive.reshape(shape)
+    acquire = acquire.reshape(shape)
+    release = release.reshape(shape)
+    round_start = np.r_[0, np.cumsum(release.max(axis=1) + 1)[:-1]]
+    arrive += round_start[:, None]
+    acquire += round_start[:, None]
+    release += round_start[:, None]
+
+    # Expand each critical section into its nested wait/acquire/release events
+    arrive, acquire, release, depth = arrive.ravel(), acquire.ravel(), release.ravel(), depth.ravel()
+    tid = np.tile(np.arange(1, n_threads + 1), n_rounds)
+    lock = lock.ravel()
+    section = np.repeat(np.arange(len(depth)), depth)
+    level = np.arange(len(section)) - np.repeat(np.cumsum(depth) - depth, depth)
+    step = (release - acquire)[section] // (2 * depth[section] + 2)
+    wait_ts = np.where(level == 0, arrive[section], acquire[section] + level * step)
+    acquire_ts = np.where(level == 0, acquire[section], acquire[section] + level * step + step // 2)
+    release_ts = release[section] - level * step
+    # Skewed choice of call stacks: few hot ones, a long tail
+    stack = np.minimum(rng.zipf(1.3, size=len(section)), n_stacks)
+
+    n = 3 * len(section)
+    events = np.empty(n, dtype=EVENT_DTYPE)
+    events["timestamp"] = np.concatenate((wait_ts, acquire_ts, release_ts))
+    events["flag"] = np.repeat([PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE], len(section))
+    events["tid"] = np.tile(tid[section], 3)
+    events["lock_hash"] = np.tile(lock[section] + 1, 3)
+    events["stack_hash"] = np.concatenate((stack, np.zeros(2 * len(section), dtype=np.int64)))
+    events = events[np.argsort(events["timestamp"], kind="stable")]
+
+    lock_hashes = {lock_hash: f"<lock {lock_hash}>" for lock_hash in range(1, n_locks + 1)}
+    return LockStats(lock_hashes, make_stacks(n_stacks, stack_depth), SyntheticEvents(events))
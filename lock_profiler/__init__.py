@@ -2,7 +2,8 @@
 The lock_profiler modula for doing line-by-line profiling of functions
 """
 __submodules__ = [
-    'lock_profiler'
+    'lock_profiler',
+    'instrument',
 ]
 
 __autogen__ = """
@@ -13,6 +14,7 @@ mkinit ./lock_profiler/__init__.py --relative -w
 
 from .lock_profiler import __version__
 
-from .lock_profiler import (LockProfiler)
+from .lock_profiler import (LockProfiler, ProfiledLock, ProfiledRLock)
+from .instrument import (install, uninstall)
 
-__all__ = ['LockProfiler', 'lock_profiler', '__version__']
+__all__ = ['LockProfiler', 'ProfiledLock', 'ProfiledRLock', 'install', 'uninstall', 'lock_profiler', '__version__']
@@ -3,14 +3,20 @@ from .python25 cimport PyFrameObject, PyObject, PyStringObject
 from sys import byteorder
 cimport cython
 from cpython.version cimport PY_VERSION_HEX
-from libc.stdint cimport int64_t
+from cpython.buffer cimport PyBUF_FORMAT, PyBUF_WRITABLE
+from libc.math cimport ceil, log2
+from libc.stdint cimport int64_t, uint64_t, uintptr_t
 
 from libcpp.unordered_map cimport unordered_map
+from libcpp.utility cimport pair
 from libcpp.vector cimport vector
+import _thread
 import threading
 import typing
-from dataclasses import dataclass
+from time import monotonic
+from dataclasses import dataclass, field
 
+import os
 import sys
 
 # long long int is at least 64 bytes assuming c99
@@ -91,30 +97,109 @@ lut = {
 cdef extern from "timers.c":
     PY_LONG_LONG hpTimer()
     double hpTimerUnit()
+    int hpTimerSetBackend(int backend)
+    int hpTimerBackend()
 
 cdef extern from "unset_trace.c":
     void unset_trace()
 
+cdef extern from "call_sites.h":
+    cdef int64_t CALL_SITE_ROOT
+    ctypedef struct CallSiteNode:
+        int64_t parent
+        PyCodeObject* code
+        int lasti
+        bint is_stack
+    vector[CallSiteNode] _call_site_nodes
+    vector[int64_t] _call_site_stacks
+    int64_t call_site_intern_current_stack()
+    void call_site_clear()
 
+cdef extern from "event_buffer.h":
+    ctypedef struct CLockEvent:
+        PY_LONG_LONG timestamp
+        int64_t flag
+        # Which thread called it
+        int64_t tid
+        # ID of the lock it was called on, see `LockProfiler.register_lock`
+        int64 lock_hash
+        # Interned call stack ID
+        int64_t stack_hash
+    ctypedef struct EventChunk:
+        pass
+    ctypedef struct ThreadBuffer:
+        pass
+    cdef cppclass EventCursor:
+        uint64_t generation
+    cdef int EVENT_CHUNK_SIZE
+    void event_buffer_record(PY_LONG_LONG timestamp, int64_t flag, int64_t lock_hash, int64_t stack_hash)
+    void event_buffer_collect(vector[CLockEvent]& out)
+    uint64_t event_buffer_collect_new(vector[CLockEvent]& out, EventCursor& cursor)
+    void event_buffer_sort(vector[CLockEvent]& events) nogil
+    uint64_t event_buffer_generation()
+    void event_buffer_clear()
+    void event_buffer_set_max_chunks(size_t max_chunks)
+    void event_buffer_freeze(bint frozen)
+    bint event_buffer_is_frozen()
+    ThreadBuffer* event_buffer_start_scratch()
+    const CLockEvent* event_buffer_take_scratch(size_t* count)
+    void event_buffer_stop_scratch(ThreadBuffer* own)
+    int event_stream_start(const char* filename)
+    int event_stream_stop() nogil
+    bint event_stream_is_active()
 
-cdef struct CLockEvent:
-    PY_LONG_LONG timestamp
-    int64_t flag
-    # Which thread called it
-    int64_t tid
-    # Which lock it was called on
-    int64 lock_hash
-    # Hash of the call stack
-    int64_t stack_hash
+cdef extern from "histogram.h":
+    ctypedef struct LatencyHistogram:
+        vector[int64_t] counts
+
+cdef extern from "sampling.h":
+    cdef int SAMPLING_MAX_SHIFT
+    int sampling_decide(int64_t lock_id, PY_LONG_LONG now)
+    bint sampling_is_enabled()
+    bint sampling_has_budget()
+    void sampling_configure(int shift, double budget, uint64_t seed)
+    void sampling_set_lock_shift(int64_t lock_id, int shift)
+    void sampling_reset_lock(int64_t lock_id)
+
+cdef extern from "aggregate.h":
+    ctypedef struct AggregateStat:
+        int64_t hits
+        int64_t acquires
+        int64_t blocks
+        int64_t total_wait_time
+        int64_t max_wait_time
+        int64_t total_hold_time
+        int64_t max_hold_time
+        int64_t total_block_time
+        int64_t max_block_time
+        LatencyHistogram wait_histogram
+        LatencyHistogram hold_histogram
+        LatencyHistogram block_histogram
+    ctypedef struct AggregateSiteKey:
+        int64_t lock_hash
+        int64_t stack_hash
+    cdef cppclass AggregateState:
+        pass
+    AggregateState _aggregate_state
+    void aggregate_state_wait(
+        AggregateState& state, int64_t tid, PY_LONG_LONG timestamp, int64_t lock_hash, int64_t stack_hash, bint blocked,
+    ) nogil
+    void aggregate_state_acquire(
+        AggregateState& state, int64_t tid, PY_LONG_LONG timestamp, int64_t lock_hash, bint calibrated,
+    ) nogil
+    void aggregate_state_release(AggregateState& state, int64_t tid, PY_LONG_LONG timestamp, int64_t lock_hash) nogil
+    void aggregate_state_collect_locks(const AggregateState& state, vector[pair[int64_t, AggregateStat]]& out)
+    void aggregate_state_collect_sites(const AggregateState& state, vector[pair[AggregateSiteKey, AggregateStat]]& out)
+    void aggregate_state_clear(AggregateState& state)
+    void aggregate_wait(PY_LONG_LONG timestamp, int64_t lock_hash, int64_t stack_hash, bint blocked)
+    void aggregate_acquire(PY_LONG_LONG timestamp, int64_t lock_hash, bint calibrated)
+    void aggregate_release(PY_LONG_LONG timestamp, int64_t lock_hash)
+    void aggregate_set_overhead(int64_t wait_overhead, int64_t hold_overhead)
+    void aggregate_clear()
 
 class LockEvent(typing.NamedTuple):
     timestamp: int
     flag: int
-    # idx: int
-    # current_depth: int
-    # wait_duration: int
-    # hold_duration: int
-    # # block_duration: int
     tid: int
     lock_hash: int
     stack_hash: int
@@ -124,40 +209,675 @@ class StackFrame(typing.NamedTuple):
     functionName: str
     lineNo: int
 
-# StackType = typing.List[StackFrame]
-# cdef struct StackInfo:
-#     str stack
-
 # Note: this is a regular Python class to allow easy pickling.
 @dataclass
 class LockStats:
     lock_hashes: typing.Dict[int, str]
     stack_hashes: typing.Dict[int, typing.List[StackFrame]]
     lock_list: typing.List[LockEvent]
+    # Cost of the hooks included in each wait and hold time, subtracted by the analysis. See `calibrate`.
+    wait_overhead: int = 0
+    hold_overhead: int = 0
+    # {lock_hash: acquisitions that were only counted}, see `set_contention_only`
+    uncontended_counts: typing.Dict[int, int] = field(default_factory=dict)
+
+
+# PEP 3118 format of a CLockEvent
+cdef bytes _EVENT_FORMAT = b"T{q:timestamp:q:flag:q:tid:q:lock_hash:q:stack_hash:}"
+EVENT_FIELDS = LockEvent._fields
+
+
+cdef class EventArray:
+    """ Read-only array of recorded events, stored as C structs without a Python object per event.
+
+    Supports the buffer protocol with one item per event, so it can be viewed without copying, e.g. through
+    `as_numpy`.
+    """
+    cdef vector[CLockEvent] events
+    cdef Py_ssize_t shape[1]
+    cdef Py_ssize_t strides[1]
+
+    def __len__(self):
+        return self.events.size()
+
+    def __getitem__(self, Py_ssize_t i) -> LockEvent:
+        if i < 0:
+            i += self.events.size()
+        if i < 0 or i >= <Py_ssize_t>self.events.size():
+            raise IndexError("event index out of range")
+        cdef CLockEvent* e = &self.events[i]
+        return LockEvent(e.timestamp, e.flag, e.tid, e.lock_hash, e.stack_hash)
+
+    def __getbuffer__(self, Py_buffer* buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("EventArray is read-only")
+        self.shape[0] = self.events.size()
+        self.strides[0] = sizeof(CLockEvent)
+        buffer.buf = self.events.data()
+        buffer.obj = self
+        buffer.len = self.shape[0] * sizeof(CLockEvent)
+        buffer.readonly = 1
+        buffer.itemsize = sizeof(CLockEvent)
+        buffer.format = <char*>_EVENT_FORMAT if flags & PyBUF_FORMAT else NULL
+        buffer.ndim = 1
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+
+    def __releasebuffer__(self, Py_buffer* buffer):
+        pass
 
+    def as_numpy(self):
+        """ Return a NumPy structured array sharing this array's memory, with one field per LockEvent field. """
+        import numpy as np
+        dtype = np.dtype([(name, np.int64) for name in EVENT_FIELDS])
+        return np.frombuffer(self, dtype=dtype)
 
-# # Mapping between tid and (mapping between lock hash and (vector of info about each nested acquisition))
-# cdef unordered_map[int64, unordered_map[int64_t, vector[CLockInfo]]] _c_lock_map
-# List of all acquire events
-cdef vector[CLockEvent] _c_lock_list
-# Mapping between lock hash and which thread is holding it
-# cdef unordered_map[int64, int64_t] _c_held_map
-# Mapping between tid and the stack hash recorede in `pre_acquire`
-cdef unordered_map[int64, int64_t] _c_current_stack_map
+
+# Events are stored in per-thread buffers, see event_buffer.h
 
 cdef int64_t E_WAIT =    0
 cdef int64_t E_ACQUIRE = 1
 cdef int64_t E_RELEASE = 2
+# Bits of the flag giving the event type
+cdef int64_t E_MASK = 0x3
+# Bits 2-6 of the flag of wait events: log2 of the acquisition's sampling weight, see `set_sampling`
+cdef int64_t F_SAMPLE_SHIFT = 2
+# Set on the flag of wait events known to be blocked by another thread, see `set_contention_only`
+cdef int64_t F_BLOCKED = 1 << 7
+# Set on the flag of acquire events recorded through `post_acquire`, whose cost `calibrate` doesn't measure, so the
+# hook overhead isn't subtracted from their wait and hold times
+cdef int64_t F_UNCALIBRATED = 1 << 2
 PY_E_WAIT = E_WAIT
 PY_E_ACQUIRE = E_ACQUIRE
 PY_E_RELEASE = E_RELEASE
-# cdef int64_t F_BLOCKED = 1 << 8
+PY_E_MASK = E_MASK
+PY_F_SAMPLE_SHIFT = F_SAMPLE_SHIFT
+PY_F_BLOCKED = F_BLOCKED
+PY_F_UNCALIBRATED = F_UNCALIBRATED
+PY_EVENT_CHUNK_SIZE = EVENT_CHUNK_SIZE
 
 
-# Mapping between call stack hash and call stack
-# cdef unordered_map[int64, vector[StackFrame]] _c_stack_map
-_stack_map = {}
+# Mapping between (code object address, instruction offset) and the resolved StackFrame
+_symbol_cache = {}
+# Mapping between lock ID and name. Not emptied by `clear_trace`, so IDs stay valid for the lifetime of their locks.
+# It keeps a name per lock that was ever acquired: profiled locks that are deallocated without being acquired
+# have nothing recorded under their ID, so they give it back, see `_free_lock_id`
 _lock_strs = {}
+# ID given to the next registered lock, once `_free_lock_ids` is empty
+cdef int64_t _next_lock_id = 1
+# IDs given back, reused first so that the arrays indexed by lock ID stay as small as the live locks allow
+cdef vector[int64_t] _free_lock_ids
+# File being written by `start_streaming`
+_stream_filename = None
+# Whether the hooks update the counters in aggregate.h instead of recording events
+cdef bint _aggregate_only = False
+# Whether profiled locks only record the acquisitions that block
+cdef bint _contention_only = False
+# Acquisitions that didn't block in contention-only mode, indexed by lock ID
+cdef vector[int64_t] _uncontended_counts
+
+# Timer backends, in the order of their ID in timers.c
+TIMERS = ("monotonic", "monotonic_raw", "tsc")
+# Thread running `calibrate`, whose hooks record into a scratch buffer. 0 if none
+cdef unsigned long _calibrating_thread = 0
+# Whether to calibrate when the first lock is registered, see `calibrate`
+cdef bint _calibration_pending = False
+# Hook cost included in wait and hold times, see `LockProfiler.calibrate`
+cdef int64_t _wait_overhead = 0
+cdef int64_t _hold_overhead = 0
+
+
+AGGREGATE_FIELDS = (
+    "hits", "acquires", "blocks",
+    "total_wait_time", "max_wait_time",
+    "total_hold_time", "max_hold_time",
+    "total_block_time", "max_block_time",
+    # Bucket counts, see histogram.py
+    "wait_histogram", "hold_histogram", "block_histogram",
+)
+
+
+cdef tuple _aggregate_tuple(AggregateStat& s):
+    return (
+        s.hits, s.acquires, s.blocks,
+        s.total_wait_time, s.max_wait_time,
+        s.total_hold_time, s.max_hold_time,
+        s.total_block_time, s.max_block_time,
+        s.wait_histogram.counts, s.hold_histogram.counts, s.block_histogram.counts,
+    )
+
+
+cdef tuple _collect_aggregates(const AggregateState& state):
+    cdef vector[pair[int64_t, AggregateStat]] locks
+    cdef vector[pair[AggregateSiteKey, AggregateStat]] sites
+    aggregate_state_collect_locks(state, locks)
+    aggregate_state_collect_sites(state, sites)
+    return (
+        {item.first: _aggregate_tuple(item.second) for item in locks},
+        {(item.first.lock_hash, item.first.stack_hash): _aggregate_tuple(item.second) for item in sites},
+    )
+
+
+cdef object _resolve_frame(PyCodeObject* code, int lasti):
+    key = (<uintptr_t>code, lasti)
+    frame = _symbol_cache.get(key)
+    if frame is None:
+        co = <object><PyObject*>code
+        frame = StackFrame(co.co_filename, co.co_name, PyCode_Addr2Line(code, lasti))
+        _symbol_cache[key] = frame
+    return frame
+
+
+cdef dict _resolve_stacks(stack_ids=None):
+    """ Resolve every interned call stack, or those of `stack_ids`, into a list of StackFrames, innermost frame first.
+
+    Unknown IDs are left out.
+    """
+    cdef dict stacks = {}
+    cdef CallSiteNode node
+    cdef int64_t node_id
+    if stack_ids is None:
+        stack_ids = _call_site_stacks
+    for stack_id in stack_ids:
+        if not 0 <= stack_id < <int64_t>_call_site_nodes.size() or not _call_site_nodes[stack_id].is_stack:
+            continue
+        stack = []
+        node_id = stack_id
+        # Nodes are chained from the outermost frame towards the innermost one
+        while node_id != CALL_SITE_ROOT:
+            node = _call_site_nodes[node_id]
+            stack.append(_resolve_frame(node.code, node.lasti))
+            node_id = node.parent
+        stack.reverse()
+        stacks[stack_id] = stack
+    return stacks
+
+
+cdef int _rate_shift(rate) except -1:
+    """ log2 of the inverse of a sampling rate, rounded to the nearest integer. """
+    if not 0 < rate <= 1:
+        raise ValueError("rate must be in (0, 1]")
+    return min(round(-log2(rate)), SAMPLING_MAX_SHIFT)
+
+
+cdef int64_t _register_lock(str name) except -1:
+    global _next_lock_id, _calibration_pending
+    if _calibration_pending:
+        _calibration_pending = False
+        LockProfiler.calibrate()
+    cdef int64_t lock_id
+    if _free_lock_ids.size():
+        lock_id = _free_lock_ids.back()
+        _free_lock_ids.pop_back()
+        # Settings made through the ID of the previous lock
+        sampling_reset_lock(lock_id)
+        if <size_t>lock_id < _uncontended_counts.size():
+            _uncontended_counts[lock_id] = 0
+    else:
+        lock_id = _next_lock_id
+        _next_lock_id += 1
+    _lock_strs[lock_id] = name
+    return lock_id
+
+
+cdef void _free_lock_id(int64_t lock_id):
+    """ Give back the ID of a deallocated lock that was never acquired, for `_register_lock` to reuse. """
+    if lock_id <= 0:
+        return
+    # Gone already when the module is torn down
+    if _lock_strs is not None:
+        _lock_strs.pop(lock_id, None)
+    _free_lock_ids.push_back(lock_id)
+
+
+cdef int _schedule_calibration() except -1:
+    """ Calibrate now if locks were registered, else when the first one is, so importing doesn't cost anything. """
+    global _calibration_pending
+    if _next_lock_id > 1:
+        LockProfiler.calibrate()
+    else:
+        _calibration_pending = True
+    return 0
+
+
+cdef inline int _check_lock_id(int64_t lock_id) except -1:
+    """ Raise ValueError if `lock_id` wasn't given by `register_lock`, as the recorder indexes arrays by it. """
+    if lock_id <= 0 or lock_id >= _next_lock_id:
+        raise ValueError(f"Unknown lock ID {lock_id}, see register_lock")
+    return 0
+
+
+cdef inline bint _is_calibrating():
+    return _calibrating_thread != 0 and PyThread_get_thread_ident() == _calibrating_thread
+
+
+cdef inline void _record_wait(int64_t h, int64_t flag=E_WAIT):
+    if event_buffer_is_frozen():
+        return
+    # Intern the call stack. Line numbers are only resolved in `get_stats`
+    cdef int64_t stack_hash = call_site_intern_current_stack()
+    # `calibrate` times the recording of events
+    if _aggregate_only and not _is_calibrating():
+        aggregate_wait(hpTimer(), h, stack_hash, flag & F_BLOCKED)
+    else:
+        event_buffer_record(hpTimer(), flag, h, stack_hash)
+
+
+cdef inline void _record_acquire(int64_t h, int64_t flag=E_ACQUIRE):
+    cdef PY_LONG_LONG t = hpTimer()
+    if event_buffer_is_frozen():
+        return
+    if _aggregate_only and not _is_calibrating():
+        aggregate_acquire(t, h, not flag & F_UNCALIBRATED)
+    else:
+        event_buffer_record(t, flag, h, 0)
+
+
+cdef inline int _sample(int64_t h):
+    """ Return log2 of the sampling weight of an acquisition to record, or -1 if it is not sampled. """
+    if not sampling_is_enabled() or _aggregate_only or _is_calibrating():
+        return 0
+    return sampling_decide(h, hpTimer() if sampling_has_budget() else 0)
+
+
+cdef inline int64_t _make_wait_flag(bint blocked, int shift):
+    return E_WAIT | (shift << F_SAMPLE_SHIFT) | (F_BLOCKED if blocked else 0)
+
+
+cdef inline void _count_uncontended(int64_t h, int64_t count=1):
+    if event_buffer_is_frozen():
+        return
+    if <size_t>h >= _uncontended_counts.size():
+        _uncontended_counts.resize(max(<size_t>h + 1, 2 * _uncontended_counts.size()))
+    _uncontended_counts[h] += count
+
+
+cdef inline void _record_release(int64_t h):
+    cdef PY_LONG_LONG t = hpTimer()
+    if event_buffer_is_frozen():
+        return
+    if _aggregate_only and not _is_calibrating():
+        aggregate_release(t, h)
+    else:
+        event_buffer_record(t, E_RELEASE, h, 0)
+
+
+cdef extern from "pythread.h":
+    ctypedef void* PyThread_type_lock
+    ctypedef enum PyLockStatus:
+        PY_LOCK_FAILURE
+        PY_LOCK_ACQUIRED
+        PY_LOCK_INTR
+    PyThread_type_lock PyThread_allocate_lock()
+    void PyThread_free_lock(PyThread_type_lock lock)
+    PyLockStatus PyThread_acquire_lock_timed(PyThread_type_lock lock, long long microseconds, int intr_flag) nogil
+    void PyThread_release_lock(PyThread_type_lock lock) nogil
+    unsigned long PyThread_get_thread_ident()
+
+cdef extern from "Python.h":
+    int PyErr_CheckSignals() except -1
+
+
+cdef inline bint _try_uncontended(PyThread_type_lock lock, int64_t h, bint* blocked, int64_t count=1):
+    """ In contention-only mode, try to take `lock` without blocking and only count it if that worked.
+
+    Sets `blocked` if that was tried and failed, so the acquisition has to wait for another thread.
+    """
+    if not _contention_only or _is_calibrating():
+        return False
+    if PyThread_acquire_lock_timed(lock, 0, 0) != PY_LOCK_ACQUIRED:
+        blocked[0] = True
+        return False
+    _count_uncontended(h, count)
+    return True
+
+
+cdef long long _timeout_us(bint blocking, double timeout) except -2:
+    """ Convert the arguments of `acquire` to microseconds for `PyThread_acquire_lock_timed`, -1 meaning forever. """
+    if not blocking:
+        if timeout != -1:
+            raise ValueError("can't specify a timeout for a non-blocking call")
+        return 0
+    if timeout == -1:
+        return -1
+    if timeout < 0:
+        raise ValueError("timeout value must be a non-negative number")
+    if timeout > _thread.TIMEOUT_MAX:
+        raise OverflowError("timeout value is too large")
+    return <long long>ceil(timeout * 1e6)
+
+
+cdef bint _acquire_lock(PyThread_type_lock lock, long long timeout_us) except -1:
+    """ Acquire `lock` like `_thread.lock.acquire`, releasing the GIL while blocked and handling signals. """
+    cdef PyLockStatus status
+    cdef double deadline
+    # Uncontended: don't release the GIL
+    if PyThread_acquire_lock_timed(lock, 0, 0) == PY_LOCK_ACQUIRED:
+        return True
+    if timeout_us == 0:
+        return False
+    if timeout_us > 0:
+        deadline = monotonic() + timeout_us / 1e6
+    while True:
+        with nogil:
+            status = PyThread_acquire_lock_timed(lock, timeout_us, 1)
+        if status != PY_LOCK_INTR:
+            return status == PY_LOCK_ACQUIRED
+        # Run signal handlers, which may raise e.g. KeyboardInterrupt
+        PyErr_CheckSignals()
+        if timeout_us > 0:
+            timeout_us = <long long>ceil((deadline - monotonic()) * 1e6)
+            if timeout_us <= 0:
+                return False
+
+
+cdef class ProfiledLock:
+    """ Drop-in replacement for `threading.Lock` that records its events without any Python-level hooks.
+
+    Implemented directly on the interpreter's lock API like `_thread.lock`, including timeouts and interruption
+    by signals, and works with `threading.Condition`.
+    """
+    cdef PyThread_type_lock _lock
+    cdef bint _locked
+    # Whether the current acquisition was recorded, and so its release must be
+    cdef bint _recorded
+    # Whether it was ever acquired. If not, nothing was recorded under its ID
+    cdef bint _acquired
+    cdef readonly int64_t lock_id
+    cdef readonly str name
+    cdef object __weakref__
+
+    def __cinit__(self, name=None):
+        self._lock = PyThread_allocate_lock()
+        if self._lock == NULL:
+            raise MemoryError("can't allocate lock")
+        self._locked = False
+        self.name = name if name is not None else f"<{type(self).__name__} object at {id(self):#x}>"
+        # The lock timed by `calibrate` isn't recorded, so it isn't registered either
+        self.lock_id = 0 if _is_calibrating() else _register_lock(self.name)
+
+    def __dealloc__(self):
+        if not self._acquired:
+            _free_lock_id(self.lock_id)
+        if self._lock != NULL:
+            if self._locked:
+                PyThread_release_lock(self._lock)
+            PyThread_free_lock(self._lock)
+
+    cdef inline bint _acquire(self, long long timeout_us) except -1:
+        cdef bint blocked = False
+        cdef int shift
+        self._acquired = True
+        if _try_uncontended(self._lock, self.lock_id, &blocked):
+            self._locked = True
+            self._recorded = False
+            return True
+        if blocked and timeout_us == 0:
+            return False
+        shift = _sample(self.lock_id)
+        if shift >= 0:
+            _record_wait(self.lock_id, _make_wait_flag(blocked, shift))
+        if not _acquire_lock(self._lock, timeout_us):
+            return False
+        self._locked = True
+        self._recorded = shift >= 0
+        if self._recorded:
+            _record_acquire(self.lock_id)
+        return True
+
+    cdef inline void _release(self) except *:
+        if not self._locked:
+            raise RuntimeError("release unlocked lock")
+        if self._recorded:
+            _record_release(self.lock_id)
+        self._locked = False
+        PyThread_release_lock(self._lock)
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(_timeout_us(blocking, timeout))
+
+    def release(self):
+        self._release()
+
+    def __enter__(self):
+        return self._acquire(-1)
+
+    def __exit__(self, *args):
+        self._release()
+
+    def locked(self):
+        return self._locked
+
+    def _is_owned(self):
+        # Used by `threading.Condition`, whose fallback would record a failed acquisition
+        return self._locked
+
+    def _at_fork_reinit(self):
+        # The lock may have been held by a thread that doesn't exist in the child. Leak it like CPython does.
+        self._lock = PyThread_allocate_lock()
+        if self._lock == NULL:
+            raise MemoryError("can't allocate lock")
+        self._locked = False
+
+    def __repr__(self):
+        return f"<{'locked' if self._locked else 'unlocked'} {self.name}>"
+
+
+cdef class ProfiledRLock:
+    """ Drop-in replacement for `threading.RLock` that records its events without any Python-level hooks.
+
+    Re-entrant acquisitions are recorded like any other, and `threading.Condition` waits are recorded as releasing
+    and re-acquiring every level. With sampling, the levels are recorded if the outermost acquisition is.
+    """
+    cdef PyThread_type_lock _lock
+    cdef unsigned long _owner
+    # Recursion level, only changed by the owning thread
+    cdef int64_t _count
+    # Flag of the wait events of the current acquisition, -1 if it isn't recorded
+    cdef int64_t _wait_flag
+    # Whether it was ever acquired. If not, nothing was recorded under its ID
+    cdef bint _acquired
+    cdef readonly int64_t lock_id
+    cdef readonly str name
+    cdef object __weakref__
+
+    def __cinit__(self, name=None):
+        self._lock = PyThread_allocate_lock()
+        if self._lock == NULL:
+            raise MemoryError("can't allocate lock")
+        self._owner = 0
+        self._count = 0
+        self._wait_flag = -1
+        self.name = name if name is not None else f"<{type(self).__name__} object at {id(self):#x}>"
+        self.lock_id = 0 if _is_calibrating() else _register_lock(self.name)
+
+    def __dealloc__(self):
+        if not self._acquired:
+            _free_lock_id(self.lock_id)
+        if self._lock != NULL:
+            if self._count:
+                PyThread_release_lock(self._lock)
+            PyThread_free_lock(self._lock)
+
+    cdef inline bint _acquire(self, long long timeout_us) except -1:
+        cdef unsigned long tid = PyThread_get_thread_ident()
+        cdef bint blocked = False
+        cdef int shift
+        cdef int64_t flag
+        self._acquired = True
+        if self._count and self._owner == tid:
+            # Re-entrant acquisitions never block. They are sampled along with the outermost one.
+            if _contention_only and not _is_calibrating():
+                _count_uncontended(self.lock_id)
+            elif self._wait_flag >= 0:
+                _record_wait(self.lock_id, self._wait_flag & ~F_BLOCKED)
+                _record_acquire(self.lock_id)
+            self._count += 1
+            return True
+        if _try_uncontended(self._lock, self.lock_id, &blocked):
+            self._wait_flag = -1
+        else:
+            if blocked and timeout_us == 0:
+                return False
+            shift = _sample(self.lock_id)
+            flag = _make_wait_flag(blocked, shift) if shift >= 0 else -1
+            if flag >= 0:
+                _record_wait(self.lock_id, flag)
+            if not _acquire_lock(self._lock, timeout_us):
+                return False
+            self._wait_flag = flag
+            if flag >= 0:
+                _record_acquire(self.lock_id)
+        self._owner = tid
+        self._count = 1
+        return True
+
+    cdef inline int64_t _recorded_levels(self):
+        """ Number of the held recursion levels whose release is recorded. """
+        if self._wait_flag < 0:
+            return 0
+        if _contention_only:
+            return 1
+        # Assumes the mode wasn't changed while the lock was held
+        return self._count
+
+    cdef inline void _release(self) except *:
+        if not self._count or self._owner != PyThread_get_thread_ident():
+            raise RuntimeError("cannot release un-acquired lock")
+        if self._wait_flag >= 0 and (not _contention_only or self._count == 1):
+            _record_release(self.lock_id)
+        self._count -= 1
+        if not self._count:
+            self._owner = 0
+            PyThread_release_lock(self._lock)
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(_timeout_us(blocking, timeout))
+
+    def release(self):
+        self._release()
+
+    def __enter__(self):
+        return self._acquire(-1)
+
+    def __exit__(self, *args):
+        self._release()
+
+    def _is_owned(self):
+        return self._count > 0 and self._owner == PyThread_get_thread_ident()
+
+    def _recursion_count(self):
+        return self._count if self._is_owned() else 0
+
+    def _release_save(self):
+        cdef int64_t i
+        if not self._count:
+            raise RuntimeError("cannot release un-acquired lock")
+        state = (self._count, self._owner)
+        for i in range(self._recorded_levels()):
+            _record_release(self.lock_id)
+        self._count = 0
+        self._owner = 0
+        PyThread_release_lock(self._lock)
+        return state
+
+    def _acquire_restore(self, state):
+        cdef int64_t i, flag, count = state[0]
+        cdef bint blocked = False
+        cdef int shift
+        if _try_uncontended(self._lock, self.lock_id, &blocked, count):
+            self._wait_flag = -1
+        else:
+            shift = _sample(self.lock_id)
+            flag = _make_wait_flag(blocked, shift) if shift >= 0 else -1
+            if flag >= 0:
+                _record_wait(self.lock_id, flag)
+            _acquire_lock(self._lock, -1)
+            self._wait_flag = flag
+            if flag >= 0:
+                _record_acquire(self.lock_id)
+            if blocked:
+                _count_uncontended(self.lock_id, count - 1)
+        self._owner = state[1]
+        self._count = count
+        if not blocked and self._wait_flag >= 0:
+            # The other levels are re-acquired at once
+            for i in range(1, count):
+                _record_wait(self.lock_id, self._wait_flag & ~F_BLOCKED)
+                _record_acquire(self.lock_id)
+
+    def _at_fork_reinit(self):
+        self._lock = PyThread_allocate_lock()
+        if self._lock == NULL:
+            raise MemoryError("can't allocate lock")
+        self._owner = 0
+        self._count = 0
+        self._wait_flag = -1
+
+    def __repr__(self):
+        return (
+            f"<{'locked' if self._count else 'unlocked'} {self.name} owner={self._owner} count={self._count}>"
+        )
+
+
+cdef class LiveAggregates:
+    """ Counters like those of aggregate-only mode, kept up to date from the events as they are recorded.
+
+    Each `update` only copies the events recorded since the previous one, holding the recorder's mutexes (see
+    event_buffer.h) but not for sorting them or updating the counters, which is done without the GIL. Following a
+    trace this way costs about as much as recording it, however often it is updated. Events dropped from memory
+    before an update, by the flight recorder or streaming, are counted in `lost_events`. The counters start over
+    when the trace is cleared, see `resets`.
+
+    Sampled acquisitions count once, without their sampling weight. Use each instance from a single thread.
+    """
+    cdef EventCursor cursor
+    cdef AggregateState state
+    # Events added to the counters
+    cdef readonly int64_t events
+    cdef readonly int64_t lost_events
+    # Times the counters started over after `LockProfiler.clear_trace`, which also renumbers the call stacks
+    cdef readonly int64_t resets
+
+    def __cinit__(self):
+        # Starting with the events recorded so far
+        self.cursor.generation = event_buffer_generation()
+
+    def update(self) -> EventArray:
+        """ Add the events recorded since the previous update to the counters. Returns them, sorted by timestamp. """
+        cdef EventArray new = EventArray.__new__(EventArray)
+        cdef uint64_t generation = self.cursor.generation
+        cdef uint64_t lost = event_buffer_collect_new(new.events, self.cursor)
+        cdef CLockEvent* e
+        cdef size_t i
+        cdef int64_t kind
+        if self.cursor.generation != generation:
+            aggregate_state_clear(self.state)
+            self.events = self.lost_events = 0
+            self.resets += 1
+        self.lost_events += lost
+        self.events += new.events.size()
+        with nogil:
+            event_buffer_sort(new.events)
+            for i in range(new.events.size()):
+                e = &new.events[i]
+                kind = e.flag & E_MASK
+                if kind == E_WAIT:
+                    aggregate_state_wait(self.state, e.tid, e.timestamp, e.lock_hash, e.stack_hash, e.flag & F_BLOCKED)
+                elif kind == E_ACQUIRE:
+                    aggregate_state_acquire(
+                        self.state, e.tid, e.timestamp, e.lock_hash, not e.flag & F_UNCALIBRATED,
+                    )
+                else:
+                    aggregate_state_release(self.state, e.tid, e.timestamp, e.lock_hash)
+        return new
+
+    def get_aggregates(self):
+        """ Return the counters as `(lock_counters, stack_counters)`, like `LockProfiler.get_aggregates`. """
+        return _collect_aggregates(self.state)
+
 
 cdef class LockProfiler:
     def __init__(self):
@@ -165,176 +885,356 @@ cdef class LockProfiler:
 
     @staticmethod
     def clear_trace():
-        _stack_map = {}
-        _lock_strs = {}
-        _c_lock_list.clear()
-        _c_current_stack_map.clear()
+        _symbol_cache.clear()
+        call_site_clear()
+        event_buffer_clear()
+        aggregate_clear()
+        _uncontended_counts.clear()
+
+    @staticmethod
+    def set_buffer_limit(max_events=None, max_bytes=None):
+        """ Bound the memory used for events, turning the recorder into a flight recorder.
+
+        Once the limit is reached, the oldest events are overwritten. Events are stored in chunks of
+        EVENT_CHUNK_SIZE events, so the limit is rounded up to whole chunks, and to at least one chunk per
+        recording thread. Call with no arguments to remove the limit.
+        """
+        limits = []
+        if max_events is not None:
+            limits.append(-(-max_events // EVENT_CHUNK_SIZE))
+        if max_bytes is not None:
+            limits.append(max_bytes // sizeof(EventChunk))
+        event_buffer_set_max_chunks(max(1, min(limits)) if limits else 0)
+
+    @staticmethod
+    def set_timer(name):
+        """ Select the timestamp source, one of `TIMERS`, and recalibrate the hook overhead, see `calibrate`.
+
+        "monotonic" is CLOCK_MONOTONIC. "monotonic_raw" isn't slewed by NTP. "tsc" reads the CPU's time stamp counter
+        directly, which is the cheapest, and is only available on x86-64 Linux with an invariant TSC. All of them
+        count nanoseconds. Can also be selected with the LOCK_PROFILER_TIMER environment variable. Timestamps from
+        different timers can't be compared, so select it before recording.
+        """
+        if name not in TIMERS:
+            raise ValueError(f"Unknown timer {name!r}, expected one of {TIMERS}")
+        if hpTimerSetBackend(TIMERS.index(name)) != 0:
+            raise RuntimeError(f"Timer {name!r} is not available on this system")
+        _schedule_calibration()
+
+    @staticmethod
+    def get_timer():
+        return TIMERS[hpTimerBackend()]
+
+    @staticmethod
+    def timestamp():
+        """ Current time of the recorder's timer, comparable to event timestamps.
+
+        Used to mark intervals to compute the critical path of, see `critical_path.critical_paths`.
+        """
+        return hpTimer()
+
+    @staticmethod
+    def calibrate(int iterations=2000):
+        """ Measure the cost of the hooks, which the analysis subtracts from wait and hold times.
+
+        Times an uncontended `ProfiledLock` and `ProfiledRLock` around an empty block, through the same recording path
+        as any lock, into a scratch buffer that is discarded: the shortest measured wait and hold times are the part of
+        the hooks' cost that falls between their timestamps. The lower of the two lock types' is kept, and it is only
+        subtracted from their events: the wait and hold times of `post_acquire` include the cost of the Python code
+        calling the hooks, which isn't measured, see `PY_F_UNCALIBRATED`. Only the calling thread records into the
+        scratch buffer, and neither the timed locks nor their call stacks are registered. Done when the first lock is registered, unless the
+        LOCK_PROFILER_CALIBRATE environment variable is 0. Returns `(wait_overhead, hold_overhead)`.
+        """
+        global _calibrating_thread, _calibration_pending, _wait_overhead, _hold_overhead
+        cdef int i
+        cdef size_t count
+        cdef const CLockEvent* events
+        cdef ThreadBuffer* own
+        cdef size_t n_stacks = _call_site_stacks.size()
+        cdef PY_LONG_LONG wait, hold
+        cdef PY_LONG_LONG min_wait = -1, min_hold = -1
+        if _calibrating_thread != 0:
+            raise RuntimeError("Another thread is calibrating")
+        _calibration_pending = False
+        _calibrating_thread = PyThread_get_thread_ident()
+        own = event_buffer_start_scratch()
+        try:
+            for lock in (ProfiledLock("<lock_profiler calibration>"), ProfiledRLock("<lock_profiler calibration>")):
+                for i in range(iterations):
+                    with lock:
+                        pass
+                    events = event_buffer_take_scratch(&count)
+                    # Nothing is recorded while the events are frozen
+                    if count != 3:
+                        continue
+                    wait = events[E_ACQUIRE].timestamp - events[E_WAIT].timestamp
+                    hold = events[E_RELEASE].timestamp - events[E_ACQUIRE].timestamp
+                    if min_wait < 0 or wait < min_wait:
+                        min_wait = wait
+                    if min_hold < 0 or hold < min_hold:
+                        min_hold = hold
+        finally:
+            event_buffer_stop_scratch(own)
+            _calibrating_thread = 0
+            # Interned again if a recorded event is made from them
+            while _call_site_stacks.size() > n_stacks:
+                _call_site_nodes[_call_site_stacks.back()].is_stack = False
+                _call_site_stacks.pop_back()
+        _wait_overhead = max(min_wait, 0)
+        _hold_overhead = max(min_hold, 0)
+        aggregate_set_overhead(_wait_overhead, _hold_overhead)
+        return _wait_overhead, _hold_overhead
+
+    @staticmethod
+    def set_overhead(int64_t wait_overhead, int64_t hold_overhead):
+        """ Set the hook cost subtracted from wait and hold times instead of calibrating it. 0 disables it. """
+        global _calibration_pending, _wait_overhead, _hold_overhead
+        _calibration_pending = False
+        _wait_overhead = wait_overhead
+        _hold_overhead = hold_overhead
+        aggregate_set_overhead(_wait_overhead, _hold_overhead)
+
+    @staticmethod
+    def get_overhead():
+        return _wait_overhead, _hold_overhead
+
+    @staticmethod
+    def set_aggregate_only(enabled=True):
+        """ Only keep per-lock and per-call stack counters, instead of recording every event.
+
+        Memory use then only depends on the number of locks and call stacks, and the stats are available at any
+        time through `get_aggregates`, without analyzing events. Switching modes doesn't clear what was recorded.
+        """
+        global _aggregate_only
+        _aggregate_only = enabled
+
+    @staticmethod
+    def is_aggregate_only():
+        return _aggregate_only
+
+    @staticmethod
+    def set_contention_only(enabled=True):
+        """ Only record the acquisitions of profiled locks that block.
+
+        `ProfiledLock` and `ProfiledRLock` then first try to acquire without blocking. If that works, which is the
+        case for most acquisitions, it is only counted (see `get_uncontended_counts`): no event or call stack is
+        recorded, and neither is its release. Otherwise the wait is recorded with the `F_BLOCKED` flag, followed
+        by the acquire and release as usual. Re-entrant acquisitions of an `RLock` are always counted.
+        Failed non-blocking acquisitions are not recorded.
+
+        Hold times then only cover blocked acquisitions. Locks instrumented with the hooks can do the same with
+        `count_uncontended` and `pre_acquire(lock_id, blocked=True)`. Change the mode while no profiled lock is
+        held.
+        """
+        global _contention_only
+        _contention_only = enabled
+
+    @staticmethod
+    def is_contention_only():
+        return _contention_only
+
+    @staticmethod
+    def set_sampling(rate=1.0, budget=None, seed=0):
+        """ Only record a random sample of the acquisitions of each lock.
+
+        Each acquisition is recorded with probability `rate`, rounded to a power of two, and its weight, the
+        inverse of that probability, is recorded in its wait event's flag (see `PY_F_SAMPLE_SHIFT`). Unsampled
+        acquisitions are not recorded at all, not even their release. `analysis.Stat.estimate` then gives
+        unbiased estimates of the totals with confidence intervals.
+
+        With a `budget`, locks taken more than `budget` times per second get a lower rate, adapted every 100 ms
+        to their rate of acquisitions over the previous 100 ms. `seed` seeds the random generator. Per-lock rates
+        can be set with `set_lock_sampling`. Call with no arguments to record every acquisition again. Sampling
+        doesn't apply in aggregate-only mode.
+        """
+        if budget is not None and budget <= 0:
+            raise ValueError("budget must be positive")
+        sampling_configure(_rate_shift(rate), budget or 0, seed)
+
+    @staticmethod
+    def set_lock_sampling(int64_t lock_id, rate=None):
+        """ Sample the acquisitions of one lock at `rate` instead of the global rate of `set_sampling`.
+
+        `None` makes it use the global rate again.
+        """
+        _check_lock_id(lock_id)
+        sampling_set_lock_shift(lock_id, -1 if rate is None else _rate_shift(rate))
+
+    @staticmethod
+    def count_uncontended(int64_t lock_id, int64_t count=1):
+        """ Count acquisitions of a lock that didn't block, without recording them. """
+        _check_lock_id(lock_id)
+        _count_uncontended(lock_id, count)
+
+    @staticmethod
+    def get_uncontended_counts() -> typing.Dict[int, int]:
+        """ Return `{lock_id: count}` of the acquisitions only counted in contention-only mode. """
+        return {lock_id: count for lock_id, count in enumerate(_uncontended_counts) if count}
+
+    @staticmethod
+    def get_aggregates():
+        """ Return the counters updated in aggregate-only mode, as `(lock_counters, stack_counters)`.
+
+        `lock_counters` is `{lock_hash: counters}` and `stack_counters` is `{(lock_hash, stack_hash): counters}`,
+        with `counters` a tuple of `AGGREGATE_FIELDS`.
+        """
+        return _collect_aggregates(_aggregate_state)
+
+    @staticmethod
+    def freeze():
+        """ Stop recording events, keeping the ones already recorded. """
+        event_buffer_freeze(True)
+
+    @staticmethod
+    def unfreeze():
+        """ Resume recording after `freeze`. """
+        event_buffer_freeze(False)
+
+    @staticmethod
+    def snapshot() -> LockStats:
+        """ Freeze the recorder, collect its current contents, and resume recording.
+
+        Intended for flight recorder mode (see `set_buffer_limit`) to capture the most recent lock activity.
+        """
+        was_frozen = event_buffer_is_frozen()
+        event_buffer_freeze(True)
+        try:
+            return LockProfiler.get_stats()
+        finally:
+            event_buffer_freeze(was_frozen)
+
+    @staticmethod
+    def start_streaming(filename):
+        """ Stream events to `filename` instead of keeping them in memory.
+
+        Full event chunks are written by a background thread, so recording never waits for I/O. Events recorded
+        before this call are written too. Use `stop_streaming` to finish the file.
+        """
+        global _stream_filename
+        path = os.fsencode(filename)
+        if event_stream_start(path) != 0:
+            if event_stream_is_active():
+                raise RuntimeError("Events are already being streamed")
+            raise OSError(f"Could not open {filename!r} for writing")
+        _stream_filename = filename
+
+    @staticmethod
+    def stop_streaming() -> LockStats:
+        """ Finish the stream started by `start_streaming`.
+
+        Returns the stats of the stream file. Its `lock_list` reads the events from the file lazily.
+        """
+        from .event_stream import write_trailer, read_event_stream
+        global _stream_filename
+        cdef int ret
+        if _stream_filename is None:
+            raise RuntimeError("Events are not being streamed")
+        filename, _stream_filename = _stream_filename, None
+        # Waits for the writer thread to finish
+        with nogil:
+            ret = event_stream_stop()
+        if ret != 0:
+            raise OSError(f"Could not write {filename!r}")
+        write_trailer(
+            filename, _lock_strs, _resolve_stacks(), _wait_overhead, _hold_overhead,
+            LockProfiler.get_uncontended_counts(),
+        )
+        return read_event_stream(filename)
+
+    @staticmethod
+    def is_streaming():
+        return event_stream_is_active()
 
     @staticmethod
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def pre_acquire(obj):
-        global _idx
-        h = hash(obj._lock)
-        if h not in _lock_strs:
-            _lock_strs[h] = str(obj)
-
-        tid = threading.get_ident()
-
-        # lock acquire called
-        if 1:
-            f = sys._getframe()
-            # f = <object>py_frame
-            skip = 0
-            while skip and f:
-                skip -= 1
-                f = f.f_back
-
-            stack = []
-            stack_hash = 0
-            while f is not None:
-                # if not filename.endswith("Lockable.py"):
-                frame = (
-                    f.f_code.co_filename,
-                    f.f_code.co_name,
-                    f.f_lineno
-                )
-                stack.append(frame)
-                # stack_hash ^= hash(frame)
-                f = f.f_back
-            # stack = tuple(stack)
-
-            # stack = (('C:\\development\\python\\packages\\test_jig_util\\tests\\lock_profiler_test.py', '<module>', 25), ('C:\\Users\\Ivan\\AppData\\Roaming\\JetBrains\\IntelliJIdea2022.2\\plugins\\python\\helpers\\pydev\\_pydev_imps\\_pydev_execfile.py', 'execfile', 18), ('C:/Users/Ivan/AppData/Roaming/JetBrains/IntelliJIdea2022.2/plugins/python/helpers/pydev/pydevd.py', '_exec', 1496), ('C:/Users/Ivan/AppData/Roaming/JetBrains/IntelliJIdea2022.2/plugins/python/helpers/pydev/pydevd.py', 'run', 1489), ('C:/Users/Ivan/AppData/Roaming/JetBrains/IntelliJIdea2022.2/plugins/python/helpers/pydev/pydevd.py', 'main', 2177), ('C:/Users/Ivan/AppData/Roaming/JetBrains/IntelliJIdea2022.2/plugins/python/helpers/pydev/pydevd.py', '<module>', 2195))
-            stack_hash = hash(tuple(stack))
-        else:
-            stack = ""
-            stack_hash = 1
-
-        if stack_hash not in _stack_map:
-            # if not _c_stack_map.count(stack_hash):
-            _stack_map[stack_hash] = stack
-
-        # _c_current_stack_map[tid] = stack_hash
-        _c_lock_list.push_back(CLockEvent(
-            hpTimer(), # TODO may want to do this last to ignore overhead from this functions
-            E_WAIT,
-            tid,
-            h,
-            stack_hash,
-        ))
-
-        # blocked = 0
-        # if _c_held_map.count(h):
-        #     if _c_held_map[h] != tid:
-        #         # Another thread is holding this lock; we're blocked
-        #         # _c_wait_map[h] = tid
-        #         blocked = 1
-        # else:
-        #     _c_held_map[h] = tid
-        #
-        # size = _c_lock_map[tid][h].size()
-        # _c_lock_map[tid][h].push_back(CLockInfo(
-        #     hpTimer(), # TODO may want to do this last to ignore overhead from this functions
-        #     _idx,
-        #     size,
-        #     # # temporarily using `acquire_duration` as a flag to say if this thread is blocked or not
-        #     # blocked,
-        #     0,
-        #
-        #     0,
-        #     tid,
-        #     h,
-        #     stack_hash,
-        # ))
-        #
-        # _idx += 1
+    def pre_acquire(int64_t lock_id, bint blocked=False):
+        """ Record that the current thread starts acquiring the lock registered as `lock_id`.
+
+        `blocked` tells that another thread holds it, e.g. after a failed non-blocking acquire, for when the
+        holder's acquisition isn't recorded (see `set_contention_only`). Returns whether the acquisition is
+        recorded, which is not the case when it isn't sampled (see `set_sampling`): then don't call
+        `post_acquire` and `pre_release` for it.
+        """
+        _check_lock_id(lock_id)
+        cdef int shift = _sample(lock_id)
+        if shift < 0:
+            return False
+        _record_wait(lock_id, _make_wait_flag(blocked, shift))
+        return True
 
     @staticmethod
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def post_acquire(obj):
-        t = hpTimer()
-        h = hash(obj._lock)
-        tid = threading.get_ident()
-
-        _c_lock_list.push_back(CLockEvent(
-            hpTimer(),
-            E_ACQUIRE,
-            tid,
-            h,
-            0,
-        ))
-
-
-        # # info = _c_lock_map[tid][h].back()
-        # # was_blocked = _c_lock_map[tid][h].back().wait_duration
-        # _c_lock_map[tid][h].back().wait_duration = t - _c_lock_map[tid][h].back().timestamp
-        #
-        # # # TODO maybe record the wait duration even if it wasn't blocked (it will only show the Python overhead and any OS overhead in this case)
-        # # if was_blocked:
-        # #     info.wait_duration = wait_duration
-        #
-        # # if _c_held_map.count(h):
-        # #     assert _c_held_map[h].tid == tid
-        # # else:
-        # #     _c_held_map[h] = LockDepth(t, tid, 0)
-        # #
-        # # _c_held_map[h].depth += 1
+    def post_acquire(int64_t lock_id):
+        _check_lock_id(lock_id)
+        _record_acquire(lock_id, E_ACQUIRE | F_UNCALIBRATED)
 
+    @staticmethod
+    def pre_release(int64_t lock_id):
+        _check_lock_id(lock_id)
+        _record_release(lock_id)
+
+    @staticmethod
+    def register_lock(str name) -> int:
+        """ Give a lock a unique ID, to pass to `pre_acquire`, `post_acquire` and `pre_release`.
+
+        IDs are dense. An ID is only reused once the lock it was given to is freed without anything ever recorded
+        under it, so the events of short-lived locks are never attributed to another lock. Only
+        `ProfiledLock` and `ProfiledRLock` give their ID back, when they are deallocated without ever being acquired:
+        the IDs returned here are never reused. `name` is stored once, and reported as the lock's name.
+        """
+        return _register_lock(name)
 
     @staticmethod
-    def pre_release(obj):
-        t = hpTimer()
-        h = hash(obj._lock)
-        tid = threading.get_ident()
-
-        _c_lock_list.push_back(CLockEvent(
-            hpTimer(),
-            E_RELEASE,
-            tid,
-            h,
-            0,
-        ))
-
-        # info = _c_lock_map[tid][h].back()
-        # _c_lock_map[tid][h].pop_back()
-        # hold_duration = t - (info.timestamp + info.wait_duration)
-        #
-        # info.hold_duration = hold_duration
-        # _c_lock_list.push_back(info)
-        #
-        # if not _c_lock_map[tid][h].size():
-        #     _c_lock_map[tid].erase(h)
-        #     assert _c_held_map[h] == tid
-        #     _c_held_map.erase(h)
-        #
-        #     # if _c_wait_map.count(h):
-        #     #     # Another thread is waiting for this lock; they're unblocked now
+    def get_lock_names() -> typing.Dict[int, str]:
+        """ Return `{lock_id: name}` for every registered lock. """
+        return dict(_lock_strs)
 
     @staticmethod
-    def get_stats() -> LockStats:
+    def get_stacks(stack_ids=None) -> typing.Dict[int, typing.List[StackFrame]]:
+        """ Return `{stack_id: frames}` of the interned call stacks of `stack_ids`, or of all of them.
+
+        Frames are innermost first, as in `LockStats.stack_hashes`. IDs that aren't interned are left out.
+        """
+        return _resolve_stacks(stack_ids)
+
+    @staticmethod
+    def get_event_array() -> EventArray:
+        """ Return the recorded events sorted by timestamp, without creating a Python object per event.
+
+        `EventArray.as_numpy()` gives a structured array for vectorized analysis.
+        """
+        cdef EventArray output = EventArray.__new__(EventArray)
+        event_buffer_collect(output.events)
+        return output
+
+    @staticmethod
+    def get_stats(as_array=False) -> LockStats:
         """ Return a LineStats object containing the timings.
+
+        With `as_array`, `lock_list` is an `EventArray` instead of a list of `LockEvent`s, which avoids creating a
+        Python object per event.
         """
+        cdef vector[CLockEvent] events
+        if as_array:
+            return LockStats(
+                _lock_strs, _resolve_stacks(), LockProfiler.get_event_array(), _wait_overhead, _hold_overhead,
+                LockProfiler.get_uncontended_counts(),
+            )
+        event_buffer_collect(events)
 
-        output = LockStats(
+        return LockStats(
             _lock_strs,
-            # # Remove frames in Lockable.py
-            # {k:
-            #      tuple(frame for frame in v if not frame[0].endswith("Lockable.py"))
-            #  for k, v in _stack_map.items()},
-            # _c_stack_map,
-            _stack_map,
-            [LockEvent(
-                a.timestamp,
-                a.flag,
-                # a.idx,
-                # a.current_depth,
-                # a.wait_duration,
-                # a.hold_duration,
-                a.tid,
-                a.lock_hash,
-                a.stack_hash,
-            ) for a in _c_lock_list],
-            # tuple(CLockTime(t[0] - offset, *t[1:]) for t in _c_lock_list),
+            _resolve_stacks(),
+            [LockEvent(a.timestamp, a.flag, a.tid, a.lock_hash, a.stack_hash) for a in events],
+            _wait_overhead,
+            _hold_overhead,
+            LockProfiler.get_uncontended_counts(),
         )
-        return output
+
+
+if os.environ.get("LOCK_PROFILER_TIMER"):
+    LockProfiler.set_timer(os.environ["LOCK_PROFILER_TIMER"])
+elif os.environ.get("LOCK_PROFILER_CALIBRATE", "1") != "0":
+    _schedule_calibration()
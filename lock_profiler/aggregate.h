@@ -0,0 +1,243 @@
+/* Online contention statistics, for recording without storing events.
+ *
+ * The hooks update per-lock and per-(lock, call stack) counters directly, so
+ * memory is bounded by the number of locks and call stacks rather than the
+ * number of events, and the stats can be read at any time.
+ *
+ * The counters follow the same rules as the analysis of recorded events:
+ * re-entrant acquisitions count as hits but not acquires, and the hold time
+ * of a lock is that of its outermost acquisition. A call stack is attributed
+ * the hold time of the outermost acquisitions made through it. Each time is
+ * also recorded in a histogram, see histogram.h. The hooks' own cost, as
+ * measured by `LockProfiler.calibrate`, is subtracted from wait and hold times.
+ *
+ * The counters live in an AggregateState. The hooks update `_aggregate_state`
+ * and must be called with the GIL held; other states can be fed recorded
+ * events by their owner, e.g. to follow a trace while it is being recorded
+ * (see `LiveAggregates`), without the GIL.
+ */
+#ifndef LOCK_PROFILER_AGGREGATE_H
+#define LOCK_PROFILER_AGGREGATE_H
+
+#include "Python.h"
+#include "pythread.h"
+#include "histogram.h"
+
+#include <algorithm>
+#include <cstdint>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+struct AggregateStat {
+    int64_t hits;
+    int64_t acquires;
+    /* Number of times it was blocked by another thread */
+    int64_t blocks;
+    int64_t total_wait_time;
+    int64_t max_wait_time;
+    int64_t total_hold_time;
+    int64_t max_hold_time;
+    int64_t total_block_time;
+    int64_t max_block_time;
+    LatencyHistogram wait_histogram;
+    LatencyHistogram hold_histogram;
+    LatencyHistogram block_histogram;
+};
+
+struct AggregateLock {
+    AggregateStat stat;
+    /* Thread holding the lock, valid while `depth` > 0 */
+    int64_t holder;
+    /* Number of nested acquisitions by the holder */
+    int64_t depth;
+};
+
+struct AggregateSiteKey {
+    int64_t lock_hash;
+    int64_t stack_hash;
+
+    bool operator==(const AggregateSiteKey& other) const {
+        return lock_hash == other.lock_hash && stack_hash == other.stack_hash;
+    }
+};
+
+struct AggregateSiteKeyHash {
+    size_t operator()(const AggregateSiteKey& key) const {
+        uint64_t h = (uint64_t)key.lock_hash * 0x9E3779B97F4A7C15ULL;
+        h ^= (uint64_t)key.stack_hash + 0x9E3779B97F4A7C15ULL + (h << 6) + (h >> 2);
+        return (size_t)h;
+    }
+};
+
+struct AggregateHeld {
+    PY_LONG_LONG timestamp;
+    /* Whether the hook overhead is subtracted from its hold time, see `PY_F_UNCALIBRATED` */
+    bool calibrated;
+    /* Stats of the call stack it was acquired from */
+    AggregateStat* site;
+};
+
+struct AggregateThread {
+    /* Pending wait, set by `aggregate_wait` until the lock is acquired */
+    bool waiting;
+    bool blocked;
+    PY_LONG_LONG wait_timestamp;
+    int64_t wait_stack_hash;
+    /* {lock_hash: nested acquisitions, outermost first} */
+    std::unordered_map<int64_t, std::vector<AggregateHeld>> held;
+};
+
+struct AggregateState {
+    /* Node-based maps, so pointers to their values stay valid as they grow */
+    std::unordered_map<int64_t, AggregateLock> locks;
+    std::unordered_map<AggregateSiteKey, AggregateStat, AggregateSiteKeyHash> sites;
+    std::unordered_map<int64_t, AggregateThread> threads;
+};
+
+/* Counters of aggregate-only mode */
+static AggregateState _aggregate_state;
+
+/* Hook cost included in each wait and hold time, see `LockProfiler.calibrate` */
+static int64_t _aggregate_wait_overhead = 0;
+static int64_t _aggregate_hold_overhead = 0;
+
+static inline void
+_aggregate_add(int64_t& total, int64_t& max, LatencyHistogram& hist, int64_t duration)
+{
+    total += duration;
+    max = std::max(max, duration);
+    histogram_record(hist, duration);
+}
+
+/* `blocked` tells that the lock is known to be held by another thread, whose acquisition may not have been recorded */
+static inline void
+aggregate_state_wait(
+    AggregateState& state, int64_t tid, PY_LONG_LONG timestamp, int64_t lock_hash, int64_t stack_hash, bool blocked)
+{
+    AggregateLock& lock = state.locks[lock_hash];
+    AggregateThread& thread = state.threads[tid];
+    thread.waiting = true;
+    // The lock is already held by a different thread
+    thread.blocked = blocked || (lock.depth > 0 && lock.holder != tid);
+    thread.wait_timestamp = timestamp;
+    thread.wait_stack_hash = stack_hash;
+}
+
+/* `calibrated` tells to subtract the hook overhead from its wait and hold times, see `PY_F_UNCALIBRATED` */
+static inline void
+aggregate_state_acquire(AggregateState& state, int64_t tid, PY_LONG_LONG timestamp, int64_t lock_hash, bool calibrated)
+{
+    AggregateThread& thread = state.threads[tid];
+    if (!thread.waiting) {
+        // Recording started while this thread was waiting
+        return;
+    }
+    thread.waiting = false;
+
+    AggregateLock& lock = state.locks[lock_hash];
+    AggregateStat& site = state.sites[AggregateSiteKey{lock_hash, thread.wait_stack_hash}];
+    int64_t wait_overhead = calibrated ? _aggregate_wait_overhead : 0;
+    int64_t wait_duration = std::max((int64_t)(timestamp - thread.wait_timestamp) - wait_overhead, (int64_t)0);
+    for (AggregateStat* stat : {&lock.stat, &site}) {
+        stat->hits += 1;
+        if (!lock.depth) {
+            stat->acquires += 1;
+        }
+        _aggregate_add(stat->total_wait_time, stat->max_wait_time, stat->wait_histogram, wait_duration);
+        if (thread.blocked) {
+            stat->blocks += 1;
+            _aggregate_add(stat->total_block_time, stat->max_block_time, stat->block_histogram, wait_duration);
+        }
+    }
+    lock.depth += 1;
+    lock.holder = tid;
+    thread.held[lock_hash].push_back(AggregateHeld{timestamp, calibrated, &site});
+}
+
+static inline void
+aggregate_state_release(AggregateState& state, int64_t tid, PY_LONG_LONG timestamp, int64_t lock_hash)
+{
+    AggregateLock& lock = state.locks[lock_hash];
+    std::vector<AggregateHeld>* held = &state.threads[tid].held[lock_hash];
+    if (held->empty() && lock.depth > 0) {
+        // Released by another thread than the holder, which plain locks allow
+        held = &state.threads[lock.holder].held[lock_hash];
+    }
+    if (held->empty()) {
+        // Acquired before recording started
+        return;
+    }
+    AggregateHeld acquire = held->back();
+    held->pop_back();
+
+    lock.depth -= 1;
+    // Only the outermost acquisition holds the lock
+    if (!lock.depth) {
+        int64_t hold_overhead = acquire.calibrated ? _aggregate_hold_overhead : 0;
+        int64_t hold_duration = std::max((int64_t)(timestamp - acquire.timestamp) - hold_overhead, (int64_t)0);
+        _aggregate_add(lock.stat.total_hold_time, lock.stat.max_hold_time, lock.stat.hold_histogram, hold_duration);
+        _aggregate_add(acquire.site->total_hold_time, acquire.site->max_hold_time, acquire.site->hold_histogram, hold_duration);
+    }
+}
+
+static void
+aggregate_state_collect_locks(const AggregateState& state, std::vector<std::pair<int64_t, AggregateStat>>& out)
+{
+    for (auto& item : state.locks) {
+        if (item.second.stat.hits) {
+            out.emplace_back(item.first, item.second.stat);
+        }
+    }
+}
+
+static void
+aggregate_state_collect_sites(const AggregateState& state, std::vector<std::pair<AggregateSiteKey, AggregateStat>>& out)
+{
+    out.insert(out.end(), state.sites.begin(), state.sites.end());
+}
+
+/* Reset all counters. Locks held at this point are ignored when they are released. */
+static void
+aggregate_state_clear(AggregateState& state)
+{
+    state.locks.clear();
+    state.sites.clear();
+    state.threads.clear();
+}
+
+/* Hooks of aggregate-only mode, called by the current thread */
+
+static inline void
+aggregate_wait(PY_LONG_LONG timestamp, int64_t lock_hash, int64_t stack_hash, bool blocked)
+{
+    aggregate_state_wait(
+        _aggregate_state, (int64_t)PyThread_get_thread_ident(), timestamp, lock_hash, stack_hash, blocked);
+}
+
+static inline void
+aggregate_acquire(PY_LONG_LONG timestamp, int64_t lock_hash, bool calibrated)
+{
+    aggregate_state_acquire(_aggregate_state, (int64_t)PyThread_get_thread_ident(), timestamp, lock_hash, calibrated);
+}
+
+static inline void
+aggregate_release(PY_LONG_LONG timestamp, int64_t lock_hash)
+{
+    aggregate_state_release(_aggregate_state, (int64_t)PyThread_get_thread_ident(), timestamp, lock_hash);
+}
+
+static void
+aggregate_set_overhead(int64_t wait_overhead, int64_t hold_overhead)
+{
+    _aggregate_wait_overhead = wait_overhead;
+    _aggregate_hold_overhead = hold_overhead;
+}
+
+static void
+aggregate_clear()
+{
+    aggregate_state_clear(_aggregate_state);
+}
+
+#endif
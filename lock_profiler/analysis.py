@@ -0,0 +1,929 @@
+"""
+Contention analysis of recorded lock events.
+
+Computes, per lock and per (file, line, lock) call site, how often the lock
+was taken and blocked, and how long it was waited for, held and blocked.
+Blocked waits are also charged to the critical sections that held the lock
+meanwhile: their call sites get "blame" for the time other threads waited.
+
+The analysis is vectorized with NumPy when it is installed: events are paired
+(wait -> acquire -> release) and grouped with sort and cumulative operations
+over the event columns, instead of a Python loop over every event. Without
+NumPy, an equivalent pure-Python implementation is used.
+
+Sampled acquisitions (see `LockProfiler.set_sampling`) are weighted by the
+inverse of their sampling probability, recorded in the flag of their wait event.
+`Stat.estimate` gives the resulting Horvitz-Thompson estimates of the totals.
+"""
+import dataclasses
+import itertools
+import math
+import typing
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from ._lock_profiler import LockStats, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_E_MASK, PY_F_SAMPLE_SHIFT, \
+    PY_F_BLOCKED, PY_F_UNCALIBRATED, EVENT_FIELDS, AGGREGATE_FIELDS
+from .event_stream import StreamedEvents
+from .histogram import Histogram, bucket_indices
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# Frames in these files are not attributed any stats
+IGNORED_FILES = ("Lockable.py", "threading.py")
+# Bits of a wait event flag giving log2 of its acquisition's sampling weight
+_SHIFT_MASK = 0x1F
+# Totals that `Stat.estimate` corrects for sampling
+ESTIMATED_FIELDS = ("hits", "acquires", "blocks", "total_wait_time", "total_hold_time", "total_block_time")
+
+
+class Estimate(typing.NamedTuple):
+    value: float
+    # Bounds of the confidence interval
+    low: float
+    high: float
+
+
+@dataclass
+class Stat:
+    # hits includes recursive re-acquisition of the same lock, while `acquires` does not
+    hits: int = 0
+    acquires: int = 0
+    # Number of times it was blocked by another thread
+    blocks: int = 0
+    # total time spent waiting for the lock, including time for re-acquisitions (based on hits)
+    total_wait_time: int = 0
+    # average time spent waiting for the lock, excluding re-acquisitions since they take almost no time and would drag down the average (based on acquires)
+    avg_wait_time: int = 0
+    max_wait_time: int = 0
+    # hold time is the time between first seen acquire and the matching release
+    # Therefore, all these times are implicitly based on `acquires`
+    total_hold_time: int = 0
+    avg_hold_time: int = 0
+    max_hold_time: int = 0
+
+    total_block_time: int = 0
+    avg_block_time: int = 0
+    max_block_time: int = 0
+
+    # Distributions of the same times, for percentiles
+    wait_histogram: Histogram = field(default_factory=Histogram, repr=False)
+    hold_histogram: Histogram = field(default_factory=Histogram, repr=False)
+    block_histogram: Histogram = field(default_factory=Histogram, repr=False)
+    # Times a critical section blocked another thread, and for how long it did, charged to the call sites of the
+    # holder's outermost acquisition. Not available in aggregate-only mode.
+    blames: int = 0
+    total_blame_time: int = 0
+    # {field: (estimated total of the unsampled acquisitions, variance of the estimate)}, for sampled acquisitions
+    _extra: typing.Dict[str, typing.Tuple[float, float]] = field(default_factory=dict, repr=False, compare=False)
+    # current acquisition depth
+    _depth: int = 0
+    # Current holder
+    _tid: int = 0
+
+    def finalize(self):
+        self.avg_wait_time = self.total_wait_time // max(1, self.acquires)
+        self.avg_hold_time = self.total_hold_time // max(1, self.acquires)
+        self.avg_block_time = self.total_block_time // max(1, self.blocks)
+
+    def percentiles(self) -> typing.Dict[str, typing.Dict[float, int]]:
+        """`{"wait" | "hold" | "block": {percentile: time}}` for the percentiles in `PERCENTILES`."""
+        return {
+            "wait": self.wait_histogram.percentiles(),
+            "hold": self.hold_histogram.percentiles(),
+            "block": self.block_histogram.percentiles(),
+        }
+
+    def estimate(self, name: str, z: float = 1.96) -> Estimate:
+        """Unbiased estimate of one of the `ESTIMATED_FIELDS` including the acquisitions that weren't sampled.
+
+        The interval is `z` standard deviations wide on each side (95% by default), assuming the estimate is
+        normally distributed, and doesn't go below the recorded total. Without sampling, all three are the
+        recorded total.
+        """
+        if name not in ESTIMATED_FIELDS:
+            raise ValueError(f"{name!r} is not estimated")
+        raw = getattr(self, name)
+        extra, var = self._extra.get(name, (0, 0))
+        value = raw + extra
+        margin = z * math.sqrt(var)
+        return Estimate(value, max(raw, value - margin), value + margin)
+
+    def estimates(self, z: float = 1.96) -> typing.Dict[str, Estimate]:
+        """`estimate` of every field in `ESTIMATED_FIELDS`."""
+        return {name: self.estimate(name, z) for name in ESTIMATED_FIELDS}
+
+    def summary(self) -> tuple:
+        """The public totals, followed by the wait, hold and block percentiles, then the blame totals."""
+        fields = dataclasses.astuple(self)[:_N_SUMMARY_FIELDS]
+        percentiles = tuple(t for times in self.percentiles().values() for t in times.values())
+        return fields + percentiles + (self.blames, self.total_blame_time)
+
+
+# Number of leading `Stat` fields holding totals rather than histograms or state
+_N_SUMMARY_FIELDS = [f.name for f in dataclasses.fields(Stat)].index("wait_histogram")
+
+FileStats = typing.Dict[str, typing.Dict[int, typing.Dict[int, Stat]]]
+
+
+@dataclass
+class ContentionStats:
+    # {lock_hash: Stat}, sorted by decreasing total wait time
+    lock_stats: typing.Dict[int, Stat] = field(default_factory=dict)
+    # {file: {line: {lock_hash: Stat}}}
+    file_stats: FileStats = field(default_factory=dict)
+    # {lock_hash: acquisitions that didn't block}, only counted in contention-only mode. They are not part of the
+    # stats, which only cover recorded acquisitions.
+    uncontended: typing.Dict[int, int] = field(default_factory=dict)
+    # {stack_hash: {lock_hash: Stat}} of whole call stacks, for flame graphs (see `flamegraph.py`). Unlike the call
+    # sites, these also count blocked hits and their block time.
+    stack_stats: typing.Dict[int, typing.Dict[int, Stat]] = field(default_factory=dict)
+
+
+def _is_ignored(file):
+    return not file.endswith(".py") or file.endswith(IGNORED_FILES)
+
+
+def _sample_weight(flag) -> int:
+    """Inverse of the sampling probability of the acquisition of a wait event."""
+    return 1 << ((flag >> PY_F_SAMPLE_SHIFT) & _SHIFT_MASK)
+
+
+def _overhead(acquire, overhead: int) -> int:
+    """`overhead`, or 0 for the times of an acquire event whose hooks `LockProfiler.calibrate` doesn't measure."""
+    return 0 if acquire.flag & PY_F_UNCALIBRATED else overhead
+
+
+def _add_weighted(stat: Stat, name: str, value, weight: int):
+    """Account for the unsampled acquisitions a sampled one of weight `weight` stands for."""
+    if weight > 1:
+        extra, var = stat._extra.get(name, (0, 0))
+        stat._extra[name] = (extra + (weight - 1) * value, var + weight * (weight - 1) * value * value)
+
+
+def _blame(stat: Stat, blame_time: int):
+    stat.blames += 1
+    stat.total_blame_time += blame_time
+
+
+def _stack_sites(stack) -> typing.List[typing.Tuple[str, int]]:
+    """Unique (file, line) call sites of a stack that stats are attributed to."""
+    sites = []
+    for frame in stack:
+        site = (frame[0], frame[2])
+        if not _is_ignored(site[0]) and site not in sites:
+            sites.append(site)
+    return sites
+
+
+def analyze(stats: LockStats, use_numpy: typing.Optional[bool] = None) -> ContentionStats:
+    """Compute per-lock and per-call-site contention stats.
+
+    The hook overhead recorded in `stats` is subtracted from every wait and hold time, except those of acquisitions
+    flagged with `PY_F_UNCALIBRATED`.
+
+    `stats.lock_list` may be any sequence of events, including an `EventArray` or a `TraceFile`, whose columns
+    are then used without copying. By default the NumPy implementation is used if NumPy is installed, except for
+    the `StreamedEvents` of a stream file: its columns would hold the whole run in memory, while the pure-Python
+    analysis reads the events one block per thread at a time.
+    """
+    if use_numpy is None:
+        use_numpy = np is not None and not isinstance(stats.lock_list, StreamedEvents)
+    if use_numpy:
+        return _analyze_numpy(stats)
+    return _analyze_python(stats)
+
+
+def _analyze_python(stats: LockStats) -> ContentionStats:
+    lock_stats: typing.DefaultDict[int, Stat] = defaultdict(Stat)
+    file_stats: FileStats = defaultdict(lambda: defaultdict(lambda: defaultdict(Stat)))
+    stack_stats = defaultdict(lambda: defaultdict(Stat))
+    all_stats: typing.List[Stat] = []
+    stack_sites = {}
+
+    def sites_of(stack_hash):
+        if stack_hash not in stack_sites:
+            stack_sites[stack_hash] = _stack_sites(stats.stack_hashes.get(stack_hash, ()))
+        return stack_sites[stack_hash]
+
+    # {tid: wait event}
+    current_wait = {}
+    # Wait events that were blocked by another thread
+    blocked_waits = set()
+    # {lock_hash: {tid: blocked wait event}} until the wait ends
+    pending_blocks = defaultdict(dict)
+    # {tid: {lock_hash: [(acquire event, stack hash, sampling weight), ...]}}
+    held = defaultdict(lambda: defaultdict(list))
+
+    def add_hit(stat: Stat, wait_duration, weight):
+        if not stat.hits:
+            all_stats.append(stat)
+        stat.hits += 1
+        _add_weighted(stat, "hits", 1, weight)
+        if not stat._depth:
+            stat.acquires += 1
+            _add_weighted(stat, "acquires", 1, weight)
+        stat._depth += 1
+        stat.total_wait_time += wait_duration
+        stat.max_wait_time = max(stat.max_wait_time, wait_duration)
+        stat.wait_histogram.record(wait_duration)
+        _add_weighted(stat, "total_wait_time", wait_duration, weight)
+
+    def add_block(stat: Stat, wait_duration, weight):
+        stat.total_block_time += wait_duration
+        stat.max_block_time = max(stat.max_block_time, wait_duration)
+        stat.block_histogram.record(wait_duration)
+        _add_weighted(stat, "total_block_time", wait_duration, weight)
+
+    def add_release(stat: Stat, hold_duration, weight):
+        stat._depth -= 1
+        if not stat._depth:
+            stat.total_hold_time += hold_duration
+            stat.max_hold_time = max(stat.max_hold_time, hold_duration)
+            stat.hold_histogram.record(hold_duration)
+            _add_weighted(stat, "total_hold_time", hold_duration, weight)
+
+    for e in stats.lock_list:
+        lock_stat = lock_stats[e.lock_hash]
+        kind = e.flag & PY_E_MASK
+
+        if kind == PY_E_WAIT:
+            previous = current_wait.get(e.tid)
+            if previous is not None:
+                # It gave up waiting
+                pending_blocks[previous.lock_hash].pop(e.tid, None)
+            # If the lock is already held by a different thread, or the recorder saw it was
+            if e.flag & PY_F_BLOCKED or (lock_stat._depth > 0 and lock_stat._tid != e.tid):
+                lock_stat.blocks += 1
+                _add_weighted(lock_stat, "blocks", 1, _sample_weight(e.flag))
+                blocked_waits.add(e)
+                pending_blocks[e.lock_hash][e.tid] = e
+            current_wait[e.tid] = e
+
+        elif kind == PY_E_ACQUIRE:
+            wait = current_wait.pop(e.tid, None)
+            if wait is None:
+                # The matching wait event was overwritten in flight recorder mode
+                continue
+            pending_blocks[wait.lock_hash].pop(e.tid, None)
+            wait_duration = max(e.timestamp - wait.timestamp - _overhead(e, stats.wait_overhead), 0)
+            weight = _sample_weight(wait.flag)
+
+            blocked = wait in blocked_waits
+            if blocked:
+                blocked_waits.remove(wait)
+                add_block(lock_stat, wait_duration, weight)
+
+            if not lock_stat.hits:
+                all_stats.append(lock_stat)
+            lock_stat.hits += 1
+            _add_weighted(lock_stat, "hits", 1, weight)
+            if not lock_stat._depth:
+                lock_stat.acquires += 1
+                _add_weighted(lock_stat, "acquires", 1, weight)
+            lock_stat._depth += 1
+            lock_stat._tid = e.tid
+            lock_stat.total_wait_time += wait_duration
+            lock_stat.max_wait_time = max(lock_stat.max_wait_time, wait_duration)
+            lock_stat.wait_histogram.record(wait_duration)
+            _add_weighted(lock_stat, "total_wait_time", wait_duration, weight)
+            held[e.tid][e.lock_hash].append((e, wait.stack_hash, weight))
+
+            for file, line in sites_of(wait.stack_hash):
+                site_stat = file_stats[file][line][e.lock_hash]
+                add_hit(site_stat, wait_duration, weight)
+                if blocked:
+                    site_stat.blocks += 1
+                    add_block(site_stat, wait_duration, weight)
+            stack_stat = stack_stats[wait.stack_hash][e.lock_hash]
+            add_hit(stack_stat, wait_duration, weight)
+            if blocked:
+                stack_stat.blocks += 1
+                add_block(stack_stat, wait_duration, weight)
+
+        elif kind == PY_E_RELEASE:
+            acquisitions = held[e.tid][e.lock_hash]
+            if not acquisitions and lock_stat._depth > 0:
+                # Released by another thread than the holder, which plain locks allow
+                acquisitions = held[lock_stat._tid][e.lock_hash]
+            if not acquisitions:
+                # The matching acquire event was overwritten in flight recorder mode
+                continue
+            acquire, stack_hash, weight = acquisitions.pop()
+            hold_duration = max(e.timestamp - acquire.timestamp - _overhead(acquire, stats.hold_overhead), 0)
+
+            # Note the lock may have been recursively acquired. Only compute the hold duration if it's released now
+            lock_stat._depth -= 1
+            if not lock_stat._depth:
+                lock_stat.total_hold_time += hold_duration
+                lock_stat.max_hold_time = max(lock_stat.max_hold_time, hold_duration)
+                lock_stat.hold_histogram.record(hold_duration)
+                _add_weighted(lock_stat, "total_hold_time", hold_duration, weight)
+                # Blame the critical section for the threads it blocked
+                for waiter, wait in pending_blocks[e.lock_hash].items():
+                    if waiter == acquire.tid:
+                        continue
+                    blame_time = e.timestamp - max(wait.timestamp, acquire.timestamp)
+                    _blame(lock_stat, blame_time)
+                    for file, line in sites_of(stack_hash):
+                        _blame(file_stats[file][line][e.lock_hash], blame_time)
+                    _blame(stack_stats[stack_hash][e.lock_hash], blame_time)
+
+            for file, line in sites_of(stack_hash):
+                add_release(file_stats[file][line][e.lock_hash], hold_duration, weight)
+            add_release(stack_stats[stack_hash][e.lock_hash], hold_duration, weight)
+
+    for stat in all_stats:
+        stat.finalize()
+
+    return ContentionStats(
+        dict(sorted(lock_stats.items(), key=lambda i: i[1].total_wait_time, reverse=True)),
+        {file: {line: dict(locks) for line, locks in lines.items()} for file, lines in file_stats.items()},
+        dict(stats.uncontended_counts),
+        {stack_hash: dict(locks) for stack_hash, locks in stack_stats.items()},
+    )
+
+
+def from_aggregates(lock_counters, stack_counters, stack_hashes, uncontended=None) -> ContentionStats:
+    """Build the stats from the counters of aggregate-only mode (see `LockProfiler.get_aggregates`).
+
+    The counters of each (lock, call stack) are combined into every call site of the stack. Unlike the analysis
+    of events, a re-entrant acquisition is always attributed to the call sites of the outermost one.
+    """
+    lock_stats = {lock_hash: _stat_from_counters(counters) for lock_hash, counters in lock_counters.items()}
+    file_stats: FileStats = {}
+    stack_stats = {}
+    stack_sites = {}
+    for (lock_hash, stack_hash), counters in stack_counters.items():
+        stack_stats.setdefault(stack_hash, {})[lock_hash] = _stat_from_counters(counters)
+        if stack_hash not in stack_sites:
+            stack_sites[stack_hash] = _stack_sites(stack_hashes.get(stack_hash, ()))
+        for file, line in stack_sites[stack_hash]:
+            locks = file_stats.setdefault(file, {}).setdefault(line, {})
+            if lock_hash in locks:
+                _merge_counters(locks[lock_hash], counters)
+            else:
+                locks[lock_hash] = _stat_from_counters(counters)
+
+    for lines in file_stats.values():
+        for locks in lines.values():
+            for stat in locks.values():
+                stat.finalize()
+
+    return ContentionStats(
+        dict(sorted(lock_stats.items(), key=lambda i: i[1].total_wait_time, reverse=True)),
+        file_stats,
+        dict(uncontended or {}),
+        stack_stats,
+    )
+
+
+def _stat_from_counters(counters) -> Stat:
+    stat = Stat(**{
+        name: Histogram(value) if name.endswith("_histogram") else value
+        for name, value in zip(AGGREGATE_FIELDS, counters)
+    })
+    stat.finalize()
+    return stat
+
+
+def _merge_counters(stat: Stat, counters):
+    for name, value in zip(AGGREGATE_FIELDS, counters):
+        if name.endswith("_histogram"):
+            getattr(stat, name).merge(Histogram(value))
+        elif name.startswith("max_"):
+            setattr(stat, name, max(getattr(stat, name), value))
+        else:
+            setattr(stat, name, getattr(stat, name) + value)
+
+
+def event_columns(events) -> typing.Dict[str, "np.ndarray"]:
+    """Return the event fields as int64 arrays, without copying for `EventArray`s and `TraceFile`s."""
+    from .trace_file import TraceFile
+
+    if hasattr(events, "as_numpy"):
+        arr = events.as_numpy()
+        return {name: arr[name] for name in EVENT_FIELDS}
+    if isinstance(events, TraceFile):
+        return {
+            name: np.frombuffer(getattr(events, name), dtype=np.uint8 if name == "flag" else np.int64)
+            for name in EVENT_FIELDS
+        }
+    n_fields = len(EVENT_FIELDS)
+    flat = np.fromiter(itertools.chain.from_iterable(events), dtype=np.int64, count=n_fields * len(events))
+    flat = flat.reshape(-1, n_fields)
+    return {name: flat[:, i] for i, name in enumerate(EVENT_FIELDS)}
+
+
+def _group_starts(keys):
+    """Start index of each run of equal keys in a sorted array."""
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.intp)
+
+
+def _stable_argsort(keys):
+    """`np.argsort(keys, kind="stable")`, in linear time for keys in [0, 2 ** 32), as NumPy radix sorts 16-bit keys."""
+    if not len(keys) or keys.min() < 0 or keys.max() >= 1 << 32:
+        return np.argsort(keys, kind="stable")
+    order = np.argsort((keys & 0xFFFF).astype(np.uint16), kind="stable")
+    if keys.max() >= 1 << 16:
+        order = order[np.argsort((keys[order] >> 16).astype(np.uint16), kind="stable")]
+    return order
+
+
+def _codes(values):
+    """`np.unique(values, return_inverse=True)`, faster for the values found here.
+
+    Values in a range not much larger than their number, such as codes combined with other codes, are looked up in
+    a table of the range, and other values below 2 ** 32 are radix sorted. Otherwise, the distinct values, usually
+    few, are found on a sample, then searched for.
+    """
+    if not len(values):
+        return values[:0], np.zeros(0, dtype=np.intp)
+    low, high = int(values.min()), int(values.max())
+    if high - low < 2 * len(values) + (1 << 16):
+        offsets = values - low if low else values
+        present = np.zeros(high - low + 1, dtype=bool)
+        present[offsets] = True
+        table = np.cumsum(present) - 1
+        return np.flatnonzero(present) + low, table[offsets]
+    if low >= 0 and high < 1 << 32:
+        order = _stable_argsort(values)
+        new_value = np.r_[True, np.diff(values[order]) != 0]
+        codes = np.empty(len(values), dtype=np.intp)
+        codes[order] = np.cumsum(new_value) - 1
+        return values[order[new_value]], codes
+    uniques = np.unique(values[::max(1, len(values) // 4096)])
+    codes = np.minimum(np.searchsorted(uniques, values), len(uniques) - 1)
+    missing = uniques[codes] != values
+    if np.any(missing):
+        uniques = np.union1d(uniques, values[missing])
+        codes = np.searchsorted(uniques, values)
+    return uniques, codes
+
+
+class _Reduction:
+    """Totals, maxima, sampling extras and histograms of per-hit values, reduced per key.
+
+    The hits of a call stack count towards the stats of each of its call sites, and a call stack is shared by many
+    hits, so they are reduced per stack once, and `fan_out` adds the result of each stack to each of its call sites.
+    """
+
+    def __init__(self, n_keys: int):
+        self.n_keys = n_keys
+        self.totals: typing.Dict[str, "np.ndarray"] = {}
+        self.maxima: typing.Dict[str, "np.ndarray"] = {}
+        # {name: (estimated total of the unsampled values, variance)}, see `_add_weighted`
+        self.extras: typing.Dict[str, typing.Tuple["np.ndarray", "np.ndarray"]] = {}
+        # {name: [(keys, buckets, counts), ...]}, where a (key, bucket) may repeat
+        self.histograms: typing.Dict[str, typing.List[typing.Tuple["np.ndarray", "np.ndarray", "np.ndarray"]]] = {}
+
+    def _zeros(self, dtype=np.int64):
+        return np.zeros(self.n_keys, dtype=dtype)
+
+    def add(self, name, keys, values=None, weight=None):
+        """Count the keys, or sum their `values`, and if `weight` is given, the extras of their sampled values."""
+        total = self.totals.setdefault(name, self._zeros())
+        if values is None:
+            total += np.bincount(keys, minlength=self.n_keys)
+            values = np.ones(len(keys))
+        else:
+            np.add.at(total, keys, values)
+        if weight is not None:
+            extra, var = self.extras.setdefault(name, (self._zeros(np.float64), self._zeros(np.float64)))
+            values = values.astype(np.float64)
+            np.add.at(extra, keys, (weight - 1) * values)
+            np.add.at(var, keys, weight * (weight - 1.0) * values * values)
+
+    def max(self, name, keys, values):
+        np.maximum.at(self.maxima.setdefault(name, self._zeros()), keys, values)
+
+    def histogram(self, name, keys, buckets):
+        size = int(buckets.max(initial=0)) + 1
+        values, codes = _codes(keys * size + buckets)
+        counts = np.bincount(codes, minlength=len(values))
+        # Sorted by key, which `fan_out` needs
+        self.histograms.setdefault(name, []).append((values // size, values % size, counts))
+
+    def fan_out(self, into: "_Reduction", sources, targets):
+        """Add the reduction of each of the `sources` keys to the `targets` key of `into`."""
+        for name, total in self.totals.items():
+            np.add.at(into.totals.setdefault(name, into._zeros()), targets, total[sources])
+        for name, maximum in self.maxima.items():
+            np.maximum.at(into.maxima.setdefault(name, into._zeros()), targets, maximum[sources])
+        for name, (extra, var) in self.extras.items():
+            into_extra, into_var = into.extras.setdefault(name, (into._zeros(np.float64), into._zeros(np.float64)))
+            np.add.at(into_extra, targets, extra[sources])
+            np.add.at(into_var, targets, var[sources])
+        for name, chunks in self.histograms.items():
+            for keys, buckets, counts in chunks:
+                # The buckets of each source, for each of its targets
+                first = np.searchsorted(keys, sources)
+                n_buckets = np.searchsorted(keys, sources, side="right") - first
+                row = np.repeat(np.arange(len(sources)), n_buckets)
+                index = np.arange(len(row)) - np.repeat(np.cumsum(n_buckets) - n_buckets - first, n_buckets)
+                into.histograms.setdefault(name, []).append((targets[row], buckets[index], counts[index]))
+
+    def stats(self) -> typing.List[Stat]:
+        """A Stat per key."""
+        totals, maxima = self.totals, self.maxima
+        zeros = self._zeros()
+        acquires = np.maximum(totals.get("acquires", zeros), 1)
+        averages = {
+            "avg_wait_time": totals.get("total_wait_time", zeros) // acquires,
+            "avg_hold_time": totals.get("total_hold_time", zeros) // acquires,
+            "avg_block_time": totals.get("total_block_time", zeros) // np.maximum(totals.get("blocks", zeros), 1),
+        }
+        columns = []
+        for f in dataclasses.fields(Stat):
+            if f.name.endswith("_histogram"):
+                columns.append(self._histograms(f.name))
+            elif not f.name.startswith("_"):
+                column = totals.get(f.name, maxima.get(f.name, averages.get(f.name, zeros)))
+                columns.append(column.tolist())
+        stats = list(map(Stat, *columns))
+        for name, (extra, var) in self.extras.items():
+            for stat, x, v in zip(stats, extra.tolist(), var.tolist()):
+                stat._extra[name] = (x, v)
+        return stats
+
+    def _histograms(self, name) -> typing.List[Histogram]:
+        chunks = self.histograms.get(name, [])
+        # The buckets of each key up to its largest one, laid out one key after the other
+        sizes = self._zeros()
+        for keys, buckets, _ in chunks:
+            np.maximum.at(sizes, keys, buckets + 1)
+        offsets = np.cumsum(sizes) - sizes
+        flat = np.zeros(int(sizes.sum()), dtype=np.int64)
+        for keys, buckets, counts in chunks:
+            np.add.at(flat, offsets[keys] + buckets, counts)
+        histograms = []
+        # Not through one list of all the counts, which the garbage collector would keep scanning
+        for o, end in zip(offsets.tolist(), np.cumsum(sizes).tolist()):
+            hist = Histogram()
+            hist.counts = flat[o:end].tolist()
+            histograms.append(hist)
+        return histograms
+
+
+def _pair_releases(acquires, acquire_tids, releases, release_tids) -> "np.ndarray":
+    """The release paired with each hit of a lock, -1 if none, given the event indices of both, in order.
+
+    Releases pop the latest unreleased hit of their thread, or if it has none, of the thread that acquired the
+    lock last, while it is held.
+    """
+    paired = np.full(len(acquires), -1)
+    held = defaultdict(list)
+    depth = 0
+    holder = None
+    acquires, acquire_tids = acquires.tolist(), acquire_tids.tolist()
+    releases, release_tids = releases.tolist(), release_tids.tolist()
+    i = 0
+    for release, tid in zip(releases, release_tids):
+        while i < len(acquires) and acquires[i] < release:
+            holder = acquire_tids[i]
+            held[holder].append(i)
+            depth += 1
+            i += 1
+        hits = held[tid]
+        if not hits and depth > 0:
+            hits = held[holder]
+        if hits:
+            paired[hits.pop()] = release
+            depth -= 1
+    return paired
+
+
+def _nesting(hit_lock, hit_acq, hit_end):
+    """Nesting depth of each hit in the other hits of its lock, and the hit it is directly nested in, -1 if none.
+
+    The hits are sorted by acquire, and those of a lock must be properly nested or disjoint. A hit is then nested in
+    the hits acquired before it and not released yet, the latest one a level up being its parent.
+    """
+    n_hits = len(hit_acq)
+    if not n_hits:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = _stable_argsort(hit_lock)
+    lock, acq = hit_lock[order], hit_acq[order]
+    scale = int(hit_end.max()) + 1
+    ends = np.sort(lock * scale + hit_end[order])
+    # Every hit has an end, so the ends of a lock start where its hits do: the hits acquired before a hit, less
+    # those released before it, are the position of the hit less the ends before it
+    depth = np.arange(n_hits) - np.searchsorted(ends, lock * scale + acq)
+
+    nested = np.flatnonzero(depth > 0)
+    # Mostly the parent is the hit acquired just before
+    parents = nested - 1
+    others = np.flatnonzero(depth[parents] != depth[nested] - 1)
+    if len(others):
+        # The levels of a lock are numbered in a row, so a level up is the previous number
+        _, level_ids = _codes(lock * (int(depth.max()) + 1) + depth)
+        by_level = _stable_argsort(level_ids)
+        keys = (level_ids * scale + acq)[by_level]
+        lookup = nested[others]
+        parents[others] = by_level[np.searchsorted(keys, (level_ids - 1)[lookup] * scale + acq[lookup]) - 1]
+    parent = np.full(n_hits, -1)
+    parent[order[nested]] = order[parents]
+    unsorted_depth = np.empty(n_hits, dtype=np.int64)
+    unsorted_depth[order] = depth
+    return unsorted_depth, parent
+
+
+def _chains(depth, parent, stack):
+    """Number the distinct sequences of stacks of the hits each hit is nested in, 0 being the empty one.
+
+    Returns the number of each hit's sequence, and per number, the number of the sequence without its last stack
+    and that stack.
+    """
+    chain = np.zeros(len(depth), dtype=np.int64)
+    chain_parent, chain_stack = [0], [-1]
+    n_stacks = int(stack.max(initial=0)) + 1
+    order = _stable_argsort(depth)
+    bounds = np.searchsorted(depth[order], np.arange(int(depth.max(initial=0)) + 2))
+    for start, end in zip(bounds[1:-1].tolist(), bounds[2:].tolist()):
+        nested = order[start:end]
+        keys, inverse = np.unique(chain[parent[nested]] * n_stacks + stack[parent[nested]], return_inverse=True)
+        chain[nested] = len(chain_parent) + inverse.reshape(-1)
+        chain_parent.extend((keys // n_stacks).tolist())
+        chain_stack.extend((keys % n_stacks).tolist())
+    return chain, chain_parent, chain_stack
+
+
+def _flatten(lists):
+    """Concatenate lists of ints into an array, with the start and length of each."""
+    lengths = np.array([len(values) for values in lists], dtype=np.int64)
+    flat = np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int64, count=int(lengths.sum()))
+    return flat, np.cumsum(lengths) - lengths, lengths
+
+
+def _expand(index, flat, starts, lengths):
+    """Pairs of a position in `index` and each value of the `index[position]`-th flattened list."""
+    n_values = lengths[index]
+    rows = np.repeat(np.arange(len(index)), n_values)
+    within = np.arange(len(rows)) - np.repeat(np.cumsum(n_values) - n_values, n_values)
+    return rows, flat[starts[index[rows]] + within]
+
+
+def _analyze_numpy(stats: LockStats) -> ContentionStats:
+    cols = event_columns(stats.lock_list)
+    ts, raw_flag, tid, lock, stack = (cols[name] for name in EVENT_FIELDS)
+    n = len(ts)
+    if n and np.any(ts[1:] < ts[:-1]):
+        order = np.argsort(ts, kind="stable")
+        ts, raw_flag, tid, lock, stack = (c[order] for c in (ts, raw_flag, tid, lock, stack))
+    flag = raw_flag & PY_E_MASK
+    # End index of intervals that never end
+    never = n
+    # Small codes of the threads and locks, to sort by
+    _, tid_codes = _codes(tid)
+    lock_values, lock_codes = _codes(lock)
+    n_locks = len(lock_values)
+
+    # Pair each acquire with the preceding wait of the same thread. Each such acquire is a hit.
+    wa = np.flatnonzero((flag == PY_E_WAIT) | (flag == PY_E_ACQUIRE))
+    wa = wa[_stable_argsort(tid_codes[wa])]
+    wa_tid = tid_codes[wa]
+    same_thread = wa_tid[1:] == wa_tid[:-1]
+    del wa_tid
+    is_acquire = flag[wa] == PY_E_ACQUIRE
+    paired = np.flatnonzero(is_acquire[1:] & ~is_acquire[:-1] & same_thread)
+    # The position in `wa` of the wait of each acquire
+    hit_pos = np.full(n, -1)
+    hit_pos[wa[paired + 1]] = paired
+    hit_acq = np.flatnonzero(hit_pos >= 0)
+    hit_wait_pos = hit_pos[hit_acq]
+    hit_wait = wa[hit_wait_pos]
+    n_hits = len(hit_acq)
+    hit_tid, hit_lock, hit_stack = tid_codes[hit_acq], lock_codes[hit_acq], stack[hit_wait]
+    hit_weight = _sample_weight(raw_flag[hit_wait].astype(np.int64))
+    # The overhead is only subtracted from the times of the hooks it was measured on
+    calibrated = (raw_flag[hit_acq] & PY_F_UNCALIBRATED) == 0
+    wait_time = np.maximum(ts[hit_acq] - ts[hit_wait] - stats.wait_overhead * calibrated, 0)
+
+    # Pair each release with the latest unreleased hit of the same thread and lock
+    rel = np.flatnonzero(flag == PY_E_RELEASE)
+    # Now the hit of each acquire
+    hit_pos[hit_acq] = np.arange(n_hits)
+    ev = np.flatnonzero((hit_pos >= 0) | (flag == PY_E_RELEASE))
+    group_key = tid_codes[ev] * n_locks + lock_codes[ev]
+    order = _stable_argsort(group_key)
+    ev, group_key = ev[order], group_key[order]
+    hit_pos = hit_pos[ev]
+    hit_rel = np.full(n_hits, -1)
+    # Most hits are released before the next event of their group, pair those first
+    adjacent = np.flatnonzero((hit_pos[:-1] >= 0) & (hit_pos[1:] < 0) & (group_key[:-1] == group_key[1:]))
+    hit_rel[hit_pos[adjacent]] = ev[adjacent + 1]
+    rest = np.ones(len(ev), dtype=bool)
+    rest[adjacent] = rest[adjacent + 1] = False
+    ev, hit_pos, group_key = ev[rest], hit_pos[rest], group_key[rest]
+    delta = np.where(hit_pos >= 0, 1, -1)
+    new_group = np.r_[True, group_key[1:] != group_key[:-1]]
+
+    def group_depth(delta, new_group):
+        total = np.cumsum(delta)
+        base = (total - delta)[new_group]
+        return total - base[np.cumsum(new_group) - 1]
+
+    if len(ev):
+        # Releases without an acquire (overwritten in flight recorder mode) set a new minimum depth. Drop them.
+        depth = group_depth(delta, new_group)
+        group = np.cumsum(new_group) - 1
+        offset = group * (2 * len(ev) + 2)
+        running_min = np.minimum.accumulate(depth - offset) + offset
+        prev_min = np.minimum(np.r_[0, running_min[:-1]], 0)
+        prev_min[new_group] = 0
+        keep = ~((delta < 0) & (depth < prev_min))
+        group = group[keep]
+        ev, delta, hit_pos = ev[keep], delta[keep], hit_pos[keep]
+        new_group = np.r_[True, group[1:] != group[:-1]] if len(group) else np.zeros(0, dtype=bool)
+
+        # An acquire and its release sit at the same nesting level
+        depth = group_depth(delta, new_group)
+        level = np.where(delta > 0, depth, depth + 1)
+        order = _stable_argsort(group * (int(level.max(initial=0)) + 1) + level)
+        ev, delta, hit_pos, level, group = ev[order], delta[order], hit_pos[order], level[order], group[order]
+        pairs = np.flatnonzero(
+            (delta[:-1] > 0) & (delta[1:] < 0) & (group[:-1] == group[1:]) & (level[:-1] == level[1:])
+        )
+        hit_rel[hit_pos[pairs]] = ev[pairs + 1]
+
+        # A release by a thread holding none of the lock's hits releases the holder's, as plain locks allow. Pairing
+        # by thread left such releases out, and paired the later releases of the holder with the wrong hits. It
+        # only happens if one of them is made while another thread holds the lock, in which case the releases of
+        # that lock are paired again in order, the same way as `_analyze_python`.
+        paired = np.zeros(n, dtype=bool)
+        paired[hit_rel[hit_rel >= 0]] = True
+        other = rel[~paired[rel]]
+        if len(other) and n_hits:
+            base = lock_codes[other] * (n + 1)
+            acquired = np.sort(hit_lock * (n + 1) + hit_acq)
+            released_at = np.sort((hit_lock * (n + 1) + hit_rel)[hit_rel >= 0])
+            held = (
+                np.searchsorted(acquired, base + other) - np.searchsorted(acquired, base)
+                - (np.searchsorted(released_at, base + other) - np.searchsorted(released_at, base))
+            )
+            for code in np.unique(lock_codes[other[held > 0]]).tolist():
+                hits = np.flatnonzero(hit_lock == code)
+                releases = rel[lock_codes[rel] == code]
+                hit_rel[hits] = _pair_releases(hit_acq[hits], hit_tid[hits], releases, tid_codes[releases])
+    del ev, delta, hit_pos, group_key
+
+    released = hit_rel >= 0
+    hit_end = np.where(released, hit_rel, never)
+    hold_time = np.where(released, np.maximum(ts[hit_rel] - ts[hit_acq] - stats.hold_overhead * calibrated, 0), 0)
+
+    # Nested acquisitions of a lock don't count as acquires, and their hold time is part of the outermost one
+    depth, parent = _nesting(hit_lock, hit_acq, hit_end)
+    lock_outer = depth == 0
+
+    # A wait is blocked if another thread holds the lock at that time
+    wait_pos = np.flatnonzero(~is_acquire)
+    # By lock, so that they are looked up in order
+    wait_pos = wait_pos[_stable_argsort(lock_codes[wa[wait_pos]])]
+    waits = wa[wait_pos]
+    outer_idx = np.flatnonzero(lock_outer)
+    outer_idx = outer_idx[_stable_argsort(hit_lock[outer_idx])]
+    outer_keys = hit_lock[outer_idx] * (n + 1) + hit_acq[outer_idx]
+    pos = np.searchsorted(outer_keys, lock_codes[waits] * (n + 1) + waits, side="right") - 1
+    holder = outer_idx[np.maximum(pos, 0)] if len(outer_idx) else np.zeros(len(waits), dtype=np.intp)
+    blocked_waits = np.zeros(len(waits), dtype=bool)
+    if len(outer_idx):
+        blocked_waits = (
+            (pos >= 0)
+            & (hit_lock[holder] == lock_codes[waits])
+            & (hit_end[holder] > waits)
+            & (hit_tid[holder] != tid_codes[waits])
+        )
+    # Or if the recorder saw it was, when the holder's acquisition isn't recorded
+    blocked_waits |= (raw_flag[waits] & PY_F_BLOCKED) != 0
+    block_pos = wait_pos[blocked_waits]
+    block_idx = wa[block_pos]
+    blocked_wa = np.zeros(len(wa), dtype=bool)
+    blocked_wa[block_pos] = True
+    hit_blocked = blocked_wa[hit_wait_pos]
+    # A wait ends at the next wait or acquire of its thread
+    block_end = np.r_[np.where(same_thread, wa[1:], never), never][block_pos]
+
+    # Blame: pair each blocked wait with the critical sections of other threads released while it lasted. The
+    # outermost hits of a lock don't overlap, so they are released in the order they are acquired.
+    holders = np.flatnonzero(lock_outer & released)
+    holders = holders[_stable_argsort(hit_lock[holders])]
+    holder_keys = hit_lock[holders] * (n + 1) + hit_rel[holders]
+    block_codes = lock_codes[block_idx] * (n + 1)
+    first = np.searchsorted(holder_keys, block_codes + block_idx, side="right")
+    last = np.searchsorted(holder_keys, block_codes + block_end, side="left")
+    n_pairs = np.maximum(last - first, 0)
+    pair_block = np.repeat(np.arange(len(block_idx)), n_pairs)
+    pair_holder = holders[np.arange(len(pair_block)) - np.repeat(np.cumsum(n_pairs) - n_pairs - first, n_pairs)]
+    other = hit_tid[pair_holder] != tid_codes[block_idx[pair_block]]
+    pair_block, pair_holder = pair_block[other], pair_holder[other]
+    blame_time = ts[hit_rel[pair_holder]] - np.maximum(ts[block_idx[pair_block]], ts[hit_acq[pair_holder]])
+
+    # The stats of a call site add up those of the call stacks it is in, which are far fewer than the hits. The
+    # hits are reduced per (stack, lock) first, then the stacks are fanned out to their call sites.
+    stack_values, hit_stack = _codes(hit_stack)
+    n_stacks = len(stack_values)
+    stack_lock_values, hit_stack_lock = _codes(hit_stack * n_locks + hit_lock)
+    stack_lock_stack, stack_lock_lock = stack_lock_values // n_locks, stack_lock_values % n_locks
+    weight = hit_weight if np.any(hit_weight > 1) else None
+
+    def weights(mask):
+        return None if weight is None else weight[mask]
+
+    wait_buckets = bucket_indices(wait_time)
+    per_stack = _Reduction(len(stack_lock_values))
+    per_stack.add("hits", hit_stack_lock, weight=weight)
+    per_stack.add("total_wait_time", hit_stack_lock, wait_time, weight)
+    per_stack.max("max_wait_time", hit_stack_lock, wait_time)
+    per_stack.histogram("wait_histogram", hit_stack_lock, wait_buckets)
+    blocked = hit_stack_lock[hit_blocked]
+    per_stack.add("blocks", blocked)
+    per_stack.add("total_block_time", blocked, wait_time[hit_blocked], weights(hit_blocked))
+    per_stack.max("max_block_time", blocked, wait_time[hit_blocked])
+    per_stack.histogram("block_histogram", blocked, wait_buckets[hit_blocked])
+    per_stack.add("blames", hit_stack_lock[pair_holder])
+    per_stack.add("total_blame_time", hit_stack_lock[pair_holder], blame_time)
+
+    per_lock = _Reduction(n_locks)
+    per_stack.fan_out(per_lock, np.arange(len(stack_lock_values)), stack_lock_lock)
+    # Unlike call sites and stacks, locks count blocked waits, acquired or not
+    del per_lock.totals["blocks"]
+    block_weight = _sample_weight(raw_flag[block_idx].astype(np.int64))
+    per_lock.add("blocks", lock_codes[block_idx], weight=block_weight if np.any(block_weight > 1) else None)
+
+    sites: typing.Dict[typing.Tuple[str, int], int] = {}
+    stack_site_ids = [
+        [sites.setdefault(site, len(sites)) for site in _stack_sites(stats.stack_hashes.get(stack_hash, ()))]
+        for stack_hash in stack_values.tolist()
+    ]
+    rows, site_ids = _expand(stack_lock_stack, *_flatten(stack_site_ids))
+    site_lock_values, site_lock = _codes(site_ids * n_locks + stack_lock_lock[rows])
+    per_site = _Reduction(len(site_lock_values))
+    per_stack.fan_out(per_site, rows, site_lock)
+
+    # A hit is an acquire of its lock, of its stack and of the call sites of its stack, unless one of the hits of its
+    # lock it is nested in is an acquire of them already: unless its stack, or the call site, is in one of theirs
+    hold_buckets = bucket_indices(hold_time)
+
+    def add_acquires(reduction, keys, acquired):
+        reduction.add("acquires", keys[acquired], weight=weights(acquired))
+        held = acquired & released
+        keys, held_time = keys[held], hold_time[held]
+        reduction.add("total_hold_time", keys, held_time, weights(held))
+        reduction.max("max_hold_time", keys, held_time)
+        reduction.histogram("hold_histogram", keys, hold_buckets[held])
+
+    add_acquires(per_lock, hit_lock, lock_outer)
+
+    # Hits are acquires of the same call sites in few ways, so they are reduced per set of call sites and lock
+    # first. The stacks the nested hits are in are numbered, to find their sites and stacks that are acquired.
+    stack_site_sets = [frozenset(site_ids) for site_ids in stack_site_ids]
+    site_set_ids = {site_set: i for i, site_set in enumerate(dict.fromkeys(stack_site_sets))}
+    hit_site_set = np.array([site_set_ids[site_set] for site_set in stack_site_sets], dtype=np.int64)[hit_stack]
+    stack_acquired = np.ones(n_hits, dtype=bool)
+    nested = np.flatnonzero(~lock_outer)
+    chain, chain_parent, chain_stack = _chains(depth, parent, hit_stack)
+    nesting_values, nested_nesting = _codes(chain[nested] * n_stacks + hit_stack[nested])
+    chain_sites, chain_stacks = [frozenset()], [frozenset()]
+    for enclosing, stack_code in zip(chain_parent[1:], chain_stack[1:]):
+        chain_sites.append(chain_sites[enclosing].union(stack_site_ids[stack_code]))
+        chain_stacks.append(chain_stacks[enclosing] | {stack_code})
+    nesting_site_set = []
+    nesting_stack_acquired = []
+    for c, stack_code in zip((nesting_values // n_stacks).tolist(), (nesting_values % n_stacks).tolist()):
+        site_set = stack_site_sets[stack_code] - chain_sites[c]
+        nesting_site_set.append(site_set_ids.setdefault(site_set, len(site_set_ids)))
+        nesting_stack_acquired.append(stack_code not in chain_stacks[c])
+    del chain_sites, chain_stacks
+    hit_site_set[nested] = np.array(nesting_site_set, dtype=np.int64)[nested_nesting]
+    stack_acquired[nested] = np.array(nesting_stack_acquired, dtype=bool)[nested_nesting]
+
+    add_acquires(per_stack, hit_stack_lock, stack_acquired)
+    set_lock_values, hit_set_lock = _codes(hit_site_set * n_locks + hit_lock)
+    per_site_set = _Reduction(len(set_lock_values))
+    add_acquires(per_site_set, hit_set_lock, np.ones(n_hits, dtype=bool))
+    set_lock_lock = set_lock_values % n_locks
+    rows, site_ids = _expand(set_lock_values // n_locks, *_flatten(site_set_ids))
+    per_site_set.fan_out(per_site, rows, np.searchsorted(site_lock_values, site_ids * n_locks + set_lock_lock[rows]))
+    del site_set_ids
+
+    lock_list = lock_values.tolist()
+    lock_stats = dict(zip(lock_list, per_lock.stats()))
+    site_list = list(sites)
+    file_stats: FileStats = {}
+    for key, stat in zip(site_lock_values.tolist(), per_site.stats()):
+        file, line = site_list[key // n_locks]
+        file_stats.setdefault(file, {}).setdefault(line, {})[lock_list[key % n_locks]] = stat
+    stack_list = stack_values.tolist()
+    stack_stats: typing.Dict[int, typing.Dict[int, Stat]] = {}
+    for stack_code, code, stat in zip(stack_lock_stack.tolist(), stack_lock_lock.tolist(), per_stack.stats()):
+        stack_stats.setdefault(stack_list[stack_code], {})[lock_list[code]] = stat
+
+    return ContentionStats(
+        dict(sorted(lock_stats.items(), key=lambda i: i[1].total_wait_time, reverse=True)),
+        file_stats,
+        dict(stats.uncontended_counts),
+        stack_stats,
+    )
@@ -0,0 +1,150 @@
+/* Interning of Python call stacks into stable integer IDs.
+ *
+ * Every unique call path is stored once as a chain of trie nodes. Each node is
+ * keyed by (parent node, code object, instruction offset), starting from the
+ * innermost frame, so the ID of the outermost node uniquely identifies the
+ * whole stack. Looking up a known stack only walks the frames and probes a hash
+ * table; no Python objects are allocated.
+ *
+ * All functions must be called with the GIL held.
+ */
+#ifndef LOCK_PROFILER_CALL_SITES_H
+#define LOCK_PROFILER_CALL_SITES_H
+
+#include "Python.h"
+#include "frameobject.h"
+
+#if PY_VERSION_HEX >= 0x030b00a6 && PY_VERSION_HEX < 0x030d0000
+  #ifndef Py_BUILD_CORE
+    #define Py_BUILD_CORE 1
+  #endif
+  #include "internal/pycore_frame.h"
+#endif
+
+#include <cstdint>
+#include <unordered_map>
+#include <vector>
+
+/* ID of the empty stack. Real nodes start at 1. */
+#define CALL_SITE_ROOT 0
+
+struct CallSiteNode {
+    int64_t parent;
+    PyCodeObject* code;
+    /* Byte offset of the last executed instruction, as used by PyCode_Addr2Line */
+    int lasti;
+    /* Whether a complete stack ends at this node */
+    bool is_stack;
+};
+
+struct CallSiteKey {
+    int64_t parent;
+    PyCodeObject* code;
+    int lasti;
+
+    bool operator==(const CallSiteKey& other) const {
+        return parent == other.parent && code == other.code && lasti == other.lasti;
+    }
+};
+
+struct CallSiteKeyHash {
+    size_t operator()(const CallSiteKey& key) const {
+        uint64_t h = (uint64_t)key.parent * 0x9E3779B97F4A7C15ULL;
+        h ^= (uint64_t)(uintptr_t)key.code + 0x9E3779B97F4A7C15ULL + (h << 6) + (h >> 2);
+        h ^= (uint64_t)(uint32_t)key.lasti + 0x9E3779B97F4A7C15ULL + (h << 6) + (h >> 2);
+        return (size_t)h;
+    }
+};
+
+/* Node storage; index 0 is a placeholder for the root */
+static std::vector<CallSiteNode> _call_site_nodes(1, CallSiteNode{CALL_SITE_ROOT, NULL, -1, false});
+static std::unordered_map<CallSiteKey, int64_t, CallSiteKeyHash> _call_site_index;
+/* IDs of all complete stacks, in order of first appearance */
+static std::vector<int64_t> _call_site_stacks;
+
+static inline int64_t
+call_site_intern(int64_t parent, PyCodeObject* code, int lasti)
+{
+    CallSiteKey key = {parent, code, lasti};
+    auto it = _call_site_index.find(key);
+    if (it != _call_site_index.end()) {
+        return it->second;
+    }
+
+    /* Keep the code object alive so its address can't be reused by another one */
+    Py_INCREF(code);
+    int64_t id = (int64_t)_call_site_nodes.size();
+    _call_site_nodes.push_back(CallSiteNode{parent, code, lasti, false});
+    _call_site_index.emplace(key, id);
+    return id;
+}
+
+/* Intern the stack of the currently executing Python frame.
+ * Only code objects and instruction offsets are stored; line numbers are
+ * resolved later from `_call_site_nodes`.
+ */
+static inline int64_t
+call_site_intern_current_stack()
+{
+    int64_t id = CALL_SITE_ROOT;
+
+#if PY_VERSION_HEX < 0x030b0000
+    PyFrameObject* frame = PyEval_GetFrame();
+    while (frame != NULL) {
+  #if PY_VERSION_HEX >= 0x030a0000
+        /* f_lasti counts code units starting with 3.10 */
+        int lasti = frame->f_lasti * (int)sizeof(_Py_CODEUNIT);
+  #else
+        int lasti = frame->f_lasti;
+  #endif
+        id = call_site_intern(id, frame->f_code, lasti);
+        frame = frame->f_back;
+    }
+#elif PY_VERSION_HEX < 0x030d0000
+    /* Walk the interpreter frames directly so frame objects are never materialized */
+    _PyInterpreterFrame* frame = PyThreadState_Get()->cframe->current_frame;
+    while (frame != NULL) {
+  #if PY_VERSION_HEX >= 0x030c0000
+        if (frame->owner == FRAME_OWNED_BY_CSTACK) {
+            frame = frame->previous;
+            continue;
+        }
+  #endif
+        if (!_PyFrame_IsIncomplete(frame)) {
+            int lasti = _PyInterpreterFrame_LASTI(frame) * (int)sizeof(_Py_CODEUNIT);
+            id = call_site_intern(id, frame->f_code, lasti);
+        }
+        frame = frame->previous;
+    }
+#else
+    PyFrameObject* frame = PyEval_GetFrame();
+    Py_XINCREF(frame);
+    while (frame != NULL) {
+        PyCodeObject* code = PyFrame_GetCode(frame);
+        id = call_site_intern(id, code, PyFrame_GetLasti(frame));
+        Py_DECREF(code);
+        PyFrameObject* back = PyFrame_GetBack(frame);
+        Py_DECREF(frame);
+        frame = back;
+    }
+#endif
+    if (!_call_site_nodes[id].is_stack) {
+        _call_site_nodes[id].is_stack = true;
+        _call_site_stacks.push_back(id);
+    }
+    return id;
+}
+
+static inline void
+call_site_clear()
+{
+    for (size_t i = 1; i < _call_site_nodes.size(); i++) {
+        Py_DECREF(_call_site_nodes[i].code);
+    }
+    _call_site_nodes.resize(1);
+    _call_site_nodes[CALL_SITE_ROOT].is_stack = false;
+    _call_site_index.clear();
+    _call_site_stacks.clear();
+}
+
+#endif
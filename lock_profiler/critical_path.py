@@ -0,0 +1,270 @@
+"""
+Critical path of a run through the lock handoffs between threads.
+
+A blocked acquire can't happen before the release that freed the lock, so each
+one adds a happens-before edge from the releasing thread to the acquiring one.
+The critical path through an interval is found by walking back from its end:
+along the current thread, until its latest blocked acquire, then over the edge
+to the thread and time of the release that unblocked it, and so on until the
+start of the interval. Shortening anything off the path doesn't make the
+interval shorter.
+
+The path is reported per lock and per (file, line, lock) call site: how long
+it runs inside critical sections holding the lock, and how long it waits for
+the lock to be handed over from a release to the acquire it unblocked. Those
+are the locks and critical sections whose speedup would shorten wall time.
+
+Intervals can be marked with `LockProfiler.timestamp()` while recording.
+Edges whose events weren't recorded (sampling, contention-only mode, a full
+flight recorder) are missed: the path then stays on the waiting thread.
+"""
+import array
+import bisect
+import itertools
+import typing
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from ._lock_profiler import LockStats, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_E_MASK, PY_F_BLOCKED
+from .analysis import _stack_sites
+
+
+class Segment(typing.NamedTuple):
+    """Stretch of the path running on one thread."""
+    tid: int
+    start: int
+    end: int
+
+
+class _Edge(typing.NamedTuple):
+    """Release of a lock by one thread that unblocked its acquire by another."""
+    acquire_index: int
+    acquire_time: int
+    lock_hash: int
+    stack_hash: int
+    release_tid: int
+    release_index: int
+    release_time: int
+
+
+class _Hold(typing.NamedTuple):
+    """Outermost acquisition of a lock, until its release."""
+    start: int
+    end: int
+    lock_hash: int
+    stack_hash: int
+
+
+@dataclass
+class PathStat:
+    # Time of the path spent in critical sections holding the lock
+    hold_time: int = 0
+    # Time of the path spent between a release and the blocked acquire it unblocked
+    handoff_time: int = 0
+    # Number of handoffs on the path
+    handoffs: int = 0
+
+    @property
+    def total_time(self) -> int:
+        return self.hold_time + self.handoff_time
+
+
+FileStats = typing.Dict[str, typing.Dict[int, typing.Dict[int, PathStat]]]
+
+
+@dataclass
+class CriticalPath:
+    # Summed length of the intervals
+    length: int = 0
+    # Stretches of the path in time order, each interval after the other
+    segments: typing.List[Segment] = field(default_factory=list)
+    # {lock_hash: PathStat}, sorted by decreasing total time
+    lock_stats: typing.Dict[int, PathStat] = field(default_factory=dict)
+    # {file: {line: {lock_hash: PathStat}}}. Hold time goes to the call sites of the holder's acquisition, handoff
+    # time to the call sites of the acquire it unblocked.
+    file_stats: FileStats = field(default_factory=dict)
+
+    def share(self, lock_hash: int) -> float:
+        """Fraction of the path spent holding or waiting for the handoff of a lock."""
+        stat = self.lock_stats.get(lock_hash)
+        return stat.total_time / self.length if stat is not None and self.length else 0.0
+
+
+class _Graph:
+    """Handoff edges and critical sections of every thread, from one pass over the events."""
+
+    def __init__(self, stats: LockStats):
+        # Columns of the events, as arrays of int64 rather than lists of int objects
+        self.timestamps = array.array("q")
+        self.tids = array.array("q")
+        # {tid: [_Edge]}, by acquire index
+        self.edges: typing.DefaultDict[int, typing.List[_Edge]] = defaultdict(list)
+        # {tid: [_Hold]}, by start
+        self.holds: typing.DefaultDict[int, typing.List[_Hold]] = defaultdict(list)
+
+        # {tid: (wait event, index, blocked)}
+        current_wait = {}
+        # {lock_hash: (holder tid, depth)}
+        holder = {}
+        # {(tid, lock_hash): [(acquire time, stack hash), ...]}
+        held = defaultdict(list)
+        # {lock_hash: (tid, index, time) of the release that freed it last}
+        last_release = {}
+        for i, e in enumerate(stats.lock_list):
+            self.timestamps.append(e.timestamp)
+            self.tids.append(e.tid)
+            kind = e.flag & PY_E_MASK
+            if kind == PY_E_WAIT:
+                owner, depth = holder.get(e.lock_hash, (e.tid, 0))
+                current_wait[e.tid] = (e, i, bool(e.flag & PY_F_BLOCKED) or (depth > 0 and owner != e.tid))
+
+            elif kind == PY_E_ACQUIRE:
+                if e.tid not in current_wait:
+                    # The matching wait event was overwritten in flight recorder mode
+                    continue
+                wait, wait_index, blocked = current_wait.pop(e.tid)
+                release = last_release.get(e.lock_hash)
+                if blocked and release is not None and release[0] != e.tid and release[1] > wait_index:
+                    self.edges[e.tid].append(_Edge(i, e.timestamp, e.lock_hash, wait.stack_hash, *release))
+                depth = holder.get(e.lock_hash, (e.tid, 0))[1]
+                holder[e.lock_hash] = (e.tid, depth + 1)
+                held[e.tid, e.lock_hash].append((e.timestamp, wait.stack_hash))
+
+            elif kind == PY_E_RELEASE:
+                owner, depth = holder.get(e.lock_hash, (e.tid, 1))
+                # Plain locks can be released by another thread than the holder, whose critical section it ends
+                hold_tid = e.tid if held[e.tid, e.lock_hash] else owner
+                acquisitions = held[hold_tid, e.lock_hash]
+                if not acquisitions:
+                    # The matching acquire event was overwritten in flight recorder mode
+                    continue
+                start, stack_hash = acquisitions.pop()
+                if depth > 1:
+                    holder[e.lock_hash] = (owner, depth - 1)
+                    continue
+                holder.pop(e.lock_hash, None)
+                # The handoff starts on the releasing thread
+                last_release[e.lock_hash] = (e.tid, i, e.timestamp)
+                self.holds[hold_tid].append(_Hold(start, e.timestamp, e.lock_hash, stack_hash))
+
+        # Never released
+        end = self.timestamps[-1] if self.timestamps else 0
+        for (tid, lock_hash), acquisitions in held.items():
+            if acquisitions:
+                start, stack_hash = acquisitions[0]
+                self.holds[tid].append(_Hold(start, end, lock_hash, stack_hash))
+        for holds in self.holds.values():
+            holds.sort()
+        self.edge_indices = {
+            tid: array.array("q", (edge.acquire_index for edge in edges)) for tid, edges in self.edges.items()
+        }
+        # {tid: start of each hold}, and {tid: latest end of the holds up to each one}, to bisect the holds that
+        # overlap a time range: those starting before its end, from the first one ending after its start on
+        self.hold_starts = {tid: array.array("q", (hold.start for hold in holds)) for tid, holds in self.holds.items()}
+        self.hold_ends = {
+            tid: array.array("q", itertools.accumulate((hold.end for hold in holds), max))
+            for tid, holds in self.holds.items()
+        }
+
+    def walk(
+        self, start: int, end: int, tid: typing.Optional[int],
+    ) -> typing.Tuple[typing.List[Segment], typing.List[_Edge]]:
+        """Segments of the critical path ending at `end` on thread `tid`, and the edges between them."""
+        # Events up to the end of the interval
+        index = bisect.bisect_right(self.timestamps, end)
+        if tid is None:
+            if not index or self.timestamps[index - 1] < start:
+                return [], []
+            # The thread that finishes last
+            tid = self.tids[index - 1]
+        segments, edges = [], []
+        while True:
+            k = bisect.bisect_left(self.edge_indices.get(tid, ()), index) - 1
+            edge = self.edges[tid][k] if k >= 0 else None
+            if edge is None or edge.acquire_time <= start:
+                segments.append(Segment(tid, start, end))
+                break
+            segments.append(Segment(tid, edge.acquire_time, end))
+            edges.append(edge)
+            if edge.release_time <= start:
+                break
+            tid, index, end = edge.release_tid, edge.release_index, edge.release_time
+        segments.reverse()
+        edges.reverse()
+        return segments, edges
+
+
+def critical_path(
+    stats: LockStats, start: typing.Optional[int] = None, end: typing.Optional[int] = None,
+    tid: typing.Optional[int] = None,
+) -> CriticalPath:
+    """The critical path from `start` to `end`, by default the whole trace.
+
+    It ends on thread `tid`, by default the thread with the last event before `end`. Times are event timestamps.
+    """
+    return critical_paths(stats, [(start, end, tid)])
+
+
+def critical_paths(
+    stats: LockStats,
+    intervals: typing.Iterable[typing.Union[typing.Tuple[int, int], typing.Tuple[int, int, typing.Optional[int]]]],
+) -> CriticalPath:
+    """The critical paths through several `(start, end)` or `(start, end, tid)` intervals, summed up.
+
+    `None` bounds are the start and end of the trace, see `critical_path`.
+    """
+    graph = _Graph(stats)
+    first = graph.timestamps[0] if graph.timestamps else 0
+    last = graph.timestamps[-1] if graph.timestamps else 0
+    lock_stats: typing.DefaultDict[int, PathStat] = defaultdict(PathStat)
+    file_stats: FileStats = defaultdict(lambda: defaultdict(lambda: defaultdict(PathStat)))
+    stack_sites = {}
+
+    def sites_of(stack_hash):
+        if stack_hash not in stack_sites:
+            stack_sites[stack_hash] = _stack_sites(stats.stack_hashes.get(stack_hash, ()))
+        return stack_sites[stack_hash]
+
+    path = CriticalPath()
+    for interval in intervals:
+        start, end, tid = (*interval, None)[:3]
+        start = first if start is None else start
+        end = last if end is None else end
+        if end <= start:
+            continue
+        path.length += end - start
+        segments, edges = graph.walk(start, end, tid)
+        path.segments.extend(segments)
+        for edge in edges:
+            handoff_time = edge.acquire_time - max(edge.release_time, start)
+            for stat in (lock_stats[edge.lock_hash], *(
+                file_stats[file][line][edge.lock_hash] for file, line in sites_of(edge.stack_hash)
+            )):
+                stat.handoff_time += handoff_time
+                stat.handoffs += 1
+
+        # Charge the critical sections running on the path. The segments of a thread don't overlap.
+        thread_segments = defaultdict(list)
+        for segment in segments:
+            thread_segments[segment.tid].append(segment)
+        for tid, segments in thread_segments.items():
+            if tid not in graph.holds:
+                continue
+            ends = [segment.end for segment in segments]
+            first = bisect.bisect_right(graph.hold_ends[tid], segments[0].start)
+            last = bisect.bisect_left(graph.hold_starts[tid], segments[-1].end)
+            for hold in graph.holds[tid][first:last]:
+                hold_time = 0
+                for segment in segments[bisect.bisect_right(ends, hold.start):]:
+                    if segment.start >= hold.end:
+                        break
+                    hold_time += min(segment.end, hold.end) - max(segment.start, hold.start)
+                if not hold_time:
+                    continue
+                lock_stats[hold.lock_hash].hold_time += hold_time
+                for file, line in sites_of(hold.stack_hash):
+                    file_stats[file][line][hold.lock_hash].hold_time += hold_time
+
+    path.lock_stats = dict(sorted(lock_stats.items(), key=lambda i: i[1].total_time, reverse=True))
+    path.file_stats = {file: {line: dict(locks) for line, locks in lines.items()} for file, lines in file_stats.items()}
+    return path
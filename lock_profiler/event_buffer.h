@@ -0,0 +1,514 @@
+/* Per-thread append-only event storage.
+ *
+ * Each recording thread owns a ThreadBuffer, registered on its first event.
+ * Events are appended to fixed-size chunks, so an append never moves existing
+ * events. Only the owning thread writes to a buffer; the chunk list is guarded
+ * by a per-buffer mutex that is taken when a new chunk is started and when the
+ * events are collected, never on the per-event path.
+ *
+ * The total number of chunks can be bounded, turning the buffers into a flight
+ * recorder: once the limit is reached, the oldest chunk of any thread is
+ * recycled for new events. Since every recording thread needs a chunk to write
+ * to, the limit is effectively at least one chunk per recording thread.
+ *
+ * Alternatively, the events can be streamed to a file: full chunks are queued
+ * for a background writer thread, which appends them to the file and returns
+ * them for reuse. Recording threads only ever take the queue's mutex.
+ *
+ * Readers can also follow the events as they are recorded with an EventCursor,
+ * which remembers how many events of each thread they have read: each read
+ * only copies the events recorded since the previous one. Events dropped from
+ * memory before they were read (recycled or streamed) are counted as lost.
+ */
+#ifndef LOCK_PROFILER_EVENT_BUFFER_H
+#define LOCK_PROFILER_EVENT_BUFFER_H
+
+#include "Python.h"
+#include "pythread.h"
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <deque>
+#include <mutex>
+#include <thread>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+struct CLockEvent {
+    PY_LONG_LONG timestamp;
+    int64_t flag;
+    /* Which thread called it */
+    int64_t tid;
+    /* ID of the lock it was called on, see `LockProfiler.register_lock` */
+    int64_t lock_hash;
+    /* Interned call stack ID */
+    int64_t stack_hash;
+};
+
+#define EVENT_CHUNK_SIZE 1024
+
+struct EventChunk {
+    /* Number of valid events. Published after the event is written. */
+    std::atomic<size_t> count;
+    CLockEvent events[EVENT_CHUNK_SIZE];
+};
+
+struct ThreadBuffer {
+    int64_t tid;
+    std::mutex mutex;
+    /* Oldest chunk first */
+    std::deque<EventChunk*> chunks;
+    /* Chunk currently being written to, or NULL */
+    EventChunk* current;
+    /* Number of events in chunks removed from the front of `chunks`, guarded by `mutex` */
+    uint64_t dropped;
+};
+
+/* Position of a reader in the events, see `event_buffer_collect_new` */
+struct EventCursor {
+    /* Value of `_event_buffer_generation` the positions are valid for */
+    uint64_t generation = 0;
+    /* {buffer: number of its events read}. Buffers are never freed, so the pointers stay unique. */
+    std::unordered_map<ThreadBuffer*, uint64_t> read;
+};
+
+static std::mutex _thread_buffers_mutex;
+static std::vector<ThreadBuffer*> _thread_buffers;
+static thread_local ThreadBuffer* _thread_buffer = NULL;
+
+/* All chunks in allocation order, oldest first. Guarded by `_thread_buffers_mutex`. */
+static std::deque<std::pair<ThreadBuffer*, EventChunk*>> _event_chunks;
+/* Maximum number of chunks, or 0 for no limit */
+static size_t _event_buffer_max_chunks = 0;
+/* While set, no new events are recorded */
+static std::atomic<bool> _event_buffer_frozen(false);
+/* Incremented when the events are cleared. Guarded by `_thread_buffers_mutex`. */
+static uint64_t _event_buffer_generation = 0;
+
+static ThreadBuffer*
+event_buffer_register()
+{
+    ThreadBuffer* buf = new ThreadBuffer();
+    buf->tid = (int64_t)PyThread_get_thread_ident();
+    buf->current = NULL;
+    buf->dropped = 0;
+    {
+        std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+        _thread_buffers.push_back(buf);
+    }
+    _thread_buffer = buf;
+    return buf;
+}
+
+/* Detach the oldest chunk that no other thread is writing to.
+ * Must be called with `_thread_buffers_mutex` held. Returns NULL if there is none.
+ */
+static EventChunk*
+_event_buffer_recycle_oldest(ThreadBuffer* requester)
+{
+    for (auto it = _event_chunks.begin(); it != _event_chunks.end(); ++it) {
+        ThreadBuffer* owner = it->first;
+        EventChunk* chunk = it->second;
+        if (owner != requester && owner->current == chunk) {
+            continue;
+        }
+        {
+            std::lock_guard<std::mutex> owner_guard(owner->mutex);
+            // A thread's chunks are allocated in order, so this is its oldest one
+            owner->chunks.pop_front();
+            owner->dropped += chunk->count.load(std::memory_order_relaxed);
+            if (owner->current == chunk) {
+                owner->current = NULL;
+            }
+        }
+        _event_chunks.erase(it);
+        chunk->count.store(0, std::memory_order_relaxed);
+        return chunk;
+    }
+    return NULL;
+}
+
+/* Stream file layout:
+ *   header: 8 byte magic, uint32 version, uint32 sizeof(CLockEvent)
+ *   blocks: int64 tid, int64 count, `count` CLockEvents of that thread
+ * Blocks of the same thread appear in recording order. Everything is in native byte order.
+ */
+#define EVENT_STREAM_MAGIC "LKSTREAM"
+#define EVENT_STREAM_VERSION 1
+
+struct EventStream {
+    FILE* file;
+    std::thread writer;
+    std::mutex mutex;
+    std::condition_variable cond;
+    /* Full chunks waiting to be written, with the tid of their thread */
+    std::deque<std::pair<int64_t, EventChunk*>> pending;
+    /* Written chunks ready for reuse */
+    std::vector<EventChunk*> free_chunks;
+    bool stopping;
+};
+
+/* Active stream, or NULL. Guarded by `_thread_buffers_mutex`. */
+static EventStream* _event_stream = NULL;
+
+static void
+_event_stream_write_loop(EventStream* stream)
+{
+    std::unique_lock<std::mutex> lock(stream->mutex);
+    for (;;) {
+        stream->cond.wait(lock, [stream] { return stream->stopping || !stream->pending.empty(); });
+        if (stream->pending.empty()) {
+            break;
+        }
+        std::pair<int64_t, EventChunk*> item = stream->pending.front();
+        stream->pending.pop_front();
+        lock.unlock();
+
+        int64_t header[2] = {item.first, (int64_t)item.second->count.load(std::memory_order_acquire)};
+        fwrite(header, sizeof(header), 1, stream->file);
+        fwrite(item.second->events, sizeof(CLockEvent), (size_t)header[1], stream->file);
+        item.second->count.store(0, std::memory_order_relaxed);
+
+        lock.lock();
+        stream->free_chunks.push_back(item.second);
+    }
+}
+
+/* Queue a chunk for writing. Must be called with `_thread_buffers_mutex` held. */
+static void
+_event_stream_push(ThreadBuffer* buf, EventChunk* chunk)
+{
+    if (chunk->count.load(std::memory_order_acquire) == 0) {
+        delete chunk;
+        return;
+    }
+    {
+        std::lock_guard<std::mutex> guard(_event_stream->mutex);
+        _event_stream->pending.emplace_back(buf->tid, chunk);
+    }
+    _event_stream->cond.notify_one();
+}
+
+/* Move every chunk currently held in memory to the stream.
+ * Must be called with `_thread_buffers_mutex` held.
+ */
+static void
+_event_stream_flush_buffers()
+{
+    for (ThreadBuffer* buf : _thread_buffers) {
+        std::lock_guard<std::mutex> buf_guard(buf->mutex);
+        for (EventChunk* chunk : buf->chunks) {
+            buf->dropped += chunk->count.load(std::memory_order_acquire);
+            _event_stream_push(buf, chunk);
+        }
+        buf->chunks.clear();
+        buf->current = NULL;
+    }
+    _event_chunks.clear();
+}
+
+/* Start streaming to `filename`, including the events already recorded.
+ * Returns 0 on success, -1 if the file can't be opened or a stream is already active.
+ */
+static int
+event_stream_start(const char* filename)
+{
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    if (_event_stream != NULL) {
+        return -1;
+    }
+    FILE* file = fopen(filename, "wb");
+    if (file == NULL) {
+        return -1;
+    }
+    setvbuf(file, NULL, _IOFBF, 1 << 20);
+    uint32_t header[2] = {EVENT_STREAM_VERSION, (uint32_t)sizeof(CLockEvent)};
+    fwrite(EVENT_STREAM_MAGIC, 1, 8, file);
+    fwrite(header, sizeof(header), 1, file);
+
+    EventStream* stream = new EventStream();
+    stream->file = file;
+    stream->stopping = false;
+    _event_stream = stream;
+    _event_stream_flush_buffers();
+    stream->writer = std::thread(_event_stream_write_loop, stream);
+    return 0;
+}
+
+/* Write out the remaining events, then stop the writer and close the file.
+ * Returns 0 on success, -1 if no stream is active or writing failed.
+ */
+static int
+event_stream_stop()
+{
+    EventStream* stream;
+    {
+        std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+        stream = _event_stream;
+        if (stream == NULL) {
+            return -1;
+        }
+        _event_stream_flush_buffers();
+        _event_stream = NULL;
+    }
+    {
+        std::lock_guard<std::mutex> guard(stream->mutex);
+        stream->stopping = true;
+    }
+    stream->cond.notify_one();
+    stream->writer.join();
+
+    int failed = ferror(stream->file);
+    failed |= fclose(stream->file);
+    for (EventChunk* chunk : stream->free_chunks) {
+        delete chunk;
+    }
+    delete stream;
+    return failed ? -1 : 0;
+}
+
+static inline bool
+event_stream_is_active()
+{
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    return _event_stream != NULL;
+}
+
+/* Hand the current chunk of `buf` to the writer and return an empty one.
+ * Must be called with `_thread_buffers_mutex` held.
+ */
+static EventChunk*
+_event_stream_swap_chunk(ThreadBuffer* buf)
+{
+    EventChunk* chunk = NULL;
+    {
+        std::lock_guard<std::mutex> buf_guard(buf->mutex);
+        for (EventChunk* full : buf->chunks) {
+            buf->dropped += full->count.load(std::memory_order_acquire);
+            _event_stream_push(buf, full);
+        }
+        buf->chunks.clear();
+    }
+    {
+        std::lock_guard<std::mutex> guard(_event_stream->mutex);
+        if (!_event_stream->free_chunks.empty()) {
+            chunk = _event_stream->free_chunks.back();
+            _event_stream->free_chunks.pop_back();
+        }
+    }
+    if (chunk == NULL) {
+        chunk = new EventChunk();
+        chunk->count.store(0, std::memory_order_relaxed);
+    }
+    return chunk;
+}
+
+static EventChunk*
+event_buffer_new_chunk(ThreadBuffer* buf)
+{
+    EventChunk* chunk = NULL;
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    if (_event_stream != NULL) {
+        chunk = _event_stream_swap_chunk(buf);
+        std::lock_guard<std::mutex> buf_guard(buf->mutex);
+        buf->chunks.push_back(chunk);
+        buf->current = chunk;
+        return chunk;
+    }
+    if (_event_buffer_max_chunks && _event_chunks.size() >= _event_buffer_max_chunks) {
+        chunk = _event_buffer_recycle_oldest(buf);
+    }
+    if (chunk == NULL) {
+        chunk = new EventChunk();
+        chunk->count.store(0, std::memory_order_relaxed);
+    }
+    _event_chunks.emplace_back(buf, chunk);
+
+    std::lock_guard<std::mutex> buf_guard(buf->mutex);
+    buf->chunks.push_back(chunk);
+    buf->current = chunk;
+    return chunk;
+}
+
+static inline void
+event_buffer_record(PY_LONG_LONG timestamp, int64_t flag, int64_t lock_hash, int64_t stack_hash)
+{
+    if (_event_buffer_frozen.load(std::memory_order_relaxed)) {
+        return;
+    }
+    ThreadBuffer* buf = _thread_buffer;
+    if (buf == NULL) {
+        buf = event_buffer_register();
+    }
+    EventChunk* chunk = buf->current;
+    size_t count = chunk == NULL ? EVENT_CHUNK_SIZE : chunk->count.load(std::memory_order_relaxed);
+    if (count == EVENT_CHUNK_SIZE) {
+        chunk = event_buffer_new_chunk(buf);
+        count = 0;
+    }
+    CLockEvent* e = &chunk->events[count];
+    e->timestamp = timestamp;
+    e->flag = flag;
+    e->tid = buf->tid;
+    e->lock_hash = lock_hash;
+    e->stack_hash = stack_hash;
+    chunk->count.store(count + 1, std::memory_order_release);
+}
+
+static inline bool
+_event_timestamp_less(const CLockEvent& a, const CLockEvent& b)
+{
+    return a.timestamp < b.timestamp;
+}
+
+/* Sort events by timestamp. Events of the same thread keep their recording order. */
+static void
+event_buffer_sort(std::vector<CLockEvent>& events)
+{
+    std::stable_sort(events.begin(), events.end(), _event_timestamp_less);
+}
+
+static uint64_t
+event_buffer_generation()
+{
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    return _event_buffer_generation;
+}
+
+/* Copy the events of all threads into `out`, sorted by timestamp.
+ * Events of the same thread keep their recording order.
+ */
+static void
+event_buffer_collect(std::vector<CLockEvent>& out)
+{
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    for (ThreadBuffer* buf : _thread_buffers) {
+        std::lock_guard<std::mutex> buf_guard(buf->mutex);
+        for (EventChunk* chunk : buf->chunks) {
+            size_t count = chunk->count.load(std::memory_order_acquire);
+            out.insert(out.end(), chunk->events, chunk->events + count);
+        }
+    }
+    event_buffer_sort(out);
+}
+
+/* Append the events recorded since the previous call with `cursor` to `out`, unsorted (see `event_buffer_sort`).
+ * If the events were cleared since, the cursor starts over. Returns the number of events dropped before
+ * they could be read.
+ */
+static uint64_t
+event_buffer_collect_new(std::vector<CLockEvent>& out, EventCursor& cursor)
+{
+    uint64_t lost = 0;
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    if (cursor.generation != _event_buffer_generation) {
+        cursor.generation = _event_buffer_generation;
+        cursor.read.clear();
+    }
+    for (ThreadBuffer* buf : _thread_buffers) {
+        std::lock_guard<std::mutex> buf_guard(buf->mutex);
+        uint64_t& read = cursor.read[buf];
+        uint64_t position = buf->dropped;
+        if (read < position) {
+            lost += position - read;
+            read = position;
+        }
+        for (EventChunk* chunk : buf->chunks) {
+            size_t count = chunk->count.load(std::memory_order_acquire);
+            if (read < position + count) {
+                out.insert(out.end(), chunk->events + (read - position), chunk->events + count);
+                read = position + count;
+            }
+            position += count;
+        }
+    }
+    return lost;
+}
+
+/* Make the current thread record into a scratch buffer of one chunk, which readers never see, instead of its own.
+ * Used to time the hooks, see `LockProfiler.calibrate`. Returns the thread's own buffer, to give back to
+ * `event_buffer_stop_scratch`. The events must be taken with `event_buffer_take_scratch` before the chunk fills.
+ */
+static ThreadBuffer*
+event_buffer_start_scratch()
+{
+    ThreadBuffer* own = _thread_buffer;
+    ThreadBuffer* scratch = new ThreadBuffer();
+    scratch->tid = (int64_t)PyThread_get_thread_ident();
+    scratch->current = new EventChunk();
+    scratch->current->count.store(0, std::memory_order_relaxed);
+    scratch->dropped = 0;
+    _thread_buffer = scratch;
+    return own;
+}
+
+/* The events recorded into the scratch buffer since the previous call, which discards them */
+static const CLockEvent*
+event_buffer_take_scratch(size_t* count)
+{
+    EventChunk* chunk = _thread_buffer->current;
+    *count = chunk->count.load(std::memory_order_relaxed);
+    chunk->count.store(0, std::memory_order_relaxed);
+    return chunk->events;
+}
+
+static void
+event_buffer_stop_scratch(ThreadBuffer* own)
+{
+    ThreadBuffer* scratch = _thread_buffer;
+    _thread_buffer = own;
+    delete scratch->current;
+    delete scratch;
+}
+
+/* Drop all recorded events. Buffers stay registered to their threads. */
+static void
+event_buffer_clear()
+{
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    for (ThreadBuffer* buf : _thread_buffers) {
+        std::lock_guard<std::mutex> buf_guard(buf->mutex);
+        for (EventChunk* chunk : buf->chunks) {
+            delete chunk;
+        }
+        buf->chunks.clear();
+        buf->current = NULL;
+        buf->dropped = 0;
+    }
+    _event_chunks.clear();
+    _event_buffer_generation++;
+}
+
+/* Limit the total number of chunks, dropping the oldest ones if needed. 0 removes the limit. */
+static void
+event_buffer_set_max_chunks(size_t max_chunks)
+{
+    std::lock_guard<std::mutex> guard(_thread_buffers_mutex);
+    _event_buffer_max_chunks = max_chunks;
+    while (max_chunks && _event_chunks.size() > max_chunks) {
+        EventChunk* chunk = _event_buffer_recycle_oldest(NULL);
+        if (chunk == NULL) {
+            break;
+        }
+        delete chunk;
+    }
+}
+
+static inline void
+event_buffer_freeze(bool frozen)
+{
+    _event_buffer_frozen.store(frozen);
+}
+
+static inline bool
+event_buffer_is_frozen()
+{
+    return _event_buffer_frozen.load(std::memory_order_relaxed);
+}
+
+#endif
@@ -0,0 +1,101 @@
+"""
+Reading of the event stream files written by `LockProfiler.start_streaming`.
+
+The events are never loaded into memory all at once: the stream is indexed by
+scanning the block headers, and the blocks of each thread are merged by
+timestamp while they are read.
+"""
+import heapq
+import json
+import struct
+import typing
+
+from ._lock_profiler import LockEvent, LockStats, StackFrame
+
+MAGIC = b"LKSTREAM"
+VERSION = 1
+# Thread ID of the block holding the lock and stack tables, appended when the stream is stopped
+TRAILER_TID = -1
+
+_HEADER = struct.Struct("=8sII")
+_BLOCK_HEADER = struct.Struct("=qq")
+_EVENT = struct.Struct("=qqqqq")
+
+
+def write_trailer(filename, lock_hashes, stack_hashes, wait_overhead=0, hold_overhead=0, uncontended_counts=None):
+    """Append the lock and stack tables, the hook overhead and the uncontended acquisition counts to a stream
+    written by the recorder."""
+    payload = json.dumps({
+        "lock_hashes": lock_hashes,
+        "stack_hashes": stack_hashes,
+        "wait_overhead": wait_overhead,
+        "hold_overhead": hold_overhead,
+        "uncontended_counts": uncontended_counts or {},
+    }).encode()
+    with open(filename, "ab") as f:
+        f.write(_BLOCK_HEADER.pack(TRAILER_TID, len(payload)))
+        f.write(payload)
+
+
+class StreamedEvents:
+    """Re-iterable, timestamp-ordered view of the events in a stream file.
+
+    Memory use is bounded by one block per thread, regardless of the number of events.
+    """
+
+    def __init__(self, filename, blocks: typing.Dict[int, typing.List[typing.Tuple[int, int]]]):
+        self.filename = filename
+        # {tid: [(offset, count), ...]}
+        self.blocks = blocks
+
+    def __len__(self):
+        return sum(count for thread_blocks in self.blocks.values() for _, count in thread_blocks)
+
+    def __iter__(self) -> typing.Iterator[LockEvent]:
+        with open(self.filename, "rb") as f:
+            yield from heapq.merge(
+                *(self._iter_thread(f, thread_blocks) for thread_blocks in self.blocks.values()),
+                key=lambda e: e.timestamp,
+            )
+
+    @staticmethod
+    def _iter_thread(f, thread_blocks):
+        for offset, count in thread_blocks:
+            f.seek(offset)
+            data = f.read(count * _EVENT.size)
+            # Read the whole block before yielding since other threads' blocks move the file position
+            events = [LockEvent._make(e) for e in _EVENT.iter_unpack(data)]
+            yield from events
+
+
+def read_event_stream(filename) -> LockStats:
+    """Open a stream file. The returned `lock_list` reads the events lazily."""
+    blocks: typing.Dict[int, typing.List[typing.Tuple[int, int]]] = {}
+    lock_hashes = {}
+    stack_hashes = {}
+    overheads = (0, 0)
+    uncontended_counts = {}
+
+    with open(filename, "rb") as f:
+        magic, version, event_size = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION or event_size != _EVENT.size:
+            raise ValueError(f"{filename} is not a supported lock_profiler event stream")
+
+        while True:
+            header = f.read(_BLOCK_HEADER.size)
+            if len(header) < _BLOCK_HEADER.size:
+                break
+            tid, count = _BLOCK_HEADER.unpack(header)
+            if tid == TRAILER_TID:
+                tables = json.loads(f.read(count))
+                lock_hashes = {int(k): v for k, v in tables["lock_hashes"].items()}
+                stack_hashes = {
+                    int(k): [StackFrame(*frame) for frame in v] for k, v in tables["stack_hashes"].items()
+                }
+                overheads = (tables.get("wait_overhead", 0), tables.get("hold_overhead", 0))
+                uncontended_counts = {int(k): v for k, v in tables.get("uncontended_counts", {}).items()}
+                continue
+            blocks.setdefault(tid, []).append((f.tell(), count))
+            f.seek(count * _EVENT.size, 1)
+
+    return LockStats(lock_hashes, stack_hashes, StreamedEvents(filename, blocks), *overheads, uncontended_counts)
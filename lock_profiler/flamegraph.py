@@ -0,0 +1,202 @@
+"""
+Flame graphs of where the time waiting for, holding and blocking on locks goes.
+
+The per line stats of the analysis flatten call paths: a helper taking a lock
+for many callers shows as one line. These keep the whole call stack instead,
+from the per stack stats of `analyze` (`ContentionStats.stack_stats`), which
+are accumulated in the same pass over the events as the other stats: the
+export only walks the distinct stacks, not the events.
+
+`collapsed_stacks` gives the collapsed-stack format of flamegraph.pl, which
+speedscope, inferno and most other flame graph tools also read: a line per
+stack, with the frames from the outermost call down to the lock separated by
+`;`, then the value, in ns. Stacks are weighted by one of the `METRICS`:
+
+- wait: time from the start of the acquire to getting the lock
+- hold: time the lock was held, from the outermost acquire to its release
+- block: wait time of the acquires that found the lock held by another thread
+- blame: time the critical sections of the stack blocked other threads
+
+With sampling, wait, hold and block are estimates that include the
+acquisitions that weren't sampled. The frames of the profiler and the
+`threading` module are left out, like in the per line stats.
+
+`write_svg` draws the same stacks as a self-contained SVG flame graph, the
+root at the bottom and each lock on top of the stack that took it, with the
+totals in the tooltips. It needs no scripts, so it renders anywhere, browsers
+and image viewers included.
+"""
+import sys
+import typing
+import zlib
+from argparse import ArgumentParser
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+from ._lock_profiler import LockStats
+from .analysis import ESTIMATED_FIELDS, ContentionStats, _is_ignored, analyze
+
+# {metric: Stat field it is weighted by}
+METRICS = {
+    "wait": "total_wait_time",
+    "hold": "total_hold_time",
+    "block": "total_block_time",
+    "blame": "total_blame_time",
+}
+
+_WIDTH = 1200
+_FRAME_HEIGHT = 16
+_FONT_SIZE = 12
+# Average width of a character, relative to the font size
+_CHAR_WIDTH = 0.59
+# Frames narrower than this are left out of the SVG, in pixels
+_MIN_WIDTH = 0.1
+
+
+def _frame_name(name: str) -> str:
+    # `;` separates the frames and a line break ends the stack
+    return name.replace(";", ",").replace("\n", " ")
+
+
+def collapsed_stacks(
+    stats: LockStats, metric: str = "wait", contention: typing.Optional[ContentionStats] = None,
+) -> typing.Dict[str, int]:
+    """{collapsed stack: total of `metric`} of each stack with a nonzero total.
+
+    `contention` is the analysis of `stats`, which is done here if not given.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(METRICS)}")
+    name = METRICS[metric]
+    if contention is None:
+        contention = analyze(stats)
+    lock_names = {}
+    stacks = defaultdict(int)
+    for stack_hash, locks in contention.stack_stats.items():
+        frames = [
+            _frame_name(f"{func} ({file}:{line})")
+            for file, func, line in reversed(stats.stack_hashes.get(stack_hash, ()))
+            if not _is_ignored(file)
+        ]
+        for lock_hash, stat in locks.items():
+            value = round(stat.estimate(name).value) if name in ESTIMATED_FIELDS else getattr(stat, name)
+            if not value:
+                continue
+            lock_name = lock_names.get(lock_hash)
+            if lock_name is None:
+                lock_name = lock_names[lock_hash] = _frame_name(stats.lock_hashes.get(lock_hash, f"lock {lock_hash}"))
+            # Stacks that differ only in ignored frames add up
+            stacks[";".join(frames + [lock_name])] += value
+    return dict(stacks)
+
+
+def write_collapsed(filename, stacks: typing.Dict[str, int]):
+    """Write the result of `collapsed_stacks`, sorted by stack."""
+    with open(filename, "w") as f:
+        for stack, value in sorted(stacks.items()):
+            f.write(f"{stack} {value}\n")
+
+
+class _Node:
+    __slots__ = ("value", "children", "is_lock")
+
+    def __init__(self):
+        self.value = 0
+        self.children: typing.Dict[str, "_Node"] = {}
+        self.is_lock = False
+
+
+def _format_time(ns: float) -> str:
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("µs", 1e3)):
+        if ns >= scale:
+            return f"{ns / scale:.3g} {unit}"
+    return f"{ns:.0f} ns"
+
+
+def _color(name: str, is_lock: bool) -> str:
+    """Warm colour for code and a blue for locks, stable per name."""
+    h = zlib.crc32(name.encode())
+    if is_lock:
+        return f"rgb({80 + h % 50},{120 + (h >> 8) % 60},{200 + (h >> 16) % 55})"
+    return f"rgb({205 + h % 50},{(h >> 8) % 200},{(h >> 16) % 55})"
+
+
+def write_svg(filename, stacks: typing.Dict[str, int], title: str = "Lock wait time"):
+    """Write the result of `collapsed_stacks` as an SVG flame graph."""
+    root = _Node()
+    depth = 0
+    for stack, value in stacks.items():
+        node = root
+        root.value += value
+        frames = stack.split(";")
+        depth = max(depth, len(frames))
+        for frame in frames:
+            node = node.children.setdefault(frame, _Node())
+            node.value += value
+        node.is_lock = True
+
+    top = 2 * _FRAME_HEIGHT + 8
+    height = top + (depth + 1) * _FRAME_HEIGHT + 10
+    scale = (_WIDTH - 20) / root.value if root.value else 0
+    out = [
+        f'<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{_WIDTH}" height="{height}" '
+        f'viewBox="0 0 {_WIDTH} {height}" font-family="Verdana, sans-serif" font-size="{_FONT_SIZE}">\n'
+        f'<rect width="100%" height="100%" fill="#f8f8f8"/>\n'
+        f'<text x="{_WIDTH / 2}" y="{_FRAME_HEIGHT + 4}" text-anchor="middle" font-size="{_FONT_SIZE + 5}">'
+        f'{escape(title)}</text>\n'
+    ]
+
+    def draw(name, node, x, level):
+        width = node.value * scale
+        y = height - 10 - (level + 1) * _FRAME_HEIGHT
+        share = node.value / root.value * 100
+        out.append(
+            f'<g><title>{escape(name)}: {_format_time(node.value)} ({share:.2f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" height="{_FRAME_HEIGHT - 1}" '
+            f'fill="{_color(name, node.is_lock)}" rx="2"/>'
+        )
+        chars = int((width - 6) / (_FONT_SIZE * _CHAR_WIDTH))
+        if chars >= 3:
+            text = name if len(name) <= chars else name[:chars - 2] + ".."
+            out.append(f'<text x="{x + 3:.1f}" y="{y + _FRAME_HEIGHT - 4}">{escape(text)}</text>')
+        out.append("</g>\n")
+        # Sorted by name, so that the same frames line up between graphs
+        for child_name, child in sorted(node.children.items()):
+            if child.value * scale >= _MIN_WIDTH:
+                draw(child_name, child, x, level + 1)
+            x += child.value * scale
+
+    if root.value:
+        draw("all", root, 10, 0)
+    out.append("</svg>\n")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("".join(out))
+
+
+def export_flamegraph(filename, stats: LockStats, metric: str = "wait",
+                      contention: typing.Optional[ContentionStats] = None):
+    """Write the `metric` flame graph of `stats` as SVG if `filename` ends in `.svg`, else as collapsed stacks."""
+    stacks = collapsed_stacks(stats, metric, contention)
+    if str(filename).endswith(".svg"):
+        write_svg(filename, stacks, f"Lock {metric} time")
+    else:
+        write_collapsed(filename, stacks)
+
+
+def main(argv=None):
+    """Write a flame graph of a trace saved by `LockProfiler.dump_stats` or `start_streaming`."""
+    from .lock_profiler import LockProfiler
+
+    parser = ArgumentParser(prog="python -m lock_profiler.flamegraph", description=main.__doc__)
+    parser.add_argument("trace", help="Trace to read")
+    parser.add_argument("output", help="SVG flame graph if it ends in .svg, else collapsed stacks")
+    parser.add_argument("--metric", choices=list(METRICS), default="wait", help="What the stacks are weighted by")
+    args = parser.parse_args(argv)
+    export_flamegraph(args.output, LockProfiler.load_stats(args.trace), args.metric)
+    print(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+/* Log-linear latency histograms, see histogram.py for the bucketing. */
+#ifndef LOCK_PROFILER_HISTOGRAM_H
+#define LOCK_PROFILER_HISTOGRAM_H
+
+#include <cstdint>
+#include <vector>
+
+#ifdef _MSC_VER
+#include <intrin.h>
+#endif
+
+#define HISTOGRAM_SUB_BUCKET_BITS 4
+#define HISTOGRAM_SUB_BUCKETS (1 << HISTOGRAM_SUB_BUCKET_BITS)
+
+struct LatencyHistogram {
+    /* Count per bucket, up to the bucket of the largest recorded value */
+    std::vector<int64_t> counts;
+};
+
+static inline int
+histogram_bucket_index(int64_t value)
+{
+    if (value < HISTOGRAM_SUB_BUCKETS) {
+        return value < 0 ? 0 : (int)value;
+    }
+#ifdef _MSC_VER
+    unsigned long exponent;
+    _BitScanReverse64(&exponent, (unsigned long long)value);
+#else
+    int exponent = 63 - __builtin_clzll((unsigned long long)value);
+#endif
+    return ((int)exponent - HISTOGRAM_SUB_BUCKET_BITS + 1) * HISTOGRAM_SUB_BUCKETS
+        + (int)((value >> (exponent - HISTOGRAM_SUB_BUCKET_BITS)) & (HISTOGRAM_SUB_BUCKETS - 1));
+}
+
+static inline void
+histogram_record(LatencyHistogram& hist, int64_t value)
+{
+    size_t index = (size_t)histogram_bucket_index(value);
+    if (index >= hist.counts.size()) {
+        hist.counts.resize(index + 1, 0);
+    }
+    hist.counts[index] += 1;
+}
+
+#endif
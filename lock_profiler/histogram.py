@@ -0,0 +1,115 @@
+"""
+Log-linear latency histograms, in the style of HDR histograms.
+
+Values are durations in timer units. Values below `SUB_BUCKETS` each get their
+own bucket; above that, every power of two is split into `SUB_BUCKETS` linear
+sub-buckets, so a bucket spans at most 1/16 of its values and any int64 fits in
+`N_BUCKETS` buckets. The bucketing is the same as in `histogram.h`, so
+histograms recorded online and offline, in different threads, runs or
+processes, can be merged by adding their counts.
+"""
+import typing
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+N_BUCKETS = (64 - SUB_BUCKET_BITS) * SUB_BUCKETS
+# Reported percentiles
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    exponent = value.bit_length() - 1
+    return (exponent - SUB_BUCKET_BITS + 1) * SUB_BUCKETS + ((value >> (exponent - SUB_BUCKET_BITS)) & (SUB_BUCKETS - 1))
+
+
+def bucket_bounds(index: int) -> typing.Tuple[int, int]:
+    """Lowest and highest value of a bucket."""
+    if index < SUB_BUCKETS:
+        return index, index
+    shift = index // SUB_BUCKETS - 1
+    low = (SUB_BUCKETS + index % SUB_BUCKETS) << shift
+    return low, low + (1 << shift) - 1
+
+
+def bucket_indices(values):
+    """Vectorized `bucket_index` of an int64 NumPy array."""
+    import numpy as np
+
+    values = np.maximum(values, 0)
+    # The exponent bits of the double, exact for values below 2 ** 53, which is over 100 days in nanoseconds
+    exponent = (values.astype(np.float64).view(np.int64) >> 52) - 1023
+    # Values below SUB_BUCKETS have a shift of 0 and are their own bucket, like in `bucket_index`
+    shift = np.maximum(exponent - SUB_BUCKET_BITS, 0)
+    return (shift << SUB_BUCKET_BITS) + (values >> shift)
+
+
+class Histogram:
+    """Counts of values per log-linear bucket.
+
+    Only the buckets up to the largest recorded value are stored.
+    """
+
+    __slots__ = ("counts",)
+
+    def __init__(self, counts: typing.Iterable[int] = ()):
+        self.counts: typing.List[int] = list(counts)
+
+    def record(self, value: int, count: int = 1):
+        index = bucket_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += count
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        """Add the counts of `other` to this histogram."""
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        return self
+
+    @property
+    def total_count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, percentile: float) -> int:
+        """Value at or below which `percentile` % of the values are.
+
+        This is the highest value of the bucket it falls in, so it is overestimated by at most 1/16. 0 if the
+        histogram is empty.
+        """
+        total = self.total_count
+        if not total:
+            return 0
+        # Smallest rank covering the percentile, computed in integers to be exact for e.g. 99.9
+        rank = max(1, -(-round(percentile * 1000) * total // 100000))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket_bounds(index)[1]
+        return bucket_bounds(len(self.counts) - 1)[1]
+
+    def percentiles(self, percentiles=PERCENTILES) -> typing.Dict[float, int]:
+        return {p: self.percentile(p) for p in percentiles}
+
+    def to_dict(self) -> typing.Dict[int, int]:
+        """Sparse `{bucket index: count}` representation, e.g. for json."""
+        return {i: count for i, count in enumerate(self.counts) if count}
+
+    @classmethod
+    def from_dict(cls, counts: typing.Dict[typing.Any, int]) -> "Histogram":
+        hist = cls()
+        for i, count in counts.items():
+            hist.record(bucket_bounds(int(i))[0], count)
+        return hist
+
+    def __eq__(self, other):
+        if not isinstance(other, Histogram):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Histogram({self.to_dict()})"
@@ -0,0 +1,90 @@
+"""
+Process-wide instrumentation of the `threading` locks.
+
+`install()` replaces `threading.Lock` and `threading.RLock` with subclasses of
+`ProfiledLock` and `ProfiledRLock`. Since `threading.Condition`, `Semaphore`,
+`Event` and `Barrier`, as well as modules like `queue`, `logging` and
+`concurrent.futures`, create their locks through these attributes, every lock
+created afterwards is profiled. Each lock is named after the place it was
+created, skipping frames inside `threading` itself.
+
+The replacements are classes, like `threading.Lock` since Python 3.13, so they
+can be subclassed, and `isinstance` checks against them also accept the plain
+locks created before `install()`.
+
+Each profiled lock keeps its ID and name for the rest of the run once it is
+acquired, so that its events stay attributed to it. Locks deallocated without
+ever being acquired give them back, so only the locks that were acquired add
+to the profiler's per-lock memory.
+
+Locks created before `install()`, or through a name imported with
+`from threading import Lock` before it, are not instrumented.
+"""
+import _thread
+import sys
+import threading
+
+from ._lock_profiler import ProfiledLock, ProfiledRLock
+
+# Frames in these files are skipped when naming a lock
+_SKIPPED_FILES = (threading.__file__, __file__)
+
+# The replaced (Lock, RLock) while installed
+_originals = None
+
+
+def _allocation_site() -> str:
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename in _SKIPPED_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return "<unknown>"
+    return f"{frame.f_code.co_filename}:{frame.f_lineno}"
+
+
+class _Replacement(type):
+    """Metaclass of the replacements, whose `isinstance` checks also accept the locks they replace."""
+
+    # Only the replacements themselves accept the replaced locks, not their subclasses
+    def __instancecheck__(cls, instance):
+        return super().__instancecheck__(instance) or isinstance(instance, cls.__dict__.get("_replaced", ()))
+
+    def __subclasscheck__(cls, subclass):
+        return super().__subclasscheck__(subclass) or issubclass(subclass, cls.__dict__.get("_replaced", ()))
+
+
+class _Lock(ProfiledLock, metaclass=_Replacement):
+    _replaced = _thread.LockType
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls, _allocation_site())
+
+
+class _RLock(ProfiledRLock, metaclass=_Replacement):
+    _replaced = tuple(t for t in (threading._CRLock, threading._PyRLock) if t is not None)
+
+    def __new__(cls, *args, **kwargs):
+        return super().__new__(cls, _allocation_site())
+
+
+def install():
+    """Profile all `threading` locks created from now on. Does nothing if already installed."""
+    global _originals
+    if _originals is not None:
+        return
+    _originals = (threading.Lock, threading.RLock)
+    threading.Lock = _Lock
+    threading.RLock = _RLock
+
+
+def uninstall():
+    """Undo `install()`. Locks that were already created stay profiled."""
+    global _originals
+    if _originals is None:
+        return
+    threading.Lock, threading.RLock = _originals
+    _originals = None
+
+
+def is_installed() -> bool:
+    return _originals is not None
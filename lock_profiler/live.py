@@ -0,0 +1,242 @@
+"""
+Live stats of a running program, served from a background thread while the profiler keeps recording.
+
+`StatsServer` serves JSON over HTTP, on localhost or on a Unix domain socket:
+
+    server = LockProfiler.serve_stats(("127.0.0.1", 8765))
+    # curl http://127.0.0.1:8765/locks
+    server = LockProfiler.serve_stats("/tmp/locks.sock")
+    # curl --unix-socket /tmp/locks.sock http://localhost/locks
+
+- `/locks`: stats of each lock, by decreasing wait time
+- `/sites`: the `top` (file, line, lock) call sites by block time, then wait time
+- `/events`: the `recent` latest events, oldest first
+- `/`: all of the above, with the snapshot's timestamp and event counts
+
+Times are in ns. The stats are those of aggregate-only mode: blame is not
+available, and sampled acquisitions count once.
+
+Requests never read the recorder. They are answered from the latest complete
+snapshot, which a refresher thread replaces as a whole every `interval`
+seconds, so the snapshot being built and the one being served are never the
+same. A snapshot only reads the recorder incrementally: the events recorded
+since the previous one are added to running counters (see `LiveAggregates`),
+rather than copying every event like `get_stats`. In aggregate-only mode the
+hooks' counters are read instead, and there are no recent events.
+
+Answering a request only writes out a prepared body, so they are handled one at
+a time by the serving thread. The server's threads are started with `_thread`,
+and only use its plain locks rather than `threading` objects (not even the
+`threading.Event` of `serve_forever`), so they stay out of the stats when the
+`threading` locks are instrumented (see `instrument.py`).
+"""
+import _thread
+import collections
+import dataclasses
+import json
+import os
+import traceback
+import typing
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import UnixStreamServer
+
+from ._lock_profiler import LiveAggregates, LockProfiler, PY_E_WAIT, PY_E_ACQUIRE, PY_E_MASK
+from .analysis import Stat, _N_SUMMARY_FIELDS, from_aggregates
+
+_KINDS = {PY_E_WAIT: "wait", PY_E_ACQUIRE: "acquire"}
+_SUMMARY_NAMES = [f.name for f in dataclasses.fields(Stat)[:_N_SUMMARY_FIELDS]]
+
+
+def _stat_json(stat: Stat) -> dict:
+    summary = dict(zip(_SUMMARY_NAMES, dataclasses.astuple(stat)[:_N_SUMMARY_FIELDS]))
+    summary["percentiles"] = stat.percentiles()
+    return summary
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Seconds a slow client can hold up the others
+    timeout = 10
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.rstrip("/") or "/"
+        body = self.server.stats_server._snapshot.get(path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixServer(UnixStreamServer):
+    pass
+
+
+class StatsServer:
+    """Serves the stats recorded so far on `address`: a (host, port) pair, or the path of a Unix domain socket.
+
+    Port 0 picks a free port, see `address` once started.
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), interval: float = 1.0, top: int = 20, recent: int = 100):
+        self.address = address
+        self.interval = interval
+        self.top = top
+        self.recent = recent
+        self._live = LiveAggregates()
+        self._recent_events = collections.deque(maxlen=recent)
+        # {stack_id: frames} of the stacks seen so far, see `LiveAggregates.resets`
+        self._stacks = {}
+        self._resets = 0
+        # {path: JSON body} of the latest snapshot
+        self._snapshot: typing.Dict[str, bytes] = {}
+        self._refresh_lock = _thread.allocate_lock()
+        # Held while running, see `_refresh_loop`
+        self._running = _thread.allocate_lock()
+        self._stopping = False
+        self._server = None
+        # Locks held by each thread until it returns
+        self._threads = []
+
+    def start(self) -> "StatsServer":
+        """Take a first snapshot and start serving it, refreshing it in the background."""
+        if self._server is not None:
+            raise RuntimeError("The server is already started")
+        self.refresh()
+        if isinstance(self.address, (str, bytes, os.PathLike)):
+            self._server = _UnixServer(os.fspath(self.address), _Handler)
+        else:
+            self._server = HTTPServer(tuple(self.address), _Handler)
+            self.address = self._server.server_address[:2]
+        self._server.stats_server = self
+        # Seconds between checks of `_stopping` while no request comes, like the poll interval of `serve_forever`
+        self._server.timeout = 0.5
+        self._stopping = False
+        self._running.acquire()
+        self._threads = [self._start_thread(self._serve_loop), self._start_thread(self._refresh_loop)]
+        return self
+
+    @staticmethod
+    def _start_thread(target) -> "_thread.LockType":
+        """Run `target` on a new thread. Returns a lock held until it returns, to wait for it."""
+        done = _thread.allocate_lock()
+        done.acquire()
+
+        def run():
+            try:
+                target()
+            finally:
+                done.release()
+
+        _thread.start_new_thread(run, ())
+        return done
+
+    def stop(self):
+        """Stop serving, and remove the Unix socket."""
+        if self._server is None:
+            return
+        self._stopping = True
+        self._running.release()
+        for done in self._threads:
+            with done:
+                pass
+        self._server.server_close()
+        if isinstance(self._server, _UnixServer):
+            os.unlink(self._server.server_address)
+        self._server = None
+
+    def __enter__(self):
+        # Started by `LockProfiler.serve_stats`
+        return self if self._server is not None else self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _serve_loop(self):
+        while not self._stopping:
+            self._server.handle_request()
+
+    def _refresh_loop(self):
+        while not self._running.acquire(timeout=self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the previous snapshot
+                traceback.print_exc()
+        self._running.release()
+
+    def refresh(self):
+        """Take a snapshot of the stats and serve it."""
+        with self._refresh_lock:
+            self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self) -> typing.Dict[str, bytes]:
+        new_events = self._live.update()
+        if self._live.resets != self._resets:
+            # The trace was cleared, which renumbers the stacks
+            self._resets = self._live.resets
+            self._stacks.clear()
+            self._recent_events.clear()
+        for i in range(max(0, len(new_events) - self.recent), len(new_events)):
+            self._recent_events.append(new_events[i])
+
+        if LockProfiler.is_aggregate_only():
+            lock_counters, stack_counters = LockProfiler.get_aggregates()
+        else:
+            lock_counters, stack_counters = self._live.get_aggregates()
+        stack_ids = {stack_id for _, stack_id in stack_counters}
+        stack_ids.update(e.stack_hash for e in self._recent_events if e.flag & PY_E_MASK == PY_E_WAIT)
+        self._stacks.update(LockProfiler.get_stacks(stack_ids.difference(self._stacks)))
+        uncontended = LockProfiler.get_uncontended_counts()
+        contention = from_aggregates(lock_counters, stack_counters, self._stacks, uncontended)
+        lock_names = LockProfiler.get_lock_names()
+
+        def lock_name(lock_id):
+            return lock_names.get(lock_id, f"lock {lock_id}")
+
+        locks = [
+            {"lock": lock_id, "name": lock_name(lock_id), **_stat_json(stat), "uncontended": uncontended.get(lock_id, 0)}
+            for lock_id, stat in contention.lock_stats.items()
+        ]
+        sites = sorted(
+            (
+                (file, line, lock_id, stat)
+                for file, lines in contention.file_stats.items()
+                for line, site_locks in lines.items()
+                for lock_id, stat in site_locks.items()
+            ),
+            key=lambda site: (site[3].total_block_time, site[3].total_wait_time),
+            reverse=True,
+        )[:self.top]
+        sites = [
+            {"file": file, "line": line, "lock": lock_id, "name": lock_name(lock_id), **_stat_json(stat)}
+            for file, line, lock_id, stat in sites
+        ]
+        events = []
+        for e in self._recent_events:
+            event = {"timestamp": e.timestamp, "kind": _KINDS.get(e.flag & PY_E_MASK, "release"), "tid": e.tid,
+                     "lock": e.lock_hash, "name": lock_name(e.lock_hash)}
+            if e.flag & PY_E_MASK == PY_E_WAIT:
+                event["stack"] = self._stacks.get(e.stack_hash, [])
+            events.append(event)
+
+        everything = {
+            "timestamp": LockProfiler.timestamp(),
+            "events": self._live.events,
+            "lost_events": self._live.lost_events,
+            "locks": locks,
+            "sites": sites,
+            "recent": events,
+        }
+        return {
+            "/": json.dumps(everything).encode(),
+            "/locks": json.dumps(locks).encode(),
+            "/sites": json.dumps(sites).encode(),
+            "/events": json.dumps(events).encode(),
+        }
@@ -14,19 +14,37 @@ import json
 from collections import defaultdict
 import pathlib
 import atexit
+import urllib.parse
+import webbrowser
 
 
 try:
     from ._lock_profiler import LockProfiler as CLockProfiler
-    from ._lock_profiler import LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+    from ._lock_profiler import ProfiledLock, ProfiledRLock
+    from ._lock_profiler import LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_E_MASK, \
+        PY_F_SAMPLE_SHIFT, PY_F_BLOCKED, PY_F_UNCALIBRATED
 except ImportError as ex:
     raise ImportError(
         'The lock_profiler._lock_profiler c-extension is not importable. '
         f'Has it been compiled? Underlying error is ex={ex!r}'
     )
 
+from .event_stream import MAGIC as STREAM_MAGIC, read_event_stream
+from .trace_file import read_trace, write_trace
+from .analysis import ContentionStats, Stat, analyze, from_aggregates
+from .critical_path import CriticalPath, critical_paths
+from .lod import build_lod, lod_filename, write_lod
+from .live import StatsServer
+
 __version__ = '4.0.0'
 
+# Also re-exports the extension's lock types, event records and flags
+__all__ = [
+    'LockProfiler', 'ProfiledLock', 'ProfiledRLock', 'LockEvent', 'LockStats', 'StackFrame',
+    'PY_E_WAIT', 'PY_E_ACQUIRE', 'PY_E_RELEASE', 'PY_E_MASK', 'PY_F_SAMPLE_SHIFT', 'PY_F_BLOCKED', 'PY_F_UNCALIBRATED',
+    '__version__',
+]
+
 
 class LockProfiler(CLockProfiler):
     # Stats file defaults to file in same directory as script with `.pclprof` appended
@@ -39,210 +57,130 @@ class LockProfiler(CLockProfiler):
         The stats are written to a json file, with extension .pclprof
         This extension is recognized by the PyCharm Line Profiler plugin
         """
-        stats: LockStats = LockProfiler.get_stats()
-
-        @dataclass
-        class Stat:
-            # hits includes recursive re-acquisition of the same lock, while `acquires` does not
-            hits: int = 0
-            acquires: int = 0
-            # Number of times it was blocked by another thread
-            blocks: int = 0
-            # total time spent waiting for the lock, including time for re-acquisitions (based on hits)
-            total_wait_time: int = 0
-            # average time spent waiting for the lock, excluding re-acquisitions since they take almost no time and would drag down the average (based on acquires)
-            avg_wait_time: int = 0
-            max_wait_time: int = 0
-            # hold time is the time between first seen acquire and the matching release
-            # Therefore, all these times are implicitly based on `acquires`
-            total_hold_time: int = 0
-            avg_hold_time: int = 0
-            max_hold_time: int = 0
-
-            total_block_time: int = 0
-            avg_block_time: int = 0
-            max_block_time: int = 0
-            # current acquisition depth
-            _depth: int = 0
-            # Current holder
-            _tid: int = 0
-
-        class T_LINE_LOCK(typing.NamedTuple):
-            file: str
-            line_no: int
-            lock_hash: int
-
-        # {tid: {lock_hash: Event}}
-        held: typing.DefaultDict[int, typing.DefaultDict[int, typing.List[LockEvent]]] = defaultdict(lambda: defaultdict(lambda: []))
-        lock_stats: typing.DefaultDict[int, Stat] = defaultdict(lambda: Stat())
-        file_stats: typing.DefaultDict[str, typing.DefaultDict[int, typing.DefaultDict[int, Stat]]] = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: Stat())))
-        all_stats: typing.List[Stat] = []
-        # {tid: event}
-        current_wait: typing.Dict[int, LockEvent] = {}
-        # {lock_hash: {tid: event}}
-        current_blocked: typing.DefaultDict[int, typing.Dict[int, LockEvent]] = defaultdict(lambda: {})
-        # lock_depths: typing.Dict[int, int] = defaultdict(lambda: 0)
-        # line_depths: typing.Dict[T_LINE_LOCK, int] = defaultdict(lambda: 0)
-        # # {lock_hash: tid}
-        # all_held: typing.Dict[int, int] = {}
-
-        lock_strs = stats.lock_hashes
-        stacks = stats.stack_hashes
-        events = stats.lock_list
-
-        for e in events:
+        if LockProfiler.is_streaming():
+            stats: LockStats = LockProfiler.stop_streaming()
+            contention = analyze(stats)
+            lock_hashes = stats.lock_hashes
+        else:
+            contention = LockProfiler.get_contention_stats()
+            lock_hashes = LockProfiler.get_lock_names()
+        LockProfiler._write_pycharm_stats(f"{LockProfiler._stats_filename}.pclprof", contention, lock_hashes)
 
-            if e.flag == PY_E_WAIT:
-                print(f"{e.tid} w")
-                # If the lock is already held by a different thread
-                if lock_stats[e.lock_hash]._depth > 0 and lock_stats[e.lock_hash]._tid != e.tid:
-                    current_blocked[e.lock_hash][e.tid] = e
-                    lock_stats[e.lock_hash].blocks += 1
-                    print(e.tid, "block")
-
-                current_wait[e.tid] = e
-
-            elif e.flag == PY_E_ACQUIRE:
-                print(f"{e.tid} a")
-                lock_stat = lock_stats[e.lock_hash]
-                stack_hash = current_wait[e.tid].stack_hash
-                wait_duration = e.timestamp - current_wait[e.tid].timestamp
-
-                if e.tid in current_blocked[e.lock_hash]:
-                    block_duration = e.timestamp - current_blocked[e.lock_hash][e.tid].timestamp
-                    lock_stat.total_block_time += block_duration
-                    lock_stat.max_block_time = max(lock_stat.max_block_time, block_duration)
-                    del current_blocked[e.lock_hash][e.tid]
-
-                if current_wait[e.tid][1]:
-                    lock_stat.total_block_time += wait_duration
-
-                del current_wait[e.tid]
-
-                if not lock_stat.hits:
-                    all_stats.append(lock_stat)
-                lock_stat.hits += 1
-
-                if not lock_stat._depth:
-                    lock_stat.acquires += 1
-                lock_stat._depth += 1
-                lock_stat._tid = e.tid
-
-                lock_stat.total_wait_time += wait_duration
-                lock_stat.max_wait_time = max(lock_stat.max_wait_time, wait_duration)
-                c = list(e)
-                # FIXME this is a hack to overwrite the stack_hash
-                c[-1] = stack_hash
-                held[e.tid][e.lock_hash].append(LockEvent(
-                    *c
-                ))
-
-                stack = [StackFrame(*f) for f in stacks[stack_hash]]
-                for frame in stack:
-                    if not frame.file.endswith(".py") or any(frame.file.endswith(f) for f in ("Lockable.py", "threading.py")):
-                        continue
-
-                    stat = file_stats[frame.file][frame.lineNo][e.lock_hash]
-                    if not stat.hits:
-                        all_stats.append(stat)
-                    stat.hits += 1
-                    if not stat._depth:
-                        stat.acquires += 1
-                    # TODO: not confident that depth will return to zero when it's supposed to...
-                    stat._depth += 1
-
-                    stat.total_wait_time += wait_duration
-                    stat.max_wait_time = max(stat.max_wait_time, wait_duration)
-
-            elif e.flag == PY_E_RELEASE:
-                print(f"{e.tid} r")
-                lock_stat = lock_stats[e.lock_hash]
-                # Held relies on the position of the matching acquire event
-                assert e.lock_hash in held[e.tid] and len(held[e.tid][e.lock_hash]), "No acquire event found for release event!"
-                acquire = held[e.tid][e.lock_hash].pop()
-                lock_stat._depth -= 1
-                assert lock_stat._depth >= 0
-
-                # if e.lock_hash in current_blocked:
-                #     block_duration = e.timestamp - current_blocked[e.lock_hash].timestamp
-                #     lock_stat.total_block_time += block_duration
-                #     lock_stat.max_block_time = max(lock_stat.max_block_time, block_duration)
-                #     del current_blocked[e.lock_hash]
-
-                hold_duration = e.timestamp - acquire.timestamp
-
-                # Note the lock may have been recursively acquired. Only compute the hold duration if it's released now
-                # if not len(held[e.tid][e.lock_hash]):
-                if not lock_stat._depth:
-                    lock_stat.total_hold_time += hold_duration
-                    lock_stat.max_hold_time = max(lock_stat.max_hold_time, hold_duration)
-
-                stack = [StackFrame(*f) for f in stacks[acquire.stack_hash]]
-                for frame in stack:
-                    if not frame.file.endswith(".py") or any(frame.file.endswith(f) for f in ("Lockable.py", "threading.py")):
-                        continue
-
-                    stat = file_stats[frame.file][frame.lineNo][acquire.lock_hash]
-                    stat._depth -= 1
-                    if not stat._depth:
-                        stat.total_hold_time += hold_duration
-                        stat.max_hold_time = max(stat.max_hold_time, hold_duration)
-
-        # TODO All depths should be at 0 during normal script execution. Verify this here
-        #  Note that if the profiling was turned on/off partway through the script, they may not return to 0
-
-        for lock_stat in all_stats:
-            lock_stat.avg_wait_time = lock_stat.total_wait_time // max(1, lock_stat.acquires)
-            lock_stat.avg_hold_time = lock_stat.total_hold_time // max(1, lock_stat.acquires)
-            lock_stat.avg_block_time = lock_stat.total_block_time // max(1, lock_stat.blocks)
-
-        # for lock_stat in lock_stats.values():
-        #     lock_stat.avg_acquire_time = lock_stat.total_acquire_time // lock_stat.hits
-        #     lock_stat.avg_hold_time = lock_stat.total_hold_time // lock_stat.hits
-        #
-        # for file_stat in file_stats.values():
-        #     for line_stat in file_stat.values():
-        #         for lock_stat in line_stat.values():
-        #             lock_stat.avg_acquire_time = lock_stat.total_acquire_time // lock_stat.hits
-        #             lock_stat.avg_hold_time = lock_stat.total_hold_time // lock_stat.hits
-
-        # Sort by total acquire time
-        lock_stats = dict(reversed(sorted(lock_stats.items(), key=lambda i: i[1].total_wait_time)))
+    atexit.register(_dump_stats_for_pycharm.__func__)
 
+    @staticmethod
+    def _write_pycharm_stats(filename, contention: ContentionStats, lock_hashes: typing.Dict[int, str]):
         output = {
-            "lock_stats": lock_stats,
-            "lock_hashes": lock_strs,
-            "file_stats": file_stats,
+            "lock_stats": contention.lock_stats,
+            "lock_hashes": lock_hashes,
+            "file_stats": contention.file_stats,
+            "uncontended": contention.uncontended,
         }
 
         class Encoder(json.JSONEncoder):
             def default(self, o):
                 if isinstance(o, Stat):  # dataclasses.is_dataclass(o):
-                    return dataclasses.astuple(o)[:-2]
+                    # The totals, then the wait, hold and block time percentiles, then the blame totals
+                    return o.summary()
                 return super().default(o)
 
-        with open(f"{LockProfiler._stats_filename}.pclprof", 'w') as fp:
+        with open(filename, 'w') as fp:
             json.dump(output, fp, indent=2, cls=Encoder)
 
-    atexit.register(_dump_stats_for_pycharm.__func__)
+    @staticmethod
+    def get_contention_stats() -> ContentionStats:
+        """Return the per-lock and per-call-site contention stats of what was recorded so far.
+
+        In aggregate-only mode (see `set_aggregate_only`) they are read from the counters, otherwise the recorded
+        events are analyzed.
+        """
+        # The events stay in C memory; the analysis reads them as columns
+        stats = LockProfiler.get_stats(as_array=True)
+        if LockProfiler.is_aggregate_only():
+            return from_aggregates(*LockProfiler.get_aggregates(), stats.stack_hashes, stats.uncontended_counts)
+        return analyze(stats)
+
+    @staticmethod
+    def serve_stats(address=("127.0.0.1", 0), **options) -> StatsServer:
+        """Serve the stats over HTTP while recording, from background threads. Returns the started `StatsServer`.
+
+        `address` is a (host, port) pair or the path of a Unix domain socket. See `live.StatsServer` for the
+        `options` and the endpoints. Stop it with `StatsServer.stop`.
+        """
+        return StatsServer(address, **options).start()
+
+    @staticmethod
+    def get_critical_path(intervals=None) -> CriticalPath:
+        """Return the critical path through the `(start, end[, tid])` intervals recorded so far, or the whole trace.
+
+        Mark the intervals with `LockProfiler.timestamp()`. Not available in aggregate-only mode.
+        """
+        return critical_paths(LockProfiler.get_stats(as_array=True), intervals or [(None, None)])
 
     @staticmethod
-    def dump_stats(filename):
-        stats = LockProfiler.get_stats()
+    def dump_stats(filename, stats: typing.Optional[LockStats] = None):
+        """Write `stats`, by default the current stats, to `filename`.
+
+        Files ending in `.lkprof` use the compact binary format (see `trace_file.py`), anything else is json.
+        """
+        if stats is None:
+            stats = LockProfiler.get_stats()
+
+        if str(filename).endswith(".lkprof"):
+            write_trace(filename, stats)
+            return
 
         with open(filename, "w") as f:
-            json.dump(stats.__dict__, f, indent=2)
+            json.dump({**stats.__dict__, "lock_list": list(stats.lock_list)}, f, indent=2)
+
+    @staticmethod
+    def load_stats(filename) -> LockStats:
+        """Load stats saved by `dump_stats` or `start_streaming`.
+
+        Binary traces are memory-mapped and streams are read lazily, so this is fast even for huge traces.
+        """
+        filename = str(filename)
+        if filename.endswith(".lkprof"):
+            return read_trace(filename)
+        with open(filename, "rb") as f:
+            is_stream = f.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+        if is_stream:
+            return read_event_stream(filename)
+
+        with open(filename) as f:
+            data = json.load(f)
+        return LockStats(
+            {int(k): v for k, v in data["lock_hashes"].items()},
+            {int(k): [StackFrame(*frame) for frame in v] for k, v in data["stack_hashes"].items()},
+            [LockEvent(*e) for e in data["lock_list"]],
+            data.get("wait_overhead", 0),
+            data.get("hold_overhead", 0),
+            {int(k): v for k, v in data.get("uncontended_counts", {}).items()},
+        )
+
+    @staticmethod
+    def visualize(filename=None):
+        """Write the current stats as a `.lkprof` trace and open it in the swimlane viewer, `vis/vis.html`.
+
+        With NumPy, the level-of-detail pyramid of the trace is written next to it (see `lod.py`), so that the viewer
+        only reads the visible part of the trace. Browsers may not let the viewer read local files by URL: the trace
+        can then be opened from the page, along with its `.lod` file.
+        """
+        if filename is None:
+            filename = os.path.join(tempfile.gettempdir(), f"{pathlib.Path(LockProfiler._stats_filename).name}.lkprof")
+        stats = LockProfiler.get_stats(as_array=True)
+        LockProfiler.dump_stats(filename, stats)
+        try:
+            write_lod(lod_filename(filename), build_lod(stats))
+        except ImportError:
+            pass
+        viewer = pathlib.Path(__file__).resolve().parent / "vis" / "vis.html"
+        trace_uri = pathlib.Path(filename).resolve().as_uri()
+        webbrowser.open(f"{viewer.as_uri()}?trace={urllib.parse.quote(trace_uri)}")
+        print(f"Wrote the trace to {filename}")
 
     @staticmethod
-    def visualize():
-        here = os.path.dirname(os.path.abspath(__file__))
-        filename = os.path.join(here, "output.json")
-        LockProfiler.dump_stats(filename)
-        uri = pathlib.Path(filename).as_uri()
-        html_path = os.path.join(here, "vis", "vis.html")
-        os.system(html_path)
-
-    def generate_html(self, filename):
+    def generate_html(filename, stats: typing.Optional[LockStats] = None):
         @dataclass
         class Style:
             style: dict
@@ -258,7 +196,7 @@ class LockProfiler(CLockProfiler):
         @dataclass
         class Div:
             cls: typing.List[str]
-            style: Style = Style({})
+            style: Style = dataclasses.field(default_factory=lambda: Style({}))
             children: typing.List[typing.Union['Div', str]] = ()
 
             def as_html(self, nesting=0):
@@ -305,16 +243,18 @@ class LockProfiler(CLockProfiler):
         THREAD_HEIGHT = 30
         X_OFFSET = 200
 
-        stats = self.get_stats()
+        if stats is None:
+            stats = LockProfiler.get_stats()
         lock_strs = stats.lock_hashes
         stacks = stats.stack_hashes
         events = stats.lock_list
 
-        # events is a list of `CLockTime` events, unsorted. The events of each thread are guaranteed to be sorted by
+        # events is a list of `LockEvent`s, unsorted. The events of each thread are guaranteed to be sorted by
         #  timestamp, increasing.
         # Event types:
-        #  acquire: includes start timestamp, duration, tid, lock hash, stack hash
-        #  release: includes timestamp, tid, lock hash. duration = -1
+        #  wait: a thread starts acquiring a lock, includes the stack hash
+        #  acquire: the lock was acquired by the thread of the previous wait
+        #  release: the lock was released
 
         # Each thread is a separate swimlane row in the html. The x-axis of the html corresponds to time passed
         # The swimlane contains colored divs indicating the state of the thread for that duration of time. If multiple
@@ -378,16 +318,18 @@ class LockProfiler(CLockProfiler):
 
         # timelines: typing.Dict[int: typing.List[LockTime]] = defaultdict(lambda: [])
 
-        # Scratchpad to hold acquire events while waiting for a release event
+        # Scratchpad to hold acquire timestamps while waiting for a release event
         # {tid: {lock_hash: [first acquire, next acquire, ...]}}
-        held: typing.DefaultDict[int, typing.DefaultDict[int, typing.List[LockEvent]]] = defaultdict(lambda: defaultdict(lambda: []))
+        held: typing.DefaultDict[int, typing.DefaultDict[int, typing.List[int]]] = defaultdict(lambda: defaultdict(lambda: []))
+        # Timestamp of the pending wait of each thread
+        waiting: typing.Dict[int, int] = {}
         # divs: typing.List[Div] = []
 
         # TODO can we remove this loop? Timestamp of the first event may not be the earliest
         t_off = min(e.timestamp for e in events)
 
         for e in events:
-            e.timestamp -= t_off
+            timestamp = e.timestamp - t_off
 
             if e.tid not in thread_positions:
                 thread_positions[e.tid] = THREAD_SPACING + (len(thread_positions) * (THREAD_HEIGHT + THREAD_SPACING))
@@ -398,28 +340,28 @@ class LockProfiler(CLockProfiler):
 
             classes = [EVENT_CLS, lock_class(e.lock_hash), thread_class(e.tid)]
 
-            if e.duration >= 0:
-                # Acquires are easy to generate; they're contained within one event
-                x = get_x(e.timestamp)
-                w = get_x(e.duration)
+            if e.flag & PY_E_MASK == PY_E_WAIT:
+                waiting[e.tid] = timestamp
+                continue
+
+            if e.flag & PY_E_MASK == PY_E_ACQUIRE:
+                # Acquires span from the wait to the acquire event
+                start = waiting.pop(e.tid, timestamp)
+                x = get_x(start)
+                w = get_x(timestamp - start)
                 z = ACQUIRE_Z
-                # # TODO this is probably actually ok since using RLock, but we'll need a different way to handle storing held locks
-                # assert e.lock_hash not in held[e.tid], "Lock acquired while already held!"
-                held[e.tid][e.lock_hash].append(e)
+                held[e.tid][e.lock_hash].append(timestamp)
                 classes.append(ACQUIRE_CLS)
 
             else:
                 # Held relies on the position of the matching acquire event
-
-                # find the matching acquire event
-                assert e.lock_hash in held[e.tid] and len(held[e.tid][e.lock_hash]), "No acquire event found for release event!"
-                acquire = held[e.tid][e.lock_hash].pop()
-                # # remove the acquire event
-                # del held[e.tid][e.lock_hash]
+                if not held[e.tid][e.lock_hash]:
+                    # Acquired before recording started
+                    continue
                 # Start at the end of the acquire
-                start = acquire.timestamp + acquire.duration
+                start = held[e.tid][e.lock_hash].pop()
                 x = get_x(start)
-                w = get_x(e.timestamp - start)
+                w = get_x(timestamp - start)
                 z = HELD_Z
                 classes.append(HELD_CLS)
 
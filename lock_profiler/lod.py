@@ -0,0 +1,403 @@
+"""
+Level-of-detail tile pyramid of a trace, for the timeline viewer (``vis/``).
+
+Each thread's timeline is summarized in buckets of time: how much of the
+bucket the thread spent holding at least one lock, waiting, and blocked, and
+the lock it held most. Level 0 buckets span `bucket_width` ns, about 16 events'
+worth; each level above merges pairs of buckets, up to a level where the whole
+trace fits in a single tile of `tile_buckets` buckets. A viewer showing one
+bucket per pixel only needs the tiles of the visible window at one level, so
+what it reads and draws is bounded by the screen size, not the trace size.
+
+Only the tiles a thread was active in are computed and kept, so building the
+pyramid takes memory in proportion to the threads' activity, not to the number
+of threads times the trace duration.
+
+The pyramid is stored next to the trace as ``<trace>.lod``, little-endian::
+
+    header   magic "LKLOD\\0\\0\\0", uint32 version, uint32 lane count, uint32 level count,
+             uint32 buckets per tile, int64 start timestamp, int64 level 0 bucket width,
+             int64 trace duration, uint64 lock count, uint64 tile count
+    lanes    (int64 tid, int64 rows) per thread, rows being its deepest nesting of waits and holds
+    locks    (int64 lock hash, int64 total hold time, int64 total blocked time) per lock
+    index    (uint32 level, uint32 lane, uint64 tile, uint64 offset) per tile, sorted
+    tiles    uint8 hold, wait and blocked share of each bucket in 255ths, then int32 lock hash held the most
+             in each bucket, -1 if none; tiles without any activity are left out
+
+Lanes are in the order of the threads' first events, like the viewer's.
+"""
+import struct
+import sys
+import typing
+from dataclasses import dataclass, field
+
+from ._lock_profiler import LockStats, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_E_MASK, PY_F_BLOCKED
+from .analysis import event_columns
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+MAGIC = b"LKLOD\0\0\0"
+VERSION = 1
+TILE_BUCKETS = 1024
+# Events per level 0 bucket, on average
+EVENTS_PER_BUCKET = 16
+KINDS = ("hold", "wait", "blocked")
+
+_HEADER = struct.Struct("<8sIIIIqqqQQ")
+_INDEX_DTYPE = [("level", "<u4"), ("lane", "<u4"), ("tile", "<u8"), ("offset", "<u8")]
+
+
+@dataclass
+class Level:
+    # Per lane: sorted indices of the tiles with any activity. The other tiles are empty
+    tiles: typing.List["np.ndarray"] = field(default_factory=list)
+    # Per lane: time spent in each of `KINDS` per bucket of those tiles, in ns, as (tile, bucket) arrays
+    coverage: typing.List[typing.Dict[str, "np.ndarray"]] = field(default_factory=list)
+    # Per lane: lock hash held the most per bucket of those tiles, -1 if none
+    lock: typing.List["np.ndarray"] = field(default_factory=list)
+
+
+@dataclass
+class Pyramid:
+    # Timestamp of the start of the first bucket
+    start: int
+    duration: int
+    bucket_width: int
+    # (tid, rows) per lane
+    lanes: typing.List[typing.Tuple[int, int]]
+    # {lock_hash: (total hold time, total blocked time)}
+    lock_totals: typing.Dict[int, typing.Tuple[int, int]]
+    levels: typing.List[Level]
+    tile_buckets: int = TILE_BUCKETS
+
+    def tiles(self) -> typing.Iterator[typing.Tuple[int, int, int, typing.Dict[str, "np.ndarray"]]]:
+        """`(level, lane, tile, {"hold", "wait", "blocked": uint8 shares, "lock": int32})` of the non-empty tiles."""
+        for level_index, level in enumerate(self.levels):
+            width = self.bucket_width << level_index
+            for lane, (tiles, coverage, lock) in enumerate(zip(level.tiles, level.coverage, level.lock)):
+                for row, tile in enumerate(tiles.tolist()):
+                    shares = {kind: _share(coverage[kind][row], width) for kind in KINDS}
+                    if any(shares[kind].any() for kind in KINDS):
+                        shares["lock"] = lock[row].astype("<i4")
+                        yield level_index, lane, tile, shares
+
+
+def _share(coverage, width):
+    """Share of the bucket covered, in 255ths, at least 1 when anything is covered so it stays visible."""
+    share = np.minimum((coverage * 255 + width // 2) // width, 255)
+    return np.where(coverage > 0, np.maximum(share, 1), 0).astype(np.uint8)
+
+
+def lod_filename(trace_filename) -> str:
+    return f"{trace_filename}.lod"
+
+
+def _group_depth(keys, delta):
+    """Running sum of `delta` within runs of equal `keys`, never below 0: unmatched decrements are dropped."""
+    new_group = np.r_[True, keys[1:] != keys[:-1]] if len(keys) else np.zeros(0, dtype=bool)
+    group = np.cumsum(new_group) - 1
+    total = np.cumsum(delta)
+    depth = total - (total - delta)[new_group][group]
+    # Offset each group so the running minimum doesn't carry over from the previous group
+    offset = group * (2 * len(delta) + 2)
+    floor = np.minimum(np.minimum.accumulate(depth - offset) + offset, 0)
+    return depth - floor, new_group
+
+
+def _spans(keys, index, delta, end):
+    """Where the depth of each key goes from 0 up and back to 0: (first event, last event) index pairs.
+
+    `keys`, `index` and `delta` must be sorted by key, then index. Spans that never end last until `end`.
+    """
+    depth, new_group = _group_depth(keys, delta)
+    before = np.r_[0, depth[:-1]]
+    before[new_group] = 0
+    opens = np.flatnonzero((before == 0) & (depth > 0))
+    closes = np.flatnonzero((before > 0) & (depth == 0))
+    # Each open is closed by the next close of the same key, if any
+    pos = np.searchsorted(closes, opens)
+    closed = pos < len(closes)
+    closed[closed] = keys[closes[pos[closed]]] == keys[opens[closed]]
+    close_index = np.full(len(opens), end)
+    close_index[closed] = index[closes[pos[closed]]]
+    return opens, close_index
+
+
+def _active_tiles(starts, ends, tile_width):
+    """Sorted indices of the tiles overlapped by any of the spans."""
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    first, last = starts // tile_width, (ends - 1) // tile_width
+    order = np.argsort(first, kind="stable")
+    first, last = first[order], last[order]
+    # Merge the ranges of tiles into runs, each starting past the end of the ranges before it
+    reach = np.maximum.accumulate(last)
+    new_run = np.r_[True, first[1:] > reach[:-1]]
+    run_first = first[new_run]
+    run_last = reach[np.r_[np.flatnonzero(new_run)[1:] - 1, len(first) - 1]]
+    lengths = run_last - run_first + 1
+    return np.repeat(run_first - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def _coverage(starts, ends, buckets, width):
+    """Time covered in each of `buckets` by non-overlapping spans, sorted by start, relative to bucket 0."""
+    if not len(starts):
+        return np.zeros(len(buckets), dtype=np.int64)
+    cumulative = np.r_[0, np.cumsum(ends - starts)]
+
+    def covered(bounds):
+        k = np.searchsorted(ends, bounds, side="right")
+        partial = np.where(k < len(starts), bounds - starts[np.minimum(k, len(starts) - 1)], 0)
+        return cumulative[k] + np.maximum(partial, 0)
+
+    return covered((buckets + 1) * width) - covered(buckets * width)
+
+
+def _dominant(starts, ends, labels, buckets, width):
+    """Label of the span overlapping each of `buckets`, sorted, the most, -1 where none does.
+
+    Every span must start and end in `buckets`.
+    """
+    dominant = np.full(len(buckets), -1, dtype=np.int64)
+    if not len(starts):
+        return dominant
+    first = starts // width
+    last = (ends - 1) // width
+    # Candidates: the partial first and last buckets of each span, and the span covering each bucket's middle
+    middle = buckets * width + width // 2
+    j = np.minimum(np.searchsorted(ends, middle, side="right"), len(starts) - 1)
+    covers = (starts[j] <= middle) & (ends[j] > middle)
+    candidates = np.r_[first, last, buckets[covers]]
+    spans = np.r_[np.arange(len(starts)), np.arange(len(starts)), j[covers]]
+    overlap = np.minimum(ends[spans], (candidates + 1) * width) - np.maximum(starts[spans], candidates * width)
+    order = np.lexsort((overlap, candidates))
+    candidates, spans = candidates[order], spans[order]
+    # The last candidate of each bucket overlaps the most
+    is_last = np.r_[candidates[1:] != candidates[:-1], True]
+    dominant[np.searchsorted(buckets, candidates[is_last])] = labels[spans[is_last]]
+    return dominant
+
+
+def build_lod(stats: LockStats, tile_buckets: int = TILE_BUCKETS, bucket_width: typing.Optional[int] = None) -> Pyramid:
+    """Summarize `stats` in a tile pyramid. Requires NumPy.
+
+    By default level 0 buckets span a power of two of ns holding about `EVENTS_PER_BUCKET` events.
+    """
+    if np is None:
+        raise ImportError("Building the level-of-detail pyramid requires NumPy")
+    cols = event_columns(stats.lock_list)
+    ts, raw_flag, tid, lock = (np.asarray(cols[name], dtype=np.int64) for name in ("timestamp", "flag", "tid", "lock_hash"))
+    n = len(ts)
+    if n and np.any(ts[1:] < ts[:-1]):
+        order = np.argsort(ts, kind="stable")
+        ts, raw_flag, tid, lock = ts[order], raw_flag[order], tid[order], lock[order]
+    start = int(ts[0]) if n else 0
+    duration = int(ts[-1]) - start if n else 0
+    if bucket_width is None:
+        target = max(duration * EVENTS_PER_BUCKET // max(n, 1), 1)
+        bucket_width = 1 << (target - 1).bit_length()
+    rel = ts - start
+    # Index standing for the end of the trace
+    end_index = n
+    rel_end = np.r_[rel, duration]
+    flag = raw_flag & PY_E_MASK
+    is_acquire = flag == PY_E_ACQUIRE
+    is_release = flag == PY_E_RELEASE
+    index = np.arange(n)
+
+    # Per lock: outermost holds, and the last acquiring thread, which holds it while its depth is above 0
+    order = np.lexsort((index, lock))
+    l_lock, l_index = lock[order], index[order]
+    l_delta = np.where(is_acquire[order], 1, np.where(is_release[order], -1, 0))
+    lock_depth, new_lock = _group_depth(l_lock, l_delta)
+    depth_before = np.r_[0, lock_depth[:-1]]
+    depth_before[new_lock] = 0
+    last_acquire = np.where(l_delta > 0, np.arange(n), -1)
+    last_acquire = np.maximum.accumulate(last_acquire) if n else last_acquire
+    group_start = np.flatnonzero(new_lock)[np.cumsum(new_lock) - 1] if n else last_acquire
+    holder = np.where(last_acquire >= group_start, tid[l_index[np.maximum(last_acquire, 0)]], -1) if n else last_acquire
+    waits = flag[l_index] == PY_E_WAIT
+    blocked = np.zeros(n, dtype=bool)
+    blocked[l_index[waits]] = (depth_before[waits] > 0) & (holder[waits] != tid[l_index[waits]])
+    blocked |= (raw_flag & PY_F_BLOCKED) != 0
+
+    opens, closes = _spans(l_lock, l_index, l_delta, end_index)
+    hold_time = rel_end[closes] - rel[l_index[opens]]
+    lock_hold = _sums(l_lock[opens], hold_time)
+
+    # Per thread, sorted by first event
+    order = np.lexsort((index, tid))
+    t_tid, t_index = tid[order], index[order]
+    t_flag = flag[t_index]
+    # A wait lasts until the next wait or acquire of its thread
+    wa = np.flatnonzero(t_flag != PY_E_RELEASE)
+    wait_end = np.full(n, end_index)
+    next_same = np.flatnonzero(t_tid[wa[1:]] == t_tid[wa[:-1]])
+    wait_end[t_index[wa[next_same]]] = t_index[wa[next_same + 1]]
+    wait_events = np.flatnonzero(flag == PY_E_WAIT)
+    lock_blocked = _sums(lock[wait_events[blocked[wait_events]]], (
+        rel_end[wait_end[wait_events]] - rel[wait_events]
+    )[blocked[wait_events]])
+
+    t_delta = np.where(is_acquire[t_index], 1, np.where(is_release[t_index], -1, 0))
+    thread_depth, _ = _group_depth(t_tid, t_delta)
+    busy_open, busy_close = _spans(t_tid, t_index, t_delta, end_index)
+
+    first_seen = np.unique(tid, return_index=True)[1] if n else np.zeros(0, dtype=np.intp)
+    lane_tids = tid[np.sort(first_seen)].tolist()
+    lane_of = {t: i for i, t in enumerate(lane_tids)}
+    thread_starts = np.flatnonzero(np.r_[True, t_tid[1:] != t_tid[:-1]]) if n else np.zeros(0, dtype=np.intp)
+    max_depth = np.maximum.reduceat(thread_depth, thread_starts) if n else np.zeros(0, dtype=np.int64)
+    lanes = [None] * len(lane_tids)
+    for thread, depth in zip(t_tid[thread_starts].tolist(), max_depth.tolist()):
+        # A wait takes one more row above the held locks
+        lanes[lane_of[thread]] = (thread, depth + 1)
+
+    n_buckets = duration // bucket_width + 1
+    tile_width = bucket_width * tile_buckets
+    level = Level()
+    # Events of each thread are contiguous in the per thread order
+    busy_tid = t_tid[busy_open]
+    t_waits = np.flatnonzero(t_flag == PY_E_WAIT)
+    wait_tid = t_tid[t_waits]
+    for thread in lane_tids:
+        spans = {}
+        busy = busy_open[np.searchsorted(busy_tid, thread):np.searchsorted(busy_tid, thread, side="right")]
+        busy_end = busy_close[np.searchsorted(busy_tid, thread):np.searchsorted(busy_tid, thread, side="right")]
+        spans["hold"] = (rel[t_index[busy]], rel_end[busy_end], lock[t_index[busy]])
+        thread_waits = t_index[t_waits[np.searchsorted(wait_tid, thread):np.searchsorted(wait_tid, thread, side="right")]]
+        for kind, mask in (("wait", ~blocked[thread_waits]), ("blocked", blocked[thread_waits])):
+            w = thread_waits[mask]
+            spans[kind] = (rel[w], rel_end[wait_end[w]], lock[w])
+        for kind, (s, e, labels) in spans.items():
+            keep = e > s
+            spans[kind] = s[keep], e[keep], labels[keep]
+        tiles = _active_tiles(*(np.concatenate([spans[kind][i] for kind in KINDS]) for i in range(2)), tile_width)
+        # Only the buckets of the active tiles
+        buckets = (tiles[:, None] * tile_buckets + np.arange(tile_buckets)).reshape(-1)
+        coverage = {}
+        for kind, (s, e, labels) in spans.items():
+            coverage[kind] = _coverage(s, e, buckets, bucket_width).reshape(-1, tile_buckets)
+            if kind == "hold":
+                level.lock.append(_dominant(s, e, labels, buckets, bucket_width).reshape(-1, tile_buckets))
+        level.tiles.append(tiles)
+        level.coverage.append(coverage)
+
+    levels = [level]
+    while len(levels) < 63 and (n_buckets + (1 << (len(levels) - 1)) - 1) >> (len(levels) - 1) > tile_buckets:
+        levels.append(_merge(levels[-1]))
+    return Pyramid(
+        start, duration, bucket_width, lanes,
+        {k: (lock_hold.get(k, 0), lock_blocked.get(k, 0)) for k in np.unique(lock).tolist()},
+        levels, tile_buckets,
+    )
+
+
+def _sums(keys, values) -> typing.Dict[int, int]:
+    if not len(keys):
+        return {}
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return dict(zip(unique.tolist(), np.bincount(inverse.reshape(-1), weights=values).astype(np.int64).tolist()))
+
+
+def _merge(level: Level) -> Level:
+    """The level above: pairs of buckets merged, with the lock of the half holding locks the longest.
+
+    Tiles `2 * t` and `2 * t + 1` make tile `t` of the level above.
+    """
+    merged = Level()
+    for tiles, coverage, lock in zip(level.tiles, level.coverage, level.lock):
+        parents, row = np.unique(tiles // 2, return_inverse=True)
+        half = tiles % 2
+
+        def join(values, fill):
+            # The buckets of both children of each parent, one after the other
+            joined = np.full((len(parents), 2, values.shape[1]), fill, dtype=values.dtype)
+            joined[row.reshape(-1), half] = values
+            return joined.reshape(len(parents), -1)
+
+        coverage = {kind: join(values, 0) for kind, values in coverage.items()}
+        lock = join(lock, -1)
+        merged.tiles.append(parents)
+        merged.coverage.append({kind: values[:, 0::2] + values[:, 1::2] for kind, values in coverage.items()})
+        hold = coverage["hold"]
+        merged.lock.append(np.where(hold[:, 1::2] > hold[:, 0::2], lock[:, 1::2], lock[:, 0::2]))
+    return merged
+
+
+def write_lod(filename, pyramid: Pyramid):
+    """Write `pyramid` to `filename`, see the module docstring for the layout."""
+    tiles = list(pyramid.tiles())
+    locks = np.array([(k, *v) for k, v in pyramid.lock_totals.items()], dtype="<i8").reshape(-1, 3)
+    lanes = np.array(pyramid.lanes, dtype="<i8").reshape(-1, 2)
+    index = np.zeros(len(tiles), dtype=_INDEX_DTYPE)
+    tile_size = 7 * pyramid.tile_buckets
+    data_offset = _HEADER.size + lanes.nbytes + locks.nbytes + index.nbytes
+    for i, (level, lane, tile, _) in enumerate(tiles):
+        index[i] = (level, lane, tile, data_offset + i * tile_size)
+    with open(filename, "wb") as f:
+        f.write(_HEADER.pack(
+            MAGIC, VERSION, len(pyramid.lanes), len(pyramid.levels), pyramid.tile_buckets,
+            pyramid.start, pyramid.bucket_width, pyramid.duration, len(locks), len(tiles),
+        ))
+        f.write(lanes.tobytes())
+        f.write(locks.tobytes())
+        f.write(index.tobytes())
+        for _, _, _, shares in tiles:
+            for kind in KINDS:
+                f.write(shares[kind].tobytes())
+            f.write(shares["lock"].tobytes())
+
+
+class LodFile:
+    """Reader of a `.lod` file, loading tiles on demand."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            header = _HEADER.unpack(f.read(_HEADER.size))
+            magic, version, n_lanes, n_levels, self.tile_buckets, self.start, self.bucket_width, self.duration, \
+                n_locks, n_tiles = header
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{filename} is not a supported .lod file")
+            self.n_levels = n_levels
+            lanes = np.frombuffer(f.read(16 * n_lanes), dtype="<i8").reshape(-1, 2)
+            self.lanes = [tuple(lane) for lane in lanes.tolist()]
+            locks = np.frombuffer(f.read(24 * n_locks), dtype="<i8").reshape(-1, 3)
+            self.lock_totals = {lock: (hold, blocked) for lock, hold, blocked in locks.tolist()}
+            index = np.frombuffer(f.read(np.dtype(_INDEX_DTYPE).itemsize * n_tiles), dtype=_INDEX_DTYPE)
+        self.filename = filename
+        self._offsets = {(int(i["level"]), int(i["lane"]), int(i["tile"])): int(i["offset"]) for i in index}
+
+    def tile(self, level: int, lane: int, tile: int) -> typing.Optional[typing.Dict[str, "np.ndarray"]]:
+        """The shares and locks of a tile, see `Pyramid.tiles`, or None if it's empty."""
+        offset = self._offsets.get((level, lane, tile))
+        if offset is None:
+            return None
+        t = self.tile_buckets
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            data = f.read(7 * t)
+        tile_data = {kind: np.frombuffer(data, dtype=np.uint8, count=t, offset=i * t) for i, kind in enumerate(KINDS)}
+        tile_data["lock"] = np.frombuffer(data, dtype="<i4", count=t, offset=3 * t)
+        return tile_data
+
+
+def main(argv=None):
+    """Write the `.lod` file of each `.lkprof` trace given on the command line."""
+    from .trace_file import read_trace
+
+    filenames = sys.argv[1:] if argv is None else argv
+    if not filenames:
+        print("usage: python -m lock_profiler.lod TRACE.lkprof...", file=sys.stderr)
+        return 2
+    for filename in filenames:
+        write_lod(lod_filename(filename), build_lod(read_trace(filename)))
+        print(f"Wrote {lod_filename(filename)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
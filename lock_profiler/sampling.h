@@ -0,0 +1,156 @@
+/* Random sampling of lock acquisitions, see `LockProfiler.set_sampling`.
+ *
+ * Each acquisition is sampled with probability 2^-shift, so its weight in the
+ * estimates of the analysis is 2^shift, recorded in the flag of its wait event.
+ * The shift of a lock is its own rate if set, the global rate otherwise, and,
+ * with a budget, at least what keeps the lock's sampled acquisitions per second
+ * under the budget, as measured over the previous window. The shift only
+ * depends on the past, so the weighted totals are unbiased.
+ *
+ * All functions must be called with the GIL held.
+ */
+#ifndef LOCK_PROFILER_SAMPLING_H
+#define LOCK_PROFILER_SAMPLING_H
+
+#include "Python.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <vector>
+
+/* Largest shift, so it fits in the 5 flag bits */
+#define SAMPLING_MAX_SHIFT 31
+/* Window over which the acquisition rate of a lock is measured for the budget, in ns */
+#define SAMPLING_WINDOW 100000000LL
+
+struct SamplingLock {
+    /* Shift set for this lock, or -1 to use the global one */
+    int own_shift;
+    /* Shift derived from the budget */
+    int budget_shift;
+    PY_LONG_LONG window_start;
+    int64_t window_count;
+};
+
+/* Indexed by lock ID */
+static std::vector<SamplingLock> _sampling_locks;
+static bool _sampling_enabled = false;
+static int _sampling_shift = 0;
+/* Sampled acquisitions per second per lock, 0 for no budget */
+static double _sampling_budget = 0;
+static uint64_t _sampling_rng = 0x9E3779B97F4A7C15ULL;
+
+static inline SamplingLock&
+_sampling_lock(int64_t lock_id)
+{
+    if ((size_t)lock_id >= _sampling_locks.size()) {
+        _sampling_locks.resize(std::max((size_t)lock_id + 1, 2 * _sampling_locks.size()), SamplingLock{-1, 0, 0, 0});
+    }
+    return _sampling_locks[lock_id];
+}
+
+/* xorshift64* */
+static inline uint64_t
+_sampling_random()
+{
+    _sampling_rng ^= _sampling_rng >> 12;
+    _sampling_rng ^= _sampling_rng << 25;
+    _sampling_rng ^= _sampling_rng >> 27;
+    return _sampling_rng * 0x2545F4914F6CDD1DULL;
+}
+
+static inline void
+_sampling_update_budget(SamplingLock& lock, PY_LONG_LONG now)
+{
+    lock.window_count += 1;
+    PY_LONG_LONG elapsed = now - lock.window_start;
+    if (elapsed < SAMPLING_WINDOW) {
+        return;
+    }
+    double rate = lock.window_count * 1e9 / (double)elapsed;
+    int shift = rate > _sampling_budget ? (int)std::ceil(std::log2(rate / _sampling_budget)) : 0;
+    lock.budget_shift = std::min(shift, SAMPLING_MAX_SHIFT);
+    lock.window_start = now;
+    lock.window_count = 0;
+}
+
+static void
+_sampling_update_enabled()
+{
+    _sampling_enabled = _sampling_shift > 0 || _sampling_budget > 0;
+    for (SamplingLock& lock : _sampling_locks) {
+        _sampling_enabled = _sampling_enabled || lock.own_shift > 0;
+    }
+}
+
+/* Return the shift of an acquisition that is sampled, or -1 if it isn't. `now` is only used with a budget. */
+static inline int
+sampling_decide(int64_t lock_id, PY_LONG_LONG now)
+{
+    SamplingLock& lock = _sampling_lock(lock_id);
+    int shift = lock.own_shift >= 0 ? lock.own_shift : _sampling_shift;
+    if (_sampling_budget > 0) {
+        _sampling_update_budget(lock, now);
+        shift = std::max(shift, lock.budget_shift);
+    }
+    // Sampled if the top `shift` bits are all 0
+    if (shift > 0 && (_sampling_random() >> (64 - shift)) != 0) {
+        return -1;
+    }
+    return shift;
+}
+
+static inline bool
+sampling_is_enabled()
+{
+    return _sampling_enabled;
+}
+
+static inline bool
+sampling_has_budget()
+{
+    return _sampling_budget > 0;
+}
+
+static void
+sampling_configure(int shift, double budget, uint64_t seed)
+{
+    _sampling_shift = shift;
+    _sampling_budget = budget;
+    // splitmix64 of the seed, as xorshift needs a few rounds to mix a small nonzero state
+    uint64_t z = seed + 0x9E3779B97F4A7C15ULL;
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    z ^= z >> 31;
+    _sampling_rng = z ? z : 0x9E3779B97F4A7C15ULL;
+    for (SamplingLock& lock : _sampling_locks) {
+        lock.budget_shift = 0;
+        lock.window_start = 0;
+        lock.window_count = 0;
+    }
+    _sampling_update_enabled();
+}
+
+static void
+sampling_set_lock_shift(int64_t lock_id, int shift)
+{
+    _sampling_lock(lock_id).own_shift = shift;
+    _sampling_update_enabled();
+}
+
+/* Forget the settings and budget window of a lock, whose ID is given to a new one */
+static void
+sampling_reset_lock(int64_t lock_id)
+{
+    if ((size_t)lock_id >= _sampling_locks.size()) {
+        return;
+    }
+    bool had_shift = _sampling_locks[lock_id].own_shift > 0;
+    _sampling_locks[lock_id] = SamplingLock{-1, 0, 0, 0};
+    if (had_shift) {
+        _sampling_update_enabled();
+    }
+}
+
+#endif
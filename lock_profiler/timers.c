@@ -8,6 +8,27 @@
 
 /*** Selection of a high-precision timer ***/
 
+/* Timer backends. All of them count nanoseconds, except on Windows and OS/2 where only the default exists. */
+#define HP_TIMER_MONOTONIC 0
+#define HP_TIMER_MONOTONIC_RAW 1
+#define HP_TIMER_TSC 2
+
+#if defined(MS_WINDOWS) || (defined(PYOS_OS2) && defined(PYCC_GCC))
+
+int
+hpTimerSetBackend(int backend)
+{
+        return backend == HP_TIMER_MONOTONIC ? 0 : -1;
+}
+
+int
+hpTimerBackend(void)
+{
+        return HP_TIMER_MONOTONIC;
+}
+
+#endif
+
 #ifdef MS_WINDOWS
 
 #include <windows.h>
@@ -57,15 +78,79 @@ hpTimerUnit(void)
 
 #include <sys/resource.h>
 #include <sys/times.h>
+#include <time.h>
+
+#if defined(__x86_64__) && defined(__linux__)
+#define HAVE_TSC_TIMER 1
+#include <cpuid.h>
+#include <x86intrin.h>
+#endif
+
+static int _hpTimerBackend = HP_TIMER_MONOTONIC;
+
+static PY_LONG_LONG
+_clockNs(clockid_t clock)
+{
+        struct timespec ts;
+        clock_gettime(clock, &ts);
+        return (PY_LONG_LONG)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+#ifdef HAVE_TSC_TIMER
+
+/* Conversion from TSC ticks to CLOCK_MONOTONIC nanoseconds, as 32.32 fixed point */
+static unsigned long long _tscBase = 0;
+static PY_LONG_LONG _tscBaseNs = 0;
+static unsigned long long _tscNsPerTick = 0;
+
+static inline PY_LONG_LONG
+_tscNs(void)
+{
+        long long ticks = (long long)(__rdtsc() - _tscBase);
+        return _tscBaseNs + (PY_LONG_LONG)(((__int128)ticks * (__int128)_tscNsPerTick) >> 32);
+}
+
+/* Only an invariant TSC ticks at a constant rate, across cores and power states */
+static int
+_tscCalibrate(void)
+{
+        unsigned int eax, ebx, ecx, edx;
+        if (!__get_cpuid(0x80000007, &eax, &ebx, &ecx, &edx) || !(edx & (1 << 8))) {
+                return -1;
+        }
+        PY_LONG_LONG start_ns = _clockNs(CLOCK_MONOTONIC);
+        unsigned long long start = __rdtsc();
+        PY_LONG_LONG end_ns;
+        do {
+                end_ns = _clockNs(CLOCK_MONOTONIC);
+        } while (end_ns - start_ns < 20000000);
+        unsigned long long end = __rdtsc();
+        if (end <= start) {
+                return -1;
+        }
+        _tscNsPerTick = (unsigned long long)(((unsigned __int128)(end_ns - start_ns) << 32) / (end - start));
+        _tscBase = end;
+        _tscBaseNs = end_ns;
+        return 0;
+}
+
+#endif
 
 PY_LONG_LONG
 hpTimer(void)
 {
-        struct timespec ts;
-        PY_LONG_LONG ret;
-        clock_gettime(CLOCK_MONOTONIC, &ts);
-        ret = ts.tv_sec * 1000000000 + ts.tv_nsec;
-        return ret;
+        switch (_hpTimerBackend) {
+#ifdef HAVE_TSC_TIMER
+        case HP_TIMER_TSC:
+                return _tscNs();
+#endif
+#ifdef CLOCK_MONOTONIC_RAW
+        case HP_TIMER_MONOTONIC_RAW:
+                return _clockNs(CLOCK_MONOTONIC_RAW);
+#endif
+        default:
+                return _clockNs(CLOCK_MONOTONIC);
+        }
 }
 
 double
@@ -74,4 +159,34 @@ hpTimerUnit(void)
         return 0.000000001;
 }
 
+int
+hpTimerSetBackend(int backend)
+{
+        switch (backend) {
+        case HP_TIMER_MONOTONIC:
+                break;
+#ifdef CLOCK_MONOTONIC_RAW
+        case HP_TIMER_MONOTONIC_RAW:
+                break;
+#endif
+#ifdef HAVE_TSC_TIMER
+        case HP_TIMER_TSC:
+                if (_tscCalibrate() != 0) {
+                        return -1;
+                }
+                break;
+#endif
+        default:
+                return -1;
+        }
+        _hpTimerBackend = backend;
+        return 0;
+}
+
+int
+hpTimerBackend(void)
+{
+        return _hpTimerBackend;
+}
+
 #endif
@@ -2,3 +2,5 @@
 
 PY_LONG_LONG hpTimer(void);
 double hpTimerUnit(void);
+int hpTimerSetBackend(int backend);
+int hpTimerBackend(void);
@@ -0,0 +1,385 @@
+"""
+Export of recorded events to the Chrome Trace Event JSON and Perfetto protobuf formats.
+
+Waits, blocked waits and holds become duration slices named after their lock,
+with the lock name and the call stack as args. As in the swimlane viewer
+(`vis/`), each thread gets a track per nesting depth, and each slice goes on
+the first track free when it starts: slices of locks released out of order
+never overlap on a track, which both formats require. Timestamps are the
+recorder's, in ns.
+
+The events are read in order and each slice is written when it ends, so memory
+use is bounded by the number of threads, locks and distinct stacks, not the
+number of events: traces read lazily (`LockProfiler.load_stats` of a `.lkprof`
+file or an event stream) export in constant memory.
+
+Chrome JSON has no notion of nested tracks, so each thread shows as a process
+of its own there, named after the thread, with a thread per depth. It loads in
+`chrome://tracing` and https://ui.perfetto.dev, which also loads the protobuf
+traces. Files ending in `.gz` are compressed.
+"""
+import gzip
+import itertools
+import json
+import sys
+import typing
+from argparse import ArgumentParser
+
+from ._lock_profiler import LockStats, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_E_MASK, PY_F_BLOCKED
+
+KIND_WAIT = "wait"
+KIND_BLOCKED = "blocked"
+KIND_HOLD = "hold"
+# Slices formatted per write
+_BATCH = 4096
+
+
+class _Slicer:
+    """Pairs events into slices, assigning each one a depth within its thread."""
+
+    def __init__(self):
+        # {tid: [whether a slice is open, per depth]}
+        self.busy = {}
+        # {tid: (start, kind, lock, stack, depth)}
+        self.waits = {}
+        # {tid: [(start, lock, stack, depth)]}
+        self.held = {}
+        # {lock: [holder tid, depth]}
+        self.holders = {}
+        # Callbacks for a new thread and a new depth of a thread
+        self.on_thread = None
+        self.on_depth = None
+
+    def _free_depth(self, tid):
+        busy = self.busy.get(tid)
+        if busy is None:
+            busy = self.busy[tid] = []
+            self.held[tid] = []
+            self.on_thread(tid)
+        for depth, is_busy in enumerate(busy):
+            if not is_busy:
+                break
+        else:
+            depth = len(busy)
+            busy.append(False)
+            self.on_depth(tid, depth)
+        busy[depth] = True
+        return depth
+
+    def _find_held(self, tid, lock) -> int:
+        """Index of the latest acquisition of `lock` still held by `tid`, -1 if none."""
+        held = self.held.get(tid, ())
+        for h in range(len(held) - 1, -1, -1):
+            if held[h][1] == lock:
+                return h
+        return -1
+
+    def slices(self, events) -> typing.Iterator[typing.Tuple[str, int, int, int, int, int, int]]:
+        """`(kind, tid, depth, start, end, lock, stack)` of each slice of `events`, in the order they end."""
+        end = 0
+        for end, flag, tid, lock, stack in events:
+            kind = flag & PY_E_MASK
+            if kind == PY_E_WAIT:
+                wait = self.waits.pop(tid, None)
+                if wait is not None:
+                    # The previous one gave up
+                    self.busy[tid][wait[4]] = False
+                    yield (wait[1], tid, wait[4], wait[0], end, wait[2], wait[3])
+                holder = self.holders.get(lock)
+                blocked = flag & PY_F_BLOCKED or (holder is not None and holder[0] != tid)
+                self.waits[tid] = (end, KIND_BLOCKED if blocked else KIND_WAIT, lock, stack, self._free_depth(tid))
+            elif kind == PY_E_ACQUIRE:
+                wait = self.waits.pop(tid, None)
+                if wait is not None:
+                    depth = wait[4]
+                    stack = wait[3]
+                    yield (wait[1], tid, depth, wait[0], end, wait[2], wait[3])
+                else:
+                    # The wait was overwritten in flight recorder mode
+                    depth = self._free_depth(tid)
+                self.held[tid].append((end, lock, stack, depth))
+                holder = self.holders.get(lock)
+                self.holders[lock] = [tid, holder[1] + 1 if holder is not None else 1]
+            elif kind == PY_E_RELEASE:
+                holder = self.holders.get(lock)
+                hold_tid = tid
+                h = self._find_held(tid, lock)
+                if h < 0 and holder is not None:
+                    # Released by another thread than the holder, which plain locks allow. The slice ends on the
+                    # holder's track.
+                    hold_tid = holder[0]
+                    h = self._find_held(hold_tid, lock)
+                if h < 0:
+                    # The acquire was overwritten in flight recorder mode
+                    continue
+                start, _, hold_stack, depth = self.held[hold_tid].pop(h)
+                self.busy[hold_tid][depth] = False
+                if holder is not None and holder[1] > 1:
+                    holder[1] -= 1
+                else:
+                    self.holders.pop(lock, None)
+                yield (KIND_HOLD, hold_tid, depth, start, end, lock, hold_stack)
+        # Close what is still open at the end of the trace
+        for tid, (start, kind, lock, stack, depth) in self.waits.items():
+            yield (kind, tid, depth, start, end, lock, stack)
+        for tid, held in self.held.items():
+            for start, lock, stack, depth in held:
+                yield (KIND_HOLD, tid, depth, start, end, lock, stack)
+
+
+def _open(filename, mode):
+    return gzip.open(filename, mode) if str(filename).endswith(".gz") else open(filename, mode)
+
+
+def _stack_text(stack) -> str:
+    return "\n".join(f"{func} ({file}:{line})" for file, func, line in stack)
+
+
+def _us(ns: int) -> str:
+    """ns as exact decimal µs, the unit of Chrome trace timestamps."""
+    sign = "-" if ns < 0 else ""
+    ns = abs(ns)
+    return f"{sign}{ns // 1000}.{ns % 1000:03d}"
+
+
+def write_chrome_trace(filename, stats: LockStats, stacks: bool = True):
+    """Write `stats` as Chrome Trace Event JSON. Without `stacks`, slices only have the lock name as arg."""
+    lock_names = {}
+    # {(kind, lock, stack): the name, category and args of the slices, formatted}
+    formatted = {}
+    out = []
+
+    def lock_name(lock):
+        name = lock_names.get(lock)
+        if name is None:
+            name = lock_names[lock] = stats.lock_hashes.get(lock, f"lock {lock}")
+        return name
+
+    def on_thread(tid):
+        out.append(json.dumps({"ph": "M", "name": "process_name", "pid": tid, "args": {"name": f"thread {tid}"}}))
+
+    def on_depth(tid, depth):
+        out.append(json.dumps({
+            "ph": "M", "name": "thread_name", "pid": tid, "tid": depth, "args": {"name": f"depth {depth}"},
+        }))
+
+    slicer = _Slicer()
+    slicer.on_thread = on_thread
+    slicer.on_depth = on_depth
+    with _open(filename, "wt") as f:
+        f.write('{"displayTimeUnit": "ns", "traceEvents": [\n')
+        first = True
+        slices = slicer.slices(stats.lock_list)
+        while True:
+            for kind, tid, depth, start, end, lock, stack in itertools.islice(slices, _BATCH):
+                key = (kind, lock, stack if stacks else 0)
+                text = formatted.get(key)
+                if text is None:
+                    name = lock_name(lock)
+                    args = {"lock": name}
+                    if stacks:
+                        args["stack"] = _stack_text(stats.stack_hashes.get(stack, ()))
+                    text = formatted[key] = (
+                        f'"name": {json.dumps(f"{kind} {name}")}, "cat": "{kind}", "args": {json.dumps(args)}'
+                    )
+                out.append(f'{{"ph": "X", "pid": {tid}, "tid": {depth}, "ts": {_us(start)}, '
+                           f'"dur": {_us(end - start)}, {text}}}')
+            if not out:
+                break
+            f.write((",\n" if not first else "") + ",\n".join(out))
+            first = False
+            out.clear()
+        f.write("\n]}\n")
+
+
+# Perfetto protobuf, see https://perfetto.dev/docs/reference/trace-packet-proto.
+# Field numbers of the messages used:
+# Trace
+_TRACE_PACKET = 1
+# TracePacket
+_TIMESTAMP = 8
+_SEQUENCE_ID = 10
+_TRACK_EVENT = 11
+_INTERNED_DATA = 12
+_SEQUENCE_FLAGS = 13
+_TRACK_DESCRIPTOR = 60
+# TrackDescriptor
+_UUID = 1
+_TRACK_NAME = 2
+_PARENT_UUID = 5
+# TrackEvent
+_CATEGORY_IIDS = 3
+_ANNOTATIONS = 4
+_TYPE = 9
+_NAME_IID = 10
+_TRACK_UUID = 11
+_SLICE_BEGIN = 1
+_SLICE_END = 2
+# DebugAnnotation
+_ANNOTATION_NAME_IID = 1
+_STRING_VALUE_IID = 17
+# InternedData, whose entries all have an iid = 1 and a name or string = 2
+_CATEGORIES = 1
+_EVENT_NAMES = 2
+_ANNOTATION_NAMES = 3
+_ANNOTATION_STRINGS = 29
+# TracePacket.SequenceFlags
+_SEQ_INCREMENTAL_STATE_CLEARED = 1
+_SEQ_NEEDS_INCREMENTAL_STATE = 2
+# Any constant ID for the packets, written by a single sequence
+_SEQUENCE = 1
+# Varints of small numbers, which most lengths are
+_SMALL_VARINTS = [bytes([n]) if n < 0x80 else bytes([n & 0x7F | 0x80, n >> 7]) for n in range(1 << 14)]
+
+
+def _varint(value: int) -> bytes:
+    if value < len(_SMALL_VARINTS):
+        return _SMALL_VARINTS[value]
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _uint_field(field: int, value: int) -> bytes:
+    return _varint(field << 3) + _varint(value)
+
+
+def _bytes_field(field: int, value: bytes) -> bytes:
+    return _varint(field << 3 | 2) + _varint(len(value)) + value
+
+
+def _string_field(field: int, value: str) -> bytes:
+    return _bytes_field(field, value.encode())
+
+
+class _Interner:
+    """Interned strings of a sequence. New ones are written in the next packet, see `take`."""
+
+    def __init__(self):
+        # {(InternedData field, string): iid}
+        self.iids = {}
+        self.pending = []
+
+    def iid(self, field: int, value: str) -> int:
+        iid = self.iids.get((field, value))
+        if iid is None:
+            # Iids are per field, but unique ones do too
+            iid = self.iids[field, value] = len(self.iids) + 1
+            self.pending.append(_bytes_field(field, _uint_field(1, iid) + _string_field(2, value)))
+        return iid
+
+    def take(self) -> bytes:
+        """The InternedData field of the strings interned since the last call, if any."""
+        if not self.pending:
+            return b""
+        data = _bytes_field(_INTERNED_DATA, b"".join(self.pending))
+        self.pending.clear()
+        return data
+
+
+def write_perfetto_trace(filename, stats: LockStats, stacks: bool = True):
+    """Write `stats` as a Perfetto protobuf trace. Without `stacks`, slices only have the lock name as arg.
+
+    Each thread is a track with a child track per depth. Slice names and args are interned, so that each distinct
+    lock name and stack is written once.
+    """
+    # {tid: uuid of its track}, {(tid, depth): uuid of its track}
+    thread_tracks = {}
+    depth_tracks = {}
+    interner = _Interner()
+    # {(kind, lock, stack): the name, category and args of the slices, encoded}
+    encoded = {}
+    # {(kind, lock, stack, track uuid): TrackEvent field of the slice begin}, {track uuid: ... of the slice end}
+    begins = {}
+    ends = {}
+    trailer = _uint_field(_SEQUENCE_ID, _SEQUENCE)
+    uses_interned = _uint_field(_SEQUENCE_FLAGS, _SEQ_NEEDS_INCREMENTAL_STATE) + trailer
+    packet_tag = _varint(_TRACE_PACKET << 3 | 2)
+    timestamp_tag = _varint(_TIMESTAMP << 3)
+    out = [_bytes_field(_TRACE_PACKET, _uint_field(_SEQUENCE_FLAGS, _SEQ_INCREMENTAL_STATE_CLEARED) + trailer)]
+
+    def track(uuid, name, parent=None):
+        descriptor = _uint_field(_UUID, uuid) + _string_field(_TRACK_NAME, name)
+        if parent is not None:
+            descriptor += _uint_field(_PARENT_UUID, parent)
+        out.append(_bytes_field(_TRACE_PACKET, _bytes_field(_TRACK_DESCRIPTOR, descriptor) + trailer))
+
+    def on_thread(tid):
+        uuid = thread_tracks[tid] = len(thread_tracks) + len(depth_tracks) + 1
+        track(uuid, f"thread {tid}")
+
+    def on_depth(tid, depth):
+        uuid = depth_tracks[tid, depth] = len(thread_tracks) + len(depth_tracks) + 1
+        track(uuid, f"depth {depth}", thread_tracks[tid])
+
+    def annotation(name, value):
+        return _bytes_field(_ANNOTATIONS, _uint_field(_ANNOTATION_NAME_IID, interner.iid(_ANNOTATION_NAMES, name))
+                            + _uint_field(_STRING_VALUE_IID, interner.iid(_ANNOTATION_STRINGS, value)))
+
+    slicer = _Slicer()
+    slicer.on_thread = on_thread
+    slicer.on_depth = on_depth
+    with _open(filename, "wb") as f:
+        slices = slicer.slices(stats.lock_list)
+        while True:
+            for kind, tid, depth, start, end, lock, stack in itertools.islice(slices, _BATCH):
+                uuid = depth_tracks[tid, depth]
+                key = (kind, lock, stack if stacks else 0, uuid)
+                begin = begins.get(key)
+                if begin is None:
+                    fields = encoded.get(key[:3])
+                    if fields is None:
+                        name = stats.lock_hashes.get(lock, f"lock {lock}")
+                        fields = [
+                            _uint_field(_NAME_IID, interner.iid(_EVENT_NAMES, f"{kind} {name}")),
+                            _uint_field(_CATEGORY_IIDS, interner.iid(_CATEGORIES, kind)),
+                            annotation("lock", name),
+                        ]
+                        if stacks:
+                            fields.append(annotation("stack", _stack_text(stats.stack_hashes.get(stack, ()))))
+                        fields = encoded[key[:3]] = b"".join(fields)
+                    begin = begins[key] = _bytes_field(
+                        _TRACK_EVENT, _uint_field(_TYPE, _SLICE_BEGIN) + _uint_field(_TRACK_UUID, uuid) + fields,
+                    )
+                body = timestamp_tag + _varint(start) + begin + uses_interned + interner.take()
+                out.append(packet_tag + _varint(len(body)) + body)
+                end_event = ends.get(uuid)
+                if end_event is None:
+                    end_event = ends[uuid] = _bytes_field(
+                        _TRACK_EVENT, _uint_field(_TYPE, _SLICE_END) + _uint_field(_TRACK_UUID, uuid),
+                    )
+                body = timestamp_tag + _varint(end) + end_event + trailer
+                out.append(packet_tag + _varint(len(body)) + body)
+            if not out:
+                break
+            f.write(b"".join(out))
+            out.clear()
+
+
+def export_trace(filename, stats: LockStats, stacks: bool = True):
+    """Write `stats` as a Perfetto protobuf trace if `filename` ends in `.pftrace` (and `.gz`), else as Chrome JSON."""
+    if str(filename).endswith((".pftrace", ".pftrace.gz")):
+        write_perfetto_trace(filename, stats, stacks)
+    else:
+        write_chrome_trace(filename, stats, stacks)
+
+
+def main(argv=None):
+    """Export a trace saved by `LockProfiler.dump_stats` or `start_streaming`."""
+    from .lock_profiler import LockProfiler
+
+    parser = ArgumentParser(prog="python -m lock_profiler.trace_export", description=main.__doc__)
+    parser.add_argument("trace", help="Trace to export")
+    parser.add_argument("output", help="Perfetto trace if it ends in .pftrace, else Chrome JSON, compressed with .gz")
+    parser.add_argument("--no-stacks", action="store_true", help="Leave the call stacks out of the slice args")
+    args = parser.parse_args(argv)
+    export_trace(args.output, LockProfiler.load_stats(args.trace), not args.no_stacks)
+    print(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
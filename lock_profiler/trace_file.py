@@ -0,0 +1,260 @@
+"""
+Compact binary trace format (``.lkprof``) and a memory-mapped reader.
+
+Layout, little-endian, every section aligned to 8 bytes::
+
+    header   magic "LKPROF\\0\\0", uint32 version, uint32 section count, uint64 event count,
+             then (uint64 offset, uint64 size in bytes) for each section in `SECTIONS` order
+    timestamp, tid, lock_hash, stack_hash   int64 column per event
+    flag                                    uint8 column per event, see `PY_F_BLOCKED`
+    strings         uint64 end offsets into `string_data`, one per string
+    string_data     concatenated UTF-8 strings
+    locks           (int64 lock hash, int64 name string index) per lock
+    frames          (int64 file string index, int64 function string index, int64 line) per frame
+    stacks          (int64 stack hash, int64 first entry in `stack_frames`, int64 frame count) per stack
+    stack_frames    int64 frame index, innermost frame first
+    overheads       int64 wait overhead, int64 hold overhead (see `LockStats`)
+    uncontended     (int64 lock hash, int64 count) per lock with uncontended acquisitions
+
+The event columns are exposed as memoryviews over the mapped file, so opening
+a trace doesn't depend on its size.
+"""
+import array
+import mmap
+import struct
+import sys
+import typing
+
+from ._lock_profiler import LockEvent, LockStats, StackFrame
+
+MAGIC = b"LKPROF\0\0"
+VERSION = 3
+
+EVENT_COLUMNS = ("timestamp", "flag", "tid", "lock_hash", "stack_hash")
+SECTIONS = (
+    "timestamp", "tid", "lock_hash", "stack_hash", "flag",
+    "strings", "string_data", "locks", "frames", "stacks", "stack_frames", "overheads", "uncontended",
+)
+_COLUMN_TYPECODES = {"timestamp": "q", "tid": "q", "lock_hash": "q", "stack_hash": "q", "flag": "B"}
+
+_HEADER = struct.Struct(f"<8sIIQ{2 * len(SECTIONS)}Q")
+# Number of events converted per write
+_BATCH_SIZE = 1 << 16
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _to_le(arr: array.array) -> array.array:
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+class _StringTable:
+    def __init__(self):
+        self.index: typing.Dict[str, int] = {}
+
+    def add(self, s: str) -> int:
+        return self.index.setdefault(s, len(self.index))
+
+    def encode(self) -> typing.Tuple[bytes, bytes]:
+        data = [s.encode() for s in self.index]
+        ends = array.array("Q")
+        end = 0
+        for d in data:
+            end += len(d)
+            ends.append(end)
+        return _to_le(ends).tobytes(), b"".join(data)
+
+
+def write_trace(filename, stats: LockStats):
+    """Write `stats` as a `.lkprof` file.
+
+    Events are consumed in a single pass, so `stats.lock_list` may be a lazily read stream. Columnar events with
+    an `as_numpy` method, like `EventArray`s, are written column by column.
+    """
+    strings = _StringTable()
+    locks = array.array("q")
+    for lock_hash, name in stats.lock_hashes.items():
+        locks.extend((lock_hash, strings.add(name)))
+
+    frame_index: typing.Dict[tuple, int] = {}
+    frames = array.array("q")
+    stacks = array.array("q")
+    stack_frames = array.array("q")
+    for stack_hash, stack in stats.stack_hashes.items():
+        stacks.extend((stack_hash, len(stack_frames), len(stack)))
+        for frame in stack:
+            frame = tuple(frame)
+            idx = frame_index.get(frame)
+            if idx is None:
+                idx = frame_index[frame] = len(frame_index)
+                frames.extend((strings.add(frame[0]), strings.add(frame[1]), frame[2]))
+            stack_frames.append(idx)
+    string_ends, string_data = strings.encode()
+
+    n_events = len(stats.lock_list)
+    tables = {
+        "strings": string_ends,
+        "string_data": string_data,
+        "locks": _to_le(locks).tobytes(),
+        "frames": _to_le(frames).tobytes(),
+        "stacks": _to_le(stacks).tobytes(),
+        "stack_frames": _to_le(stack_frames).tobytes(),
+        "overheads": _to_le(array.array("q", (stats.wait_overhead, stats.hold_overhead))).tobytes(),
+        "uncontended": _to_le(array.array("q", (
+            v for item in stats.uncontended_counts.items() for v in item
+        ))).tobytes(),
+    }
+    sizes = {name: n_events * array.array(code).itemsize for name, code in _COLUMN_TYPECODES.items()}
+    sizes.update((name, len(data)) for name, data in tables.items())
+
+    offsets = {}
+    offset = _HEADER.size
+    for name in SECTIONS:
+        offset = _align(offset)
+        offsets[name] = offset
+        offset += sizes[name]
+
+    with open(filename, "wb") as f:
+        f.write(_HEADER.pack(
+            MAGIC, VERSION, len(SECTIONS), n_events,
+            *(v for name in SECTIONS for v in (offsets[name], sizes[name])),
+        ))
+        for name, data in tables.items():
+            f.seek(offsets[name])
+            f.write(data)
+
+        # Write the event columns in batches so the events are never all held in memory
+        written = 0
+        batch = {name: array.array(code) for name, code in _COLUMN_TYPECODES.items()}
+
+        def flush():
+            for name, column in batch.items():
+                f.seek(offsets[name] + written * column.itemsize)
+                f.write(_to_le(column).tobytes())
+                del column[:]
+
+        if hasattr(stats.lock_list, "as_numpy"):
+            # Columnar events, e.g. an `EventArray`: write each column in batches without creating events
+            arr = stats.lock_list.as_numpy()
+            for start in range(0, n_events, _BATCH_SIZE):
+                for name, code in _COLUMN_TYPECODES.items():
+                    f.seek(offsets[name] + start * array.array(code).itemsize)
+                    f.write(arr[name][start:start + _BATCH_SIZE].astype("u1" if code == "B" else "<i8").tobytes())
+            f.truncate(offset)
+            return
+
+        for e in stats.lock_list:
+            batch["timestamp"].append(e.timestamp)
+            batch["flag"].append(e.flag)
+            batch["tid"].append(e.tid)
+            batch["lock_hash"].append(e.lock_hash)
+            batch["stack_hash"].append(e.stack_hash)
+            if len(batch["timestamp"]) == _BATCH_SIZE:
+                flush()
+                written += _BATCH_SIZE
+        n_batch = len(batch["timestamp"])
+        flush()
+        if written + n_batch != n_events:
+            raise ValueError(f"Expected {n_events} events, got {written + n_batch}")
+        f.truncate(offset)
+
+
+class TraceFile:
+    """Memory-mapped `.lkprof` trace.
+
+    The event columns (`timestamp`, `flag`, `tid`, `lock_hash`, `stack_hash`) are zero-copy memoryviews.
+    Indexing or iterating the trace yields `LockEvent`s, so it can be used as `LockStats.lock_list`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+
+        header = _HEADER.unpack_from(buf)
+        magic, version, n_sections, self.n_events = header[:4]
+        if magic != MAGIC or version != VERSION or n_sections != len(SECTIONS):
+            buf.release()
+            self._mmap.close()
+            raise ValueError(f"{filename} is not a supported .lkprof trace")
+        self._sections = {
+            name: buf[offset:offset + size]
+            for name, offset, size in zip(SECTIONS, header[4::2], header[5::2])
+        }
+        buf.release()
+
+        for name, code in _COLUMN_TYPECODES.items():
+            setattr(self, name, self._column(name, code))
+
+        self.lock_hashes, self.stack_hashes = self._read_tables()
+        self.wait_overhead, self.hold_overhead = self._column("overheads", "q")
+        uncontended = self._column("uncontended", "q")
+        self.uncontended_counts = {uncontended[i]: uncontended[i + 1] for i in range(0, len(uncontended), 2)}
+
+    def _column(self, name, code):
+        section = self._sections[name]
+        if sys.byteorder == "big" and code != "B":
+            return memoryview(_to_le(array.array(code, section.tobytes())))
+        return section.cast(code)
+
+    def _read_tables(self):
+        ends = self._column("strings", "Q")
+        data = self._sections["string_data"]
+        strings = []
+        start = 0
+        for end in ends:
+            strings.append(str(data[start:end], "utf-8"))
+            start = end
+
+        locks = self._column("locks", "q")
+        lock_hashes = {locks[i]: strings[locks[i + 1]] for i in range(0, len(locks), 2)}
+
+        frames_col = self._column("frames", "q")
+        frames = [
+            StackFrame(strings[frames_col[i]], strings[frames_col[i + 1]], frames_col[i + 2])
+            for i in range(0, len(frames_col), 3)
+        ]
+        stacks = self._column("stacks", "q")
+        stack_frames = self._column("stack_frames", "q")
+        stack_hashes = {
+            stacks[i]: [frames[idx] for idx in stack_frames[stacks[i + 1]:stacks[i + 1] + stacks[i + 2]]]
+            for i in range(0, len(stacks), 3)
+        }
+        return lock_hashes, stack_hashes
+
+    def __len__(self):
+        return self.n_events
+
+    def __getitem__(self, i) -> LockEvent:
+        return LockEvent(self.timestamp[i], self.flag[i], self.tid[i], self.lock_hash[i], self.stack_hash[i])
+
+    def __iter__(self) -> typing.Iterator[LockEvent]:
+        return map(LockEvent, self.timestamp, self.flag, self.tid, self.lock_hash, self.stack_hash)
+
+    def to_stats(self) -> LockStats:
+        return LockStats(
+            self.lock_hashes, self.stack_hashes, self, self.wait_overhead, self.hold_overhead, self.uncontended_counts,
+        )
+
+    def close(self):
+        for name in _COLUMN_TYPECODES:
+            getattr(self, name).release()
+        for section in self._sections.values():
+            section.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_trace(filename) -> LockStats:
+    """Open a `.lkprof` trace. The events are read from the mapped file on access."""
+    return TraceFile(filename).to_stats()
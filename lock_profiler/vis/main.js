@@ -1,67 +1,1166 @@
-let lastRender = 0;
+// Swimlane viewer of `.lkprof` traces, see `trace_file.py` for the format.
+//
+// The event columns are read in chunks straight from the file and paired into
+// wait and hold intervals, drawn as one row per thread and nesting depth. Each
+// row keeps its intervals in start order in typed arrays; as intervals of a row
+// don't overlap, their ends are sorted too, so drawing binary-searches the
+// first visible interval and skips to the next pixel column whenever intervals
+// get narrower than a pixel. A frame costs O(rows * width * log n), whatever
+// the size of the trace. Timestamps are shown as nanoseconds, which every
+// timer of the recorder counts.
+//
+// When the trace comes with its level-of-detail pyramid (`<trace>.lod`, see
+// `lod.py`), events aren't loaded up front: zoomed out, each lane is drawn from
+// the tiles of the visible window at the level with buckets of at most a
+// pixel, and zoomed in past the finest level, from the events of the visible
+// window only, found by bisecting the timestamp column. Files are read by
+// ranges, so memory and drawing stay bounded by the screen size.
+"use strict";
+
+const MAGIC = "LKPROF\0\0";
+const VERSION = 3;
+const SECTIONS = [
+    "timestamp", "tid", "lock_hash", "stack_hash", "flag",
+    "strings", "string_data", "locks", "frames", "stacks", "stack_frames", "overheads", "uncontended",
+];
+const HEADER_SIZE = 24 + 16 * SECTIONS.length;
+// Event flags, see `_lock_profiler.pyx`
+const E_WAIT = 0;
+const E_ACQUIRE = 1;
+const E_RELEASE = 2;
+const E_MASK = 0x3;
+const F_BLOCKED = 1 << 7;
+// Events read and paired per step of the loading
+const CHUNK_EVENTS = 1 << 20;
+const LOD_MAGIC = "LKLOD\0\0\0";
+const LOD_VERSION = 1;
+const LOD_HEADER_SIZE = 64;
+// Tiles kept in memory, least recently drawn dropped first
+const TILE_CACHE_SIZE = 512;
+// Events read before the visible window, so that intervals open at its start are drawn from their beginning
+const WINDOW_PAD_EVENTS = 1 << 16;
+// Events of a window at most; past them, the view is drawn from the finest tiles
+const MAX_WINDOW_EVENTS = CHUNK_EVENTS;
+
+const KIND_WAIT = 0;
+const KIND_BLOCKED = 1;
+const KIND_HOLD = 2;
+const KIND_NAMES = ["wait", "blocked wait", "hold"];
+
+const ROW_HEIGHT = 14;
+const LANE_GAP = 8;
+const AXIS_HEIGHT = 24;
+const LABEL_WIDTH = 150;
+const DIMMED = "#dddddd";
+const BLOCKED = "#d62728";
+// Waits in tiles, which don't keep the lock waited for
+const WAITING = "#bbbbbb";
+// Frames shown in the tooltip
+const TOOLTIP_FRAMES = 8;
+
 let canvas;
 let ctx;
-let fileInput;
-let oldTimestamp;
-let data;
+let tooltip;
+let statusBar;
+let legend;
+let trace = null;
+// With a level-of-detail pyramid: its `Tiles`, and the `Window` of loaded events
+let tiles = null;
+let eventWindow = null;
+let windowLoading = false;
+// Visible time range: timestamp at the left edge of the timeline, and pixels per ns
+let view = {start: 0, scale: 1, scrollY: 0};
+let highlightLock = -1;
+let renderQueued = false;
+let drag = null;
+let renderTime = 0;
 
 window.onload = init;
 
 function init() {
-    fileInput = document.getElementById('file-input');
-    fileInput.addEventListener('change', readFile, false);
-    fileInput.style.display = "block";
+    canvas = document.getElementById("canvas");
+    ctx = canvas.getContext("2d");
+    tooltip = document.getElementById("tooltip");
+    statusBar = document.getElementById("status");
+    legend = document.getElementById("legend");
 
-    canvas = document.getElementById('canvas');
-    ctx = canvas.getContext('2d');
+    document.getElementById("file-input").addEventListener("change", (e) => {
+        loadFiles(e.target.files);
+    });
+    document.body.addEventListener("dragover", (e) => e.preventDefault());
+    document.body.addEventListener("drop", (e) => {
+        e.preventDefault();
+        loadFiles(e.dataTransfer.files);
+    });
 
-    canvas.width = window.innerWidth;
-    canvas.height = window.innerHeight;
+    canvas.addEventListener("wheel", onWheel, {passive: false});
+    canvas.addEventListener("mousedown", (e) => {
+        drag = {x: e.clientX, y: e.clientY, moved: false};
+    });
+    window.addEventListener("mouseup", onMouseUp);
+    window.addEventListener("mousemove", onMouseMove);
+    canvas.addEventListener("mouseleave", () => {
+        tooltip.style.display = "none";
+    });
+    canvas.addEventListener("dblclick", () => {
+        resetView();
+    });
+    window.addEventListener("resize", resize);
+    resize();
 
-    ctx.fillStyle = "#FF0000";
-    ctx.strokeStyle = "#FF0000";
-    ctx.lineWidth = 1;
-    ctx.lineCap = "round";
-    ctx.lineJoin = 0 ? "miter" : "round";
+    // vis.html?trace=<url>, see `LockProfiler.visualize`
+    const url = new URLSearchParams(window.location.search).get("trace");
+    if (url) {
+        const source = urlSource(url);
+        const lodSource = urlSource(`${url}.lod`);
+        // Without the pyramid, the whole trace is loaded
+        lodSource.read(0, 8)
+            .then(() => lodSource, () => null)
+            .then((lod) => load(source, lod))
+            .catch((error) => setStatus(`Can't fetch ${url}: ${error}. Open the file instead.`));
+    }
+}
 
-    ctx.lineCap = "square";
-    ctx.lineWidth = 20;
+// A trace picked or dropped with its `.lod` pyramid, or alone
+function loadFiles(files) {
+    files = Array.from(files);
+    const lod = files.find((f) => f.name.endsWith(".lod"));
+    const traceFile = files.find((f) => f !== lod);
+    if (traceFile !== undefined) {
+        load(blobSource(traceFile), lod !== undefined ? blobSource(lod) : null);
+    }
+}
 
-    // Start the first frame request
-    window.requestAnimationFrame(gameLoop);
+function setStatus(text) {
+    statusBar.textContent = text;
 }
 
-function readFile(e) {
-    let file = e.target.files[0];
-    const reader = new FileReader();
-    reader.onload = (event) => {
-        data = JSON.parse(event.target.result);
-        fileInput.style.display = "none";
+// Loading
+
+// Files are read through sources: {name, read(offset, size) -> Promise<ArrayBuffer>}
+function blobSource(blob) {
+    return {name: blob.name || "", read: (offset, size) => blob.slice(offset, offset + size).arrayBuffer()};
+}
+
+// Reads with HTTP range requests, or fetches the whole file once if the server doesn't support them
+function urlSource(url) {
+    let whole = null;
+    return {
+        name: url.split("/").pop(),
+        async read(offset, size) {
+            if (whole === null && size > 0) {
+                const response = await fetch(url, {headers: {Range: `bytes=${offset}-${offset + size - 1}`}});
+                if (!response.ok) {
+                    throw new Error(`${response.status} ${response.statusText}`);
+                }
+                if (response.status === 206) {
+                    return await response.arrayBuffer();
+                }
+                whole = await response.blob();
+            }
+            return whole === null ? new ArrayBuffer(0) : await whole.slice(offset, offset + size).arrayBuffer();
+        },
     };
-    reader.readAsText(file);
 }
 
-function draw() {
+async function readBytes(source, offset, size) {
+    return await source.read(offset, size);
+}
+
+// Little-endian int64s as numbers, minus `base`. Exact while the differences stay below 2 ** 53.
+function int64Numbers(buffer, baseHi = 0, baseLo = 0) {
+    const words = new Int32Array(buffer);
+    const out = new Float64Array(words.length / 2);
+    for (let i = 0; i < out.length; i++) {
+        out[i] = (words[2 * i + 1] - baseHi) * 4294967296 + ((words[2 * i] >>> 0) - baseLo);
+    }
+    return out;
+}
+
+async function readHeader(source) {
+    const view = new DataView(await readBytes(source, 0, HEADER_SIZE));
+    const magic = String.fromCharCode(...new Uint8Array(view.buffer, 0, 8));
+    const version = view.getUint32(8, true);
+    if (magic !== MAGIC || version !== VERSION || view.getUint32(12, true) !== SECTIONS.length) {
+        throw new Error(`not a version ${VERSION} .lkprof trace`);
+    }
+    const sections = {};
+    SECTIONS.forEach((name, i) => {
+        sections[name] = {
+            offset: Number(view.getBigUint64(24 + 16 * i, true)),
+            size: Number(view.getBigUint64(32 + 16 * i, true)),
+        };
+    });
+    return {nEvents: Number(view.getBigUint64(16, true)), sections};
+}
+
+async function readSection(source, section) {
+    return await readBytes(source, section.offset, section.size);
+}
+
+async function readTables(source, sections) {
+    const ends = int64Numbers(await readSection(source, sections.strings));
+    const data = new Uint8Array(await readSection(source, sections.string_data));
+    const decoder = new TextDecoder();
+    const strings = [];
+    let start = 0;
+    for (const end of ends) {
+        strings.push(decoder.decode(data.subarray(start, end)));
+        start = end;
+    }
+
+    const lockNames = new Map();
+    const locks = int64Numbers(await readSection(source, sections.locks));
+    for (let i = 0; i < locks.length; i += 2) {
+        lockNames.set(locks[i], strings[locks[i + 1]]);
+    }
+
+    const frameCol = int64Numbers(await readSection(source, sections.frames));
+    const frames = [];
+    for (let i = 0; i < frameCol.length; i += 3) {
+        frames.push({file: strings[frameCol[i]], func: strings[frameCol[i + 1]], line: frameCol[i + 2]});
+    }
+    const stackCol = int64Numbers(await readSection(source, sections.stacks));
+    const stackFrames = int64Numbers(await readSection(source, sections.stack_frames));
+    const stacks = new Map();
+    for (let i = 0; i < stackCol.length; i += 3) {
+        const first = stackCol[i + 1];
+        stacks.set(stackCol[i], Array.from(stackFrames.subarray(first, first + stackCol[i + 2]), (idx) => frames[idx]));
+    }
+    return {lockNames, stacks};
+}
+
+// Where and how to read the events of a trace: {source, sections, nEvents, base}
+async function eventReader(source, header) {
+    const {sections, nEvents} = header;
+    let base = [0, 0];
+    if (nEvents) {
+        // Timestamps are kept relative to the first one, so they fit in doubles
+        const words = new Int32Array(await readBytes(source, sections.timestamp.offset, 8));
+        base = [words[1], words[0] >>> 0];
+    }
+    return {source, sections, nEvents, base};
+}
+
+// Add the events [first, first + n) to `target`
+async function readEvents(events, first, n, target) {
+    const {source, sections, base} = events;
+    const column = (name, itemSize) => readBytes(source, sections[name].offset + first * itemSize, n * itemSize);
+    const [tsBytes, tidBytes, lockBytes, stackBytes, flagBytes] = await Promise.all([
+        column("timestamp", 8), column("tid", 8), column("lock_hash", 8), column("stack_hash", 8), column("flag", 1),
+    ]);
+    target.addEvents(
+        int64Numbers(tsBytes, ...base), new Uint8Array(flagBytes), int64Numbers(tidBytes),
+        int64Numbers(lockBytes), int64Numbers(stackBytes),
+    );
+}
+
+// Relative timestamp of an event
+async function readTimestamp(events, index) {
+    return int64Numbers(await readBytes(events.source, events.sections.timestamp.offset + index * 8, 8), ...events.base)[0];
+}
+
+// First event at or after relative time `t`, bisecting the timestamp column in the file
+async function eventAt(events, t) {
+    let lo = 0;
+    let hi = events.nEvents;
+    while (lo < hi) {
+        const mid = Math.floor((lo + hi) / 2);
+        if (await readTimestamp(events, mid) < t) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+async function load(source, lodSource = null) {
+    document.getElementById("file-input").blur();
+    let header;
+    try {
+        header = await readHeader(source);
+    } catch (error) {
+        setStatus(`Can't read ${source.name || "the trace"}: ${error.message}`);
+        return;
+    }
+    const {lockNames, stacks} = await readTables(source, header.sections);
+    const events = await eventReader(source, header);
+    const {nEvents} = header;
+    trace = new Trace(lockNames, stacks);
+    tiles = null;
+    eventWindow = null;
+    highlightLock = -1;
+
+    if (lodSource !== null) {
+        try {
+            tiles = await Tiles.open(lodSource, trace, events);
+        } catch (error) {
+            setStatus(`Can't read ${lodSource.name || "the pyramid"}: ${error.message}, loading all events`);
+        }
+    }
+    if (tiles !== null) {
+        setStatus(`${source.name || "Trace"}: ${nEvents} events, ${trace.lanes.length} threads, ${trace.locks.length} locks, `
+            + `${tiles.nLevels} levels of detail`);
+        updateLegend();
+        resetView();
+        return;
+    }
 
+    for (let first = 0; first < nEvents; first += CHUNK_EVENTS) {
+        const n = Math.min(CHUNK_EVENTS, nEvents - first);
+        await readEvents(events, first, n, trace);
+        if (first === 0) {
+            resetView();
+        }
+        setStatus(`Loading ${source.name || ""}: ${Math.round(100 * (first + n) / nEvents)}% of ${nEvents} events`);
+        updateLegend();
+        requestRender();
+        // Let the page draw what was loaded so far
+        await new Promise((resolve) => setTimeout(resolve, 0));
+    }
+    trace.finish();
+    setStatus(`${source.name || "Trace"}: ${nEvents} events, ${trace.lanes.length} threads, ${trace.locks.length} locks`);
+    updateLegend();
+    resetView();
 }
 
-function gameLoop(timestamp) {
-    // Calculate the number of seconds passed since the last frame
-    let secondsPassed = (timestamp - oldTimestamp) / 1000;
-    oldTimestamp = timestamp;
+// Level-of-detail pyramid
+
+class Tiles {
+    // Read the header and index of a `.lod` file, and lay out `trace` from them
+    static async open(source, trace, events) {
+        const header = new DataView(await readBytes(source, 0, LOD_HEADER_SIZE));
+        const magic = String.fromCharCode(...new Uint8Array(header.buffer, 0, 8));
+        if (magic !== LOD_MAGIC || header.getUint32(8, true) !== LOD_VERSION) {
+            throw new Error(`not a version ${LOD_VERSION} .lod pyramid`);
+        }
+        const nLanes = header.getUint32(12, true);
+        const nLocks = Number(header.getBigUint64(48, true));
+        const nTiles = Number(header.getBigUint64(56, true));
+        const tables = await readBytes(source, LOD_HEADER_SIZE, 16 * nLanes + 24 * nLocks + 24 * nTiles);
+        const lanes = int64Numbers(tables.slice(0, 16 * nLanes));
+        for (let i = 0; i < lanes.length; i += 2) {
+            const lane = trace.lane(lanes[i]);
+            while (lane.rows.length < lanes[i + 1]) {
+                lane.freeDepth();
+                lane.busy[lane.busy.length - 1] = true;
+            }
+        }
+        const locks = int64Numbers(tables.slice(16 * nLanes, 16 * nLanes + 24 * nLocks));
+        for (let i = 0; i < locks.length; i += 3) {
+            const lock = trace.locks[trace.lock(locks[i])];
+            lock.holdTime = locks[i + 1];
+            lock.blockedTime = locks[i + 2];
+        }
+        trace.end = Number(header.getBigInt64(40, true));
+
+        const tileBuckets = header.getUint32(20, true);
+        const index = new DataView(tables, 16 * nLanes + 24 * nLocks);
+        const offsets = new Map();
+        for (let i = 0; i < nTiles; i++) {
+            const level = index.getUint32(24 * i, true);
+            const lane = index.getUint32(24 * i + 4, true);
+            const tile = Number(index.getBigUint64(24 * i + 8, true));
+            offsets.set(`${level}/${lane}/${tile}`, Number(index.getBigUint64(24 * i + 16, true)));
+        }
+        return new Tiles(source, trace, events, {
+            nLevels: header.getUint32(16, true),
+            tileBuckets,
+            bucketWidth: Number(header.getBigInt64(32, true)),
+            offsets,
+        });
+    }
+
+    constructor(source, trace, events, {nLevels, tileBuckets, bucketWidth, offsets}) {
+        this.source = source;
+        this.trace = trace;
+        this.events = events;
+        this.nLevels = nLevels;
+        this.tileBuckets = tileBuckets;
+        // Of level 0, in ns
+        this.bucketWidth = bucketWidth;
+        this.offsets = offsets;
+        // In least recently used order
+        this.cache = new Map();
+        this.pending = new Set();
+    }
+
+    // The finest level with buckets of at least a pixel
+    level(nsPerPixel) {
+        const level = Math.ceil(Math.log2(nsPerPixel / this.bucketWidth));
+        return Math.min(Math.max(level, 0), this.nLevels - 1);
+    }
+
+    // A tile {hold, wait, blocked: Uint8Array shares in 255ths, lock: Int32Array lock indices or -1}, null if it's
+    // empty, or undefined while it's being read
+    get(level, lane, tile) {
+        const key = `${level}/${lane}/${tile}`;
+        const offset = this.offsets.get(key);
+        if (offset === undefined) {
+            return null;
+        }
+        const cached = this.cache.get(key);
+        if (cached !== undefined) {
+            this.cache.delete(key);
+            this.cache.set(key, cached);
+            return cached;
+        }
+        if (!this.pending.has(key)) {
+            this.pending.add(key);
+            this.fetch(key, offset).catch((error) => setStatus(`Can't read tile ${key}: ${error.message}`));
+        }
+        return undefined;
+    }
+
+    async fetch(key, offset) {
+        const n = this.tileBuckets;
+        const buffer = await readBytes(this.source, offset, 7 * n);
+        const lockHash = new Int32Array(buffer.slice(3 * n, 7 * n));
+        const lock = new Int32Array(n);
+        for (let i = 0; i < n; i++) {
+            lock[i] = lockHash[i] < 0 ? -1 : this.trace.lock(lockHash[i]);
+        }
+        this.cache.set(key, {
+            hold: new Uint8Array(buffer, 0, n),
+            wait: new Uint8Array(buffer, n, n),
+            blocked: new Uint8Array(buffer, 2 * n, n),
+            lock,
+        });
+        this.pending.delete(key);
+        if (this.cache.size > TILE_CACHE_SIZE) {
+            this.cache.delete(this.cache.keys().next().value);
+        }
+        requestRender();
+    }
+}
+
+// Events of a time window, read when zoomed in past the finest tiles
+class Window {
+    constructor(start, end, trace, requested) {
+        // Times between which `trace` has every interval
+        this.start = start;
+        this.end = end;
+        this.trace = trace;
+        // Where the first and last events read are: intervals open there may have started before or end after
+        this.first = trace.firstTime;
+        this.last = end < trace.parent.end ? end : Infinity;
+        // The window that was asked for, which has too many events to read if it isn't covered
+        this.requested = requested;
+    }
+
+    covers(left, right) {
+        return this.start <= left && right <= this.end;
+    }
+
+    wasRequested(left, right) {
+        return this.requested[0] <= left && right <= this.requested[1];
+    }
+}
+
+// Read the events around [left, right] into `eventWindow`
+async function loadWindow(left, right) {
+    windowLoading = true;
+    try {
+        const events = tiles.events;
+        // A screen to each side, to pan without waiting
+        const span = right - left;
+        const first = await eventAt(events, left - span);
+        const begin = Math.max(first - WINDOW_PAD_EVENTS, 0);
+        let end = Math.max(await eventAt(events, right + span), first);
+        end = Math.min(end, begin + MAX_WINDOW_EVENTS);
+        // Nothing happens between the requested start and the first event after it
+        const start = first > 0 ? left - span : -Infinity;
+        const stop = end < events.nEvents ? await readTimestamp(events, end) : trace.end;
+        const windowTrace = new Trace(trace.lockNames, trace.stacks, trace);
+        // In one go, for `openHeld` to see all of them
+        await readEvents(events, begin, end - begin, windowTrace);
+        // Nothing happens until the next event
+        windowTrace.end = stop;
+        windowTrace.finish();
+        for (const lane of trace.lanes) {
+            const windowLane = windowTrace.laneByTid.get(lane.tid);
+            while (windowLane !== undefined && lane.rows.length < windowLane.rows.length) {
+                lane.rows.push(new Row());
+            }
+        }
+        eventWindow = new Window(start, stop, windowTrace, [left - span, right + span]);
+    } finally {
+        windowLoading = false;
+    }
+    requestRender();
+}
+
+// The trace to draw the view from, or null to draw it from the tiles
+function viewTrace() {
+    if (tiles === null) {
+        return trace;
+    }
+    if (1 / view.scale > tiles.bucketWidth) {
+        return null;
+    }
+    const left = view.start;
+    const right = toTime(canvas.clientWidth);
+    if (eventWindow !== null) {
+        if (eventWindow.covers(left, right)) {
+            return eventWindow.trace;
+        }
+        if (eventWindow.wasRequested(left, right)) {
+            // Too many events: the finest tiles stand in
+            return null;
+        }
+    }
+    if (!windowLoading) {
+        loadWindow(left, right).catch((error) => setStatus(`Can't read events: ${error.message}`));
+    }
+    return null;
+}
+
+// Trace model
+
+// Intervals of one row in start order, in growable typed arrays
+class Row {
+    constructor() {
+        this.count = 0;
+        this.start = new Float64Array(1024);
+        this.end = new Float64Array(1024);
+        this.lock = new Int32Array(1024);
+        this.stack = new Float64Array(1024);
+        this.kind = new Uint8Array(1024);
+    }
+
+    push(start, lock, stack, kind) {
+        if (this.count === this.start.length) {
+            for (const name of ["start", "end", "lock", "stack", "kind"]) {
+                const grown = new this[name].constructor(this.count * 2);
+                grown.set(this[name]);
+                this[name] = grown;
+            }
+        }
+        const i = this.count++;
+        this.start[i] = start;
+        // Open until its end is seen
+        this.end[i] = start;
+        this.lock[i] = lock;
+        this.stack[i] = stack;
+        this.kind[i] = kind;
+        return i;
+    }
+}
+
+class Lane {
+    constructor(tid) {
+        this.tid = tid;
+        // One row per nesting depth
+        this.rows = [];
+        // Per depth, whether an interval is open
+        this.busy = [];
+        // The wait being recorded: {row, index, lock, stack, depth}
+        this.wait = null;
+        // Held locks: [{row, index, lock, depth}]
+        this.held = [];
+    }
+
+    freeDepth() {
+        let depth = this.busy.indexOf(false);
+        if (depth < 0) {
+            depth = this.busy.length;
+            this.busy.push(false);
+            this.rows.push(new Row());
+        }
+        return depth;
+    }
+}
+
+class Trace {
+    // A trace of a window of events of `parent` shares its locks and lane order, and doesn't add to its totals
+    constructor(lockNames, stacks, parent = null) {
+        this.lockNames = lockNames;
+        this.stacks = stacks;
+        this.parent = parent;
+        this.lanes = [];
+        this.laneByTid = new Map();
+        // [{hash, name, color, waitColor, holdTime, blockedTime}]
+        this.locks = parent !== null ? parent.locks : [];
+        this.lockIndex = parent !== null ? parent.lockIndex : new Map();
+        // {lock index: [holder tid, depth]}
+        this.holders = new Map();
+        this.end = 0;
+        if (parent !== null) {
+            for (const lane of parent.lanes) {
+                this.lane(lane.tid);
+            }
+        }
+    }
+
+    lane(tid) {
+        let lane = this.laneByTid.get(tid);
+        if (lane === undefined) {
+            lane = new Lane(tid);
+            this.laneByTid.set(tid, lane);
+            this.lanes.push(lane);
+        }
+        return lane;
+    }
+
+    lock(hash) {
+        let index = this.lockIndex.get(hash);
+        if (index === undefined) {
+            index = this.locks.length;
+            // Spread the hues with the golden angle
+            const hue = (index * 137.508) % 360;
+            this.locks.push({
+                hash,
+                name: this.lockNames.get(hash) || `lock ${hash}`,
+                color: `hsl(${hue}, 60%, 50%)`,
+                waitColor: `hsl(${hue}, 60%, 82%)`,
+                holdTime: 0,
+                blockedTime: 0,
+            });
+            this.lockIndex.set(hash, index);
+        }
+        return index;
+    }
+
+    closeWait(lane, end) {
+        const wait = lane.wait;
+        wait.row.end[wait.index] = end;
+        if (wait.row.kind[wait.index] === KIND_BLOCKED && this.parent === null) {
+            this.locks[wait.lock].blockedTime += end - wait.row.start[wait.index];
+        }
+        lane.wait = null;
+    }
+
+    // Holds released in a window of events before being acquired in it were open at its start: open them first,
+    // so that rows stay in start order
+    openHeld(ts, flag, tid, lockHash) {
+        this.firstTime = ts.length ? ts[0] : 0;
+        const depths = new Map();
+        const missing = [];
+        for (let i = 0; i < ts.length; i++) {
+            const kind = flag[i] & E_MASK;
+            const key = `${tid[i]}/${lockHash[i]}`;
+            const depth = depths.get(key) || 0;
+            if (kind === E_ACQUIRE) {
+                depths.set(key, depth + 1);
+            } else if (kind === E_RELEASE) {
+                if (depth > 0) {
+                    depths.set(key, depth - 1);
+                } else {
+                    missing.push(i);
+                }
+            }
+        }
+        // The first released is the innermost
+        for (const i of missing.reverse()) {
+            const lane = this.lane(tid[i]);
+            const lock = this.lock(lockHash[i]);
+            const depth = lane.freeDepth();
+            const row = lane.rows[depth];
+            lane.busy[depth] = true;
+            lane.held.push({row, index: row.push(ts[0], lock, 0, KIND_HOLD), lock, depth});
+            const holder = this.holders.get(lock);
+            this.holders.set(lock, [tid[i], holder !== undefined ? holder[1] + 1 : 1]);
+        }
+    }
+
+    addEvents(ts, flag, tid, lockHash, stackHash) {
+        if (this.parent !== null) {
+            this.openHeld(ts, flag, tid, lockHash);
+        }
+        for (let i = 0; i < ts.length; i++) {
+            const lane = this.lane(tid[i]);
+            const lock = this.lock(lockHash[i]);
+            const t = ts[i];
+            const kind = flag[i] & E_MASK;
+            if (kind === E_WAIT) {
+                if (lane.wait !== null) {
+                    // The previous one gave up
+                    lane.busy[lane.wait.depth] = false;
+                    this.closeWait(lane, t);
+                }
+                const holder = this.holders.get(lock);
+                const blocked = (flag[i] & F_BLOCKED) !== 0 || (holder !== undefined && holder[0] !== tid[i]);
+                const depth = lane.freeDepth();
+                const row = lane.rows[depth];
+                lane.busy[depth] = true;
+                const index = row.push(t, lock, stackHash[i], blocked ? KIND_BLOCKED : KIND_WAIT);
+                lane.wait = {row, index, lock, stack: stackHash[i], depth};
+            } else if (kind === E_ACQUIRE) {
+                let depth, stack;
+                if (lane.wait !== null) {
+                    depth = lane.wait.depth;
+                    stack = lane.wait.stack;
+                    this.closeWait(lane, t);
+                } else {
+                    // The wait was overwritten in flight recorder mode
+                    depth = lane.freeDepth();
+                    lane.busy[depth] = true;
+                    stack = 0;
+                }
+                const row = lane.rows[depth];
+                lane.held.push({row, index: row.push(t, lock, stack, KIND_HOLD), lock, depth});
+                const holder = this.holders.get(lock);
+                this.holders.set(lock, [tid[i], holder !== undefined ? holder[1] + 1 : 1]);
+            } else if (kind === E_RELEASE) {
+                let h = lane.held.length - 1;
+                while (h >= 0 && lane.held[h].lock !== lock) {
+                    h--;
+                }
+                if (h < 0) {
+                    // The acquire was overwritten in flight recorder mode
+                    continue;
+                }
+                const held = lane.held[h];
+                lane.held.splice(h, 1);
+                held.row.end[held.index] = t;
+                lane.busy[held.depth] = false;
+                const holder = this.holders.get(lock);
+                if (holder !== undefined && holder[1] > 1) {
+                    holder[1]--;
+                } else {
+                    // Re-entrant acquisitions are part of the outermost one
+                    if (this.parent === null) {
+                        this.locks[lock].holdTime += t - held.row.start[held.index];
+                    }
+                    this.holders.delete(lock);
+                }
+            }
+        }
+        if (ts.length) {
+            this.end = Math.max(this.end, ts[ts.length - 1]);
+        }
+    }
+
+    // Close what is still open at the end of the trace
+    finish() {
+        for (const lane of this.lanes) {
+            if (lane.wait !== null) {
+                this.closeWait(lane, this.end);
+            }
+            for (const held of lane.held) {
+                held.row.end[held.index] = this.end;
+            }
+        }
+    }
+
+    height() {
+        return this.lanes.reduce((h, lane) => h + lane.rows.length * ROW_HEIGHT + LANE_GAP, 0);
+    }
+}
+
+// First index from `lo` whose value is at least `value`, in a sorted typed array
+function lowerBound(values, count, value, lo = 0) {
+    let hi = count;
+    while (lo < hi) {
+        const mid = (lo + hi) >>> 1;
+        if (values[mid] < value) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// Same as `lowerBound`, for a value expected close after `lo`: probes at doubling distances first, which touches
+// less memory than bisecting the whole rest of the array
+function gallopLowerBound(values, count, value, lo) {
+    let step = 1;
+    let hi = lo;
+    while (hi < count && values[hi] < value) {
+        lo = hi + 1;
+        hi += step;
+        step *= 2;
+    }
+    return lowerBound(values, Math.min(hi, count), value, lo);
+}
+
+// View
+
+function timelineWidth() {
+    return canvas.clientWidth - LABEL_WIDTH;
+}
+
+function toX(t) {
+    return LABEL_WIDTH + (t - view.start) * view.scale;
+}
+
+function toTime(x) {
+    return view.start + (x - LABEL_WIDTH) / view.scale;
+}
+
+function resetView() {
+    view.start = 0;
+    view.scale = trace && trace.end > 0 ? timelineWidth() / trace.end : 1;
+    view.scrollY = 0;
+    requestRender();
+}
+
+function resize() {
+    const ratio = window.devicePixelRatio || 1;
+    canvas.width = Math.floor(canvas.clientWidth * ratio);
+    canvas.height = Math.floor(canvas.clientHeight * ratio);
+    ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+    requestRender();
+}
+
+function requestRender() {
+    if (!renderQueued) {
+        renderQueued = true;
+        window.requestAnimationFrame(render);
+    }
+}
+
+function onWheel(e) {
+    e.preventDefault();
+    if (e.shiftKey) {
+        scrollBy(e.deltaY);
+        return;
+    }
+    // Zoom around the cursor
+    const t = toTime(e.offsetX);
+    view.scale *= Math.exp(-e.deltaY * 0.002);
+    view.start = t - (e.offsetX - LABEL_WIDTH) / view.scale;
+    requestRender();
+}
+
+function scrollBy(dy) {
+    const maxScroll = Math.max(0, (trace ? trace.height() : 0) - (canvas.clientHeight - AXIS_HEIGHT));
+    view.scrollY = Math.min(Math.max(view.scrollY + dy, 0), maxScroll);
+    requestRender();
+}
+
+function onMouseMove(e) {
+    if (drag !== null) {
+        const dx = e.clientX - drag.x;
+        const dy = e.clientY - drag.y;
+        if (dx || dy) {
+            drag.moved = true;
+        }
+        view.start -= dx / view.scale;
+        scrollBy(-dy);
+        drag.x = e.clientX;
+        drag.y = e.clientY;
+        tooltip.style.display = "none";
+        return;
+    }
+    if (e.target !== canvas) {
+        return;
+    }
+    const hit = hitTest(e.offsetX, e.offsetY);
+    if (hit === null) {
+        tooltip.style.display = "none";
+        return;
+    }
+    showTooltip(hit, e.clientX, e.clientY);
+}
+
+function onMouseUp(e) {
+    if (drag !== null && !drag.moved && e.target === canvas) {
+        // Click: highlight the lock under the cursor, or clear the highlight
+        const hit = hitTest(e.offsetX, e.offsetY);
+        const lock = hit !== null ? hitLock(hit) : -1;
+        setHighlight(lock !== highlightLock ? lock : -1);
+    }
+    drag = null;
+}
+
+function setHighlight(lock) {
+    highlightLock = lock;
+    updateLegend();
+    requestRender();
+}
+
+// What is at a point of the canvas: {lane, row, index} of an interval, {lane, tile, i, level, bucket} of a drawn
+// bucket of a tile, or null
+function hitTest(x, y) {
+    if (trace === null || x < LABEL_WIDTH || y < AXIS_HEIGHT) {
+        return null;
+    }
+    const source = viewTrace();
+    const t = toTime(x);
+    let top = AXIS_HEIGHT - view.scrollY;
+    for (let l = 0; l < trace.lanes.length; l++) {
+        const lane = trace.lanes[l];
+        const bottom = top + lane.rows.length * ROW_HEIGHT;
+        if (y >= top && y < bottom) {
+            if (source === null) {
+                const level = tiles.level(1 / view.scale);
+                const bucket = Math.floor(t / (tiles.bucketWidth * 2 ** level));
+                const tile = tiles.get(level, l, Math.floor(bucket / tiles.tileBuckets));
+                const i = bucket % tiles.tileBuckets;
+                if (!tile || !(tile.hold[i] || tile.wait[i] || tile.blocked[i])) {
+                    return null;
+                }
+                return {lane, tile, i, level, bucket};
+            }
+            const row = source.laneByTid.get(lane.tid).rows[Math.floor((y - top) / ROW_HEIGHT)];
+            if (row === undefined) {
+                return null;
+            }
+            // Within a pixel of the cursor
+            const slack = 1 / view.scale;
+            const index = lowerBound(row.end, row.count, t - slack);
+            if (index < row.count && row.start[index] <= t + slack) {
+                return {lane, row, index, window: source !== trace ? eventWindow : null};
+            }
+            return null;
+        }
+        top = bottom + LANE_GAP;
+    }
+    return null;
+}
+
+function hitLock(hit) {
+    return hit.tile !== undefined ? hit.tile.lock[hit.i] : hit.row.lock[hit.index];
+}
+
+function formatTime(ns) {
+    const abs = Math.abs(ns);
+    if (abs >= 1e9) {
+        return `${(ns / 1e9).toPrecision(4)} s`;
+    }
+    if (abs >= 1e6) {
+        return `${(ns / 1e6).toPrecision(4)} ms`;
+    }
+    if (abs >= 1e3) {
+        return `${(ns / 1e3).toPrecision(4)} µs`;
+    }
+    return `${Math.round(ns)} ns`;
+}
+
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"]/g, (c) => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})[c]);
+}
+
+function intervalTooltip({lane, row, index, window}) {
+    const lock = trace.locks[row.lock[index]];
+    const start = row.start[index];
+    const end = row.end[index];
+    const frames = trace.stacks.get(row.stack[index]) || [];
+    // Intervals open at the edges of a window of events may be longer
+    const clipped = window !== null && (start <= window.first || end >= window.last);
+    const lines = [
+        `<b>${escapeHtml(lock.name)}</b>`,
+        `${KIND_NAMES[row.kind[index]]} of ${clipped ? "at least " : ""}${formatTime(end - start)} at ${formatTime(start)}`,
+        `thread ${lane.tid}`,
+        ...frames.slice(0, TOOLTIP_FRAMES).map(
+            (f) => `<span class="frame">${escapeHtml(f.func)} (${escapeHtml(f.file)}:${f.line})</span>`,
+        ),
+    ];
+    if (frames.length > TOOLTIP_FRAMES) {
+        lines.push(`<span class="frame">… ${frames.length - TOOLTIP_FRAMES} more frames</span>`);
+    }
+    return lines;
+}
+
+function bucketTooltip({lane, tile, i, level, bucket}) {
+    const width = tiles.bucketWidth * 2 ** level;
+    const lock = tile.lock[i];
+    const percent = (share) => `${Math.round(share * 100 / 255)}%`;
+    return [
+        `<b>${lock >= 0 ? escapeHtml(trace.locks[lock].name) : "no lock held"}</b>`,
+        `${formatTime(width)} at ${formatTime(bucket * width)}`,
+        `held ${percent(tile.hold[i])}, blocked ${percent(tile.blocked[i])}, waiting ${percent(tile.wait[i])}`,
+        `thread ${lane.tid}`,
+    ];
+}
+
+function showTooltip(hit, clientX, clientY) {
+    const lines = hit.tile !== undefined ? bucketTooltip(hit) : intervalTooltip(hit);
+    tooltip.innerHTML = lines.join("<br>");
+    tooltip.style.display = "block";
+    const x = Math.min(clientX + 12, window.innerWidth - tooltip.offsetWidth - 4);
+    const y = Math.min(clientY + 12, window.innerHeight - tooltip.offsetHeight - 4);
+    tooltip.style.left = `${Math.max(x, 0)}px`;
+    tooltip.style.top = `${Math.max(y, 0)}px`;
+}
+
+function updateLegend() {
+    if (trace === null) {
+        return;
+    }
+    const locks = trace.locks.map((lock, index) => ({lock, index}));
+    locks.sort((a, b) => b.lock.holdTime + b.lock.blockedTime - a.lock.holdTime - a.lock.blockedTime);
+    legend.innerHTML = "";
+    for (const {lock, index} of locks.slice(0, 50)) {
+        const item = document.createElement("div");
+        item.className = "legend-item" + (index === highlightLock ? " selected" : "");
+        item.innerHTML = `<span class="swatch" style="background: ${lock.color}"></span>${escapeHtml(lock.name)}`
+            + `<span class="legend-time">held ${formatTime(lock.holdTime)}, blocked ${formatTime(lock.blockedTime)}</span>`;
+        item.addEventListener("click", () => setHighlight(index === highlightLock ? -1 : index));
+        legend.appendChild(item);
+    }
+}
+
+// Drawing
+
+// `lock` is -1 for the waits of tiles, which don't know the lock
+function fillStyle(kind, lock) {
+    if (highlightLock >= 0 && lock !== highlightLock) {
+        return DIMMED;
+    }
+    if (kind === KIND_BLOCKED) {
+        return BLOCKED;
+    }
+    if (lock < 0) {
+        return WAITING;
+    }
+    return kind === KIND_HOLD ? trace.locks[lock].color : trace.locks[lock].waitColor;
+}
+
+// Add a rectangle to `rects`, {style: [x, y, width, height, ...]}
+function addRect(rects, style, x, y, width, height) {
+    let list = rects.get(style);
+    if (list === undefined) {
+        list = [];
+        rects.set(style, list);
+    }
+    list.push(x, y, width, height);
+}
+
+// Add the visible intervals of a row to `rects`
+function collectRow(row, y, rects) {
+    const left = view.start;
+    const right = toTime(canvas.clientWidth);
+    let i = lowerBound(row.end, row.count, left);
+    while (i < row.count && row.start[i] < right) {
+        const x0 = Math.max(toX(row.start[i]), LABEL_WIDTH);
+        const x1 = toX(row.end[i]);
+        addRect(rects, fillStyle(row.kind[i], row.lock[i]), x0, y, Math.max(x1 - x0, 1), ROW_HEIGHT - 2);
+        const nextPixel = Math.floor(x0) + 1;
+        // The rest of this pixel is covered already: skip to the first interval reaching the next one
+        i = x1 < nextPixel ? gallopLowerBound(row.end, row.count, toTime(nextPixel), i + 1) : i + 1;
+    }
+}
+
+// Add the visible buckets [first, last] of a lane at `level` to `rects`: the shares of the bucket spent holding (in
+// the color of the lock held the most), blocked and waiting, stacked from the top of the lane
+function collectBuckets(level, laneIndex, first, last, y, height, rects) {
+    const n = tiles.tileBuckets;
+    const width = tiles.bucketWidth * 2 ** level;
+    const pixels = Math.max(width * view.scale, 1);
+    for (let t = Math.floor(first / n); t <= Math.floor(last / n); t++) {
+        const lo = Math.max(first, t * n);
+        const hi = Math.min(last, t * n + n - 1);
+        const tile = tiles.get(level, laneIndex, t);
+        if (tile === undefined) {
+            // Coarser buckets stand in while the tile is read
+            if (level + 1 < tiles.nLevels) {
+                collectBuckets(level + 1, laneIndex, lo >> 1, hi >> 1, y, height, rects);
+            }
+            continue;
+        }
+        if (tile === null) {
+            continue;
+        }
+        for (let b = lo; b <= hi; b++) {
+            const i = b - t * n;
+            const x = Math.max(toX(b * width), LABEL_WIDTH);
+            let top = y;
+            if (tile.hold[i]) {
+                const h = height * tile.hold[i] / 255;
+                addRect(rects, fillStyle(KIND_HOLD, tile.lock[i]), x, top, pixels, h);
+                top += h;
+            }
+            if (tile.blocked[i]) {
+                const h = height * tile.blocked[i] / 255;
+                addRect(rects, fillStyle(KIND_BLOCKED, -1), x, top, pixels, h);
+                top += h;
+            }
+            if (tile.wait[i]) {
+                addRect(rects, fillStyle(KIND_WAIT, -1), x, top, pixels, height * tile.wait[i] / 255);
+            }
+        }
+    }
+}
+
+function collectTiles(laneIndex, y, height, rects) {
+    const level = tiles.level(1 / view.scale);
+    const width = tiles.bucketWidth * 2 ** level;
+    const first = Math.max(Math.floor(view.start / width), 0);
+    const last = Math.floor(Math.min(toTime(canvas.clientWidth), trace.end) / width);
+    if (first <= last) {
+        collectBuckets(level, laneIndex, first, last, y, height, rects);
+    }
+}
+
+function drawAxis(width) {
+    ctx.fillStyle = "#f8f8f8";
+    ctx.fillRect(0, 0, width, AXIS_HEIGHT);
+    // Ticks about 100px apart, on 1, 2 or 5 times a power of ten
+    const raw = 100 / view.scale;
+    const power = Math.pow(10, Math.floor(Math.log10(raw)));
+    const step = power * (raw / power < 2 ? 1 : raw / power < 5 ? 2 : 5);
+    ctx.fillStyle = "#333";
+    ctx.strokeStyle = "#ccc";
+    ctx.font = "11px sans-serif";
+    ctx.beginPath();
+    for (let t = Math.ceil(view.start / step) * step; toX(t) < width; t += step) {
+        const x = Math.round(toX(t)) + 0.5;
+        ctx.moveTo(x, AXIS_HEIGHT - 6);
+        ctx.lineTo(x, canvas.clientHeight);
+        ctx.fillText(formatTime(t), x + 3, AXIS_HEIGHT - 8);
+    }
+    ctx.stroke();
+}
 
-    // Calculate fps
-    let fps = Math.round(1 / secondsPassed);
+function render() {
+    renderQueued = false;
+    const begin = performance.now();
+    const width = canvas.clientWidth;
+    const height = canvas.clientHeight;
+    ctx.clearRect(0, 0, width, height);
+    if (trace === null) {
+        return;
+    }
+    drawAxis(width);
 
-    // Draw number to the screen
-    ctx.fillStyle = 'white';
-    ctx.fillRect(0, 0, 200, 100);
-    ctx.font = '25px Arial';
-    ctx.fillStyle = 'black';
-    ctx.fillText("FPS: " + fps, 10, 30);
+    const source = viewTrace();
+    const rects = new Map();
+    const labels = [];
+    let top = AXIS_HEIGHT - view.scrollY;
+    for (let l = 0; l < trace.lanes.length; l++) {
+        const lane = trace.lanes[l];
+        const laneHeight = lane.rows.length * ROW_HEIGHT;
+        if (top + laneHeight >= AXIS_HEIGHT && top < height) {
+            labels.push([lane, top, laneHeight]);
+            if (source === null) {
+                collectTiles(l, top + 1, laneHeight - 2, rects);
+            } else {
+                source.laneByTid.get(lane.tid).rows.forEach((row, depth) => {
+                    collectRow(row, top + depth * ROW_HEIGHT + 1, rects);
+                });
+            }
+        }
+        top += laneHeight + LANE_GAP;
+        if (top >= height) {
+            break;
+        }
+    }
+    for (const [style, list] of rects) {
+        ctx.fillStyle = style;
+        ctx.beginPath();
+        for (let i = 0; i < list.length; i += 4) {
+            ctx.rect(list[i], list[i + 1], list[i + 2], list[i + 3]);
+        }
+        ctx.fill();
+    }
 
-    draw();
+    // Thread labels over the rows scrolled under the axis
+    ctx.fillStyle = "#fff";
+    ctx.fillRect(0, AXIS_HEIGHT, LABEL_WIDTH, height);
+    ctx.fillStyle = "#333";
+    ctx.font = "12px sans-serif";
+    for (const [lane, y, laneHeight] of labels) {
+        if (y >= AXIS_HEIGHT) {
+            ctx.fillText(`thread ${lane.tid}`, 6, y + Math.min(laneHeight, ROW_HEIGHT) - 3, LABEL_WIDTH - 12);
+        }
+    }
+    ctx.fillStyle = "#f8f8f8";
+    ctx.fillRect(0, 0, LABEL_WIDTH, AXIS_HEIGHT);
 
-    lastRender = timestamp;
-    window.requestAnimationFrame(gameLoop);
+    renderTime = performance.now() - begin;
+    document.getElementById("render-time").textContent = `${renderTime.toFixed(1)} ms/frame`;
 }
@@ -225,11 +225,13 @@ if __name__ == '__main__':
         "all": parse_requirements("requirements.txt"),
         "tests": parse_requirements("requirements/tests.txt"),
         "ipython": parse_requirements('requirements/ipython.txt'),
+        "numpy": parse_requirements('requirements/numpy.txt'),
         'build': parse_requirements('requirements/build.txt'),
         "runtime-strict": parse_requirements("requirements/runtime.txt", versions="strict"),
         "all-strict": parse_requirements("requirements.txt", versions="strict"),
         "tests-strict": parse_requirements("requirements/tests.txt", versions="strict"),
         "ipython-strict": parse_requirements('requirements/ipython.txt', versions="strict"),
+        "numpy-strict": parse_requirements('requirements/numpy.txt', versions="strict"),
         'build-strict': parse_requirements('requirements/build.txt', versions="strict"),
     }
     setupkw['entry_points'] = {
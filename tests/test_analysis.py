@@ -0,0 +1,278 @@
+import dataclasses
+import random
+
+import pytest
+
+from lock_profiler.analysis import analyze
+from lock_profiler.lock_profiler import LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, \
+    PY_F_BLOCKED, PY_F_SAMPLE_SHIFT, PY_F_UNCALIBRATED
+
+W, A, R = PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+STACKS = {
+    1: [StackFrame("Lockable.py", "__enter__", 5), StackFrame("app.py", "f", 10), StackFrame("app.py", "main", 30)],
+    2: [StackFrame("Lockable.py", "__enter__", 5), StackFrame("app.py", "g", 20), StackFrame("app.py", "main", 31)],
+}
+
+
+def make_stats(events):
+    return LockStats({7: "lock 7", 8: "lock 8"}, STACKS, [LockEvent(*e) for e in events])
+
+
+def stat_values(stat):
+    return dataclasses.astuple(stat)[:-2]
+
+
+def results(contention):
+    return (
+        {k: stat_values(v) for k, v in contention.lock_stats.items()},
+        {
+            (file, line, lock): stat_values(stat)
+            for file, lines in contention.file_stats.items()
+            for line, locks in lines.items()
+            for lock, stat in locks.items()
+        },
+        {
+            (stack_hash, lock): stat_values(stat)
+            for stack_hash, locks in contention.stack_stats.items()
+            for lock, stat in locks.items()
+        },
+    )
+
+
+@pytest.fixture(params=[False, True], ids=["python", "numpy"])
+def use_numpy(request):
+    if request.param:
+        pytest.importorskip("numpy")
+    return request.param
+
+
+def test_blocked_acquire(use_numpy):
+    stats = make_stats([
+        # (timestamp, flag, tid, lock, stack)
+        (0, W, 1, 7, 1),
+        (1, A, 1, 7, 0),
+        (2, W, 2, 7, 2),
+        # Re-entrant acquire in thread 1
+        (3, W, 1, 7, 2),
+        (4, A, 1, 7, 0),
+        (6, R, 1, 7, 0),
+        (10, R, 1, 7, 0),
+        (12, A, 2, 7, 0),
+        (15, R, 2, 7, 0),
+    ])
+    contention = analyze(stats, use_numpy=use_numpy)
+    lock = contention.lock_stats[7]
+    assert (lock.hits, lock.acquires, lock.blocks) == (3, 2, 1)
+    assert (lock.total_wait_time, lock.max_wait_time) == (1 + 10 + 1, 10)
+    assert (lock.total_hold_time, lock.max_hold_time) == (9 + 3, 9)
+    assert (lock.total_block_time, lock.max_block_time, lock.avg_block_time) == (10, 10, 10)
+    assert lock.avg_wait_time == 12 // 2
+    assert lock.wait_histogram.total_count == 3
+    assert lock.hold_histogram.percentiles() == {50: 3, 90: 9, 99: 9, 99.9: 9}
+    assert lock.block_histogram.percentile(50) == 10
+
+    assert "Lockable.py" not in contention.file_stats
+    f = contention.file_stats["app.py"][10][7]
+    assert (f.hits, f.acquires, f.blocks, f.total_wait_time, f.total_hold_time) == (1, 1, 0, 1, 9)
+    g = contention.file_stats["app.py"][20][7]
+    assert (g.hits, g.acquires, g.blocks, g.total_wait_time, g.total_block_time, g.total_hold_time) == (2, 2, 1, 11, 10, 5)
+    assert g.block_histogram.percentile(50) == 10
+    main = contention.file_stats["app.py"][31][7]
+    assert (main.hits, main.acquires, main.blocks, main.total_hold_time) == (2, 2, 1, 5)
+
+    # Whole stacks too
+    g = contention.stack_stats[2][7]
+    assert (g.hits, g.acquires, g.blocks, g.total_wait_time, g.total_block_time, g.total_hold_time) == (2, 2, 1, 11, 10, 5)
+    assert contention.stack_stats[1][7].total_blame_time == 10 - 2
+
+
+def test_overhead_is_subtracted(use_numpy):
+    stats = make_stats([
+        (0, W, 1, 7, 1),
+        (5, A, 1, 7, 0),
+        (6, R, 1, 7, 0),
+        (10, W, 1, 7, 1),
+        (12, A, 1, 7, 0),
+        (20, R, 1, 7, 0),
+    ])
+    stats.wait_overhead, stats.hold_overhead = 3, 2
+    lock = analyze(stats, use_numpy=use_numpy).lock_stats[7]
+    # Times shorter than the overhead are clamped to 0
+    assert (lock.total_wait_time, lock.max_wait_time) == (2 + 0, 2)
+    assert (lock.total_hold_time, lock.max_hold_time) == (0 + 6, 6)
+
+
+def test_overhead_is_not_subtracted_from_uncalibrated_hooks(use_numpy):
+    stats = make_stats([
+        (0, W, 1, 7, 1),
+        (5, A | PY_F_UNCALIBRATED, 1, 7, 0),
+        (6, R, 1, 7, 0),
+        (10, W, 1, 7, 1),
+        (12, A, 1, 7, 0),
+        (20, R, 1, 7, 0),
+    ])
+    stats.wait_overhead, stats.hold_overhead = 3, 2
+    lock = analyze(stats, use_numpy=use_numpy).lock_stats[7]
+    assert (lock.total_wait_time, lock.total_hold_time) == (5 + 0, 1 + 6)
+
+
+def test_flagged_block(use_numpy):
+    stats = make_stats([
+        # The holder's acquisition wasn't recorded in contention-only mode
+        (0, W | PY_F_BLOCKED, 1, 7, 1),
+        (8, A, 1, 7, 0),
+        (9, R, 1, 7, 0),
+    ])
+    stats.uncontended_counts = {7: 5}
+    contention = analyze(stats, use_numpy=use_numpy)
+    lock = contention.lock_stats[7]
+    assert (lock.hits, lock.acquires, lock.blocks, lock.total_block_time) == (1, 1, 1, 8)
+    assert contention.file_stats["app.py"][10][7].total_wait_time == 8
+    assert contention.uncontended == {7: 5}
+
+
+def test_blame(use_numpy):
+    stats = make_stats([
+        (0, W, 1, 7, 1),
+        (1, A, 1, 7, 0),
+        (2, W, 2, 7, 2),
+        (3, W, 3, 7, 2),
+        (5, R, 1, 7, 0),
+        (6, A, 2, 7, 0),
+        (9, R, 2, 7, 0),
+        (10, A, 3, 7, 0),
+        (11, R, 3, 7, 0),
+    ])
+    contention = analyze(stats, use_numpy=use_numpy)
+    lock = contention.lock_stats[7]
+    # Thread 1 blocked threads 2 and 3, then thread 2 blocked thread 3
+    assert (lock.blames, lock.total_blame_time) == (3, (5 - 2) + (5 - 3) + (9 - 6))
+    f = contention.file_stats["app.py"][10][7]
+    assert (f.blames, f.total_blame_time) == (2, 5)
+    g = contention.file_stats["app.py"][20][7]
+    assert (g.blames, g.total_blame_time) == (1, 3)
+    assert g.summary()[-2:] == (1, 3)
+
+
+def test_sampled_estimates(use_numpy):
+    # Weights 4 and 1
+    w4 = W | 2 << PY_F_SAMPLE_SHIFT
+    stats = make_stats([
+        (0, w4, 1, 7, 1),
+        (2, A, 1, 7, 0),
+        (7, R, 1, 7, 0),
+        (8, W, 1, 7, 1),
+        (9, A, 1, 7, 0),
+        (10, R, 1, 7, 0),
+    ])
+    contention = analyze(stats, use_numpy=use_numpy)
+    lock = contention.lock_stats[7]
+    assert (lock.acquires, lock.total_wait_time, lock.total_hold_time) == (2, 3, 6)
+    assert lock.estimate("acquires").value == 5
+    assert lock.estimate("total_wait_time").value == 4 * 2 + 1
+    hold = lock.estimate("total_hold_time")
+    # Variance w * (w - 1) * x^2 of the weighted hold time
+    assert hold.value == 4 * 5 + 1
+    assert hold.high - hold.value == pytest.approx(1.96 * (12 * 25) ** 0.5)
+    assert hold.low == 6
+    assert lock.estimate("blocks") == (0, 0, 0)
+    assert contention.file_stats["app.py"][10][7].estimate("acquires").value == 5
+    with pytest.raises(ValueError):
+        lock.estimate("max_wait_time")
+
+
+def test_cross_thread_release(use_numpy):
+    stats = make_stats([
+        (0, W, 1, 7, 1),
+        (1, A, 1, 7, 0),
+        (2, W, 2, 7, 2),
+        # Plain locks can be released by another thread than the holder
+        (5, R, 3, 7, 0),
+        (6, A, 2, 7, 0),
+        (8, R, 2, 7, 0),
+        (10, W, 1, 7, 1),
+        (11, A, 1, 7, 0),
+        (12, R, 1, 7, 0),
+    ])
+    contention = analyze(stats, use_numpy=use_numpy)
+    lock = contention.lock_stats[7]
+    assert (lock.hits, lock.acquires, lock.blocks, lock.total_block_time) == (3, 3, 1, 4)
+    assert (lock.total_hold_time, lock.hold_histogram.total_count) == (4 + 2 + 1, 3)
+    assert (lock.blames, lock.total_blame_time) == (1, 5 - 2)
+    assert contention.file_stats["app.py"][10][7].total_hold_time == 4 + 1
+
+
+def test_truncated_trace(use_numpy):
+    stats = make_stats([
+        # The start of the trace was overwritten
+        (0, A, 1, 7, 0),
+        (1, R, 1, 7, 0),
+        (2, W, 1, 7, 1),
+        (3, A, 1, 7, 0),
+        (5, R, 1, 7, 0),
+        # Never released
+        (6, W, 2, 8, 2),
+        (7, A, 2, 8, 0),
+    ])
+    contention = analyze(stats, use_numpy=use_numpy)
+    assert stat_values(contention.lock_stats[7])[:4] == (1, 1, 0, 1)
+    assert contention.lock_stats[7].total_hold_time == 2
+    assert contention.lock_stats[8].acquires == 1
+    assert contention.lock_stats[8].total_hold_time == 0
+    assert list(contention.lock_stats) == [7, 8]
+
+
+def random_trace(seed, n_threads=4, n_locks=3, n_steps=2000, handoff=0.05):
+    """Simulate threads taking nested and re-entrant locks, with realistic blocking.
+
+    Locks are taken in increasing order, so the threads never deadlock. With probability `handoff`, a thread
+    releases a lock another thread holds once, like plain locks allow.
+    """
+    rng = random.Random(seed)
+    events = []
+    holder = {}
+    # Per thread: stack of held locks, or the lock being waited for
+    held = {tid: [] for tid in range(n_threads)}
+    waiting = {}
+    for t in range(n_steps):
+        tid = rng.randrange(n_threads)
+        if tid in waiting:
+            lock = waiting[tid]
+            if holder.get(lock, (tid,))[0] == tid:
+                del waiting[tid]
+                holder[lock] = (tid, holder.get(lock, (tid, 0))[1] + 1)
+                held[tid].append(lock)
+                events.append((t, A, tid, lock, 0))
+        elif rng.random() < handoff and any(owner != tid and depth == 1 for owner, depth in holder.values()):
+            lock = rng.choice(sorted(
+                lock for lock, (owner, depth) in holder.items() if owner != tid and depth == 1
+            ))
+            owner, _ = holder.pop(lock)
+            held[owner].remove(lock)
+            events.append((t, R, tid, lock, 0))
+        elif held[tid] and rng.random() < 0.5:
+            lock = held[tid].pop()
+            owner, depth = holder[lock]
+            holder[lock] = (owner, depth - 1)
+            if depth == 1:
+                del holder[lock]
+            events.append((t, R, tid, lock, 0))
+        else:
+            lowest = max(held[tid], default=0)
+            if lowest == n_locks - 1:
+                continue
+            lock = rng.randrange(lowest, n_locks)
+            events.append((t, W, tid, lock, rng.choice([1, 2])))
+            waiting[tid] = lock
+    return LockStats({lock: f"lock {lock}" for lock in range(n_locks)}, STACKS, [LockEvent(*e) for e in events])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_numpy_matches_python(seed):
+    pytest.importorskip("numpy")
+    stats = random_trace(seed)
+    assert results(analyze(stats, use_numpy=True)) == results(analyze(stats, use_numpy=False))
+    # Truncated traces are handled the same way too
+    stats.lock_list = stats.lock_list[len(stats.lock_list) // 3:]
+    assert results(analyze(stats, use_numpy=True)) == results(analyze(stats, use_numpy=False))
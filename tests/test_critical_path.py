@@ -0,0 +1,118 @@
+import threading
+import time
+
+from lock_profiler import LockProfiler, ProfiledLock
+from lock_profiler.critical_path import Segment, critical_path, critical_paths
+from lock_profiler.lock_profiler import LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+W, A, R = PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+STACKS = {
+    1: [StackFrame("app.py", "f", 10), StackFrame("app.py", "main", 30)],
+    2: [StackFrame("app.py", "g", 20), StackFrame("app.py", "main", 31)],
+}
+
+
+def make_stats():
+    events = [
+        # (timestamp, flag, tid, lock, stack)
+        (0, W, 1, 7, 1),
+        (1, A, 1, 7, 0),
+        # Blocked until thread 1 releases
+        (2, W, 2, 7, 2),
+        (10, R, 1, 7, 0),
+        (12, A, 2, 7, 0),
+        (15, R, 2, 7, 0),
+        (20, W, 2, 8, 1),
+        (21, A, 2, 8, 0),
+        (22, R, 2, 8, 0),
+    ]
+    return LockStats({7: "lock 7", 8: "lock 8"}, STACKS, [LockEvent(*e) for e in events])
+
+
+def test_critical_path():
+    path = critical_path(make_stats())
+    assert path.length == 22
+    assert path.segments == [Segment(1, 0, 10), Segment(2, 12, 22)]
+    lock = path.lock_stats[7]
+    assert (lock.hold_time, lock.handoff_time, lock.handoffs) == (9 + 3, 2, 1)
+    assert path.lock_stats[8].hold_time == 1
+    assert list(path.lock_stats) == [7, 8]
+    assert path.share(7) == 14 / 22
+
+    # Hold time goes to the holder's call sites, handoff time to the waiter's
+    assert path.file_stats["app.py"][10][7].hold_time == 9
+    assert path.file_stats["app.py"][20][7].hold_time == 3
+    assert path.file_stats["app.py"][20][7].handoff_time == 2
+    assert path.file_stats["app.py"][10][8].hold_time == 1
+
+
+def test_intervals():
+    stats = make_stats()
+    path = critical_paths(stats, [(11, 22)])
+    assert path.segments == [Segment(2, 12, 22)]
+    assert (path.lock_stats[7].hold_time, path.lock_stats[7].handoff_time) == (3, 1)
+
+    # Ending on a thread that was never blocked
+    path = critical_path(stats, tid=1)
+    assert path.segments == [Segment(1, 0, 22)]
+    assert path.lock_stats == {7: path.lock_stats[7]}
+    assert path.lock_stats[7].hold_time == 9
+
+    # Intervals add up
+    path = critical_paths(stats, [(0, 10), (11, 22)])
+    assert path.length == 21
+    assert path.lock_stats[7].hold_time == 9 + 3
+
+
+def test_cross_thread_release():
+    events = [
+        (0, W, 1, 7, 1),
+        (1, A, 1, 7, 0),
+        (2, W, 2, 7, 2),
+        # Plain locks can be released by another thread than the holder
+        (5, R, 3, 7, 0),
+        (6, A, 2, 7, 0),
+        (8, R, 2, 7, 0),
+        (10, W, 1, 7, 1),
+        (11, A, 1, 7, 0),
+        (12, R, 1, 7, 0),
+    ]
+    stats = LockStats({7: "lock 7"}, STACKS, [LockEvent(*e) for e in events])
+    # The releasing thread hands the lock over
+    path = critical_path(stats, end=8, tid=2)
+    assert path.segments == [Segment(3, 0, 5), Segment(2, 6, 8)]
+    lock = path.lock_stats[7]
+    assert (lock.hold_time, lock.handoff_time, lock.handoffs) == (2, 1, 1)
+    # It ends the critical section of the holder
+    path = critical_path(stats, tid=1)
+    assert path.segments == [Segment(1, 0, 12)]
+    assert path.lock_stats[7].hold_time == 4 + 1
+
+
+def test_recorded_path():
+    LockProfiler.clear_trace()
+    lock = ProfiledLock()
+    holding = threading.Event()
+
+    def hold():
+        with lock:
+            holding.set()
+            time.sleep(0.02)
+
+    start = LockProfiler.timestamp()
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait(5)
+    with lock:
+        pass
+    end = LockProfiler.timestamp()
+    thread.join()
+
+    path = LockProfiler.get_critical_path([(start, end, threading.get_ident())])
+    LockProfiler.clear_trace()
+    # Through the other thread's critical section
+    assert [segment.tid for segment in path.segments] == [thread.ident, threading.get_ident()]
+    assert path.lock_stats[lock.lock_id].handoffs == 1
+    # Mostly waiting for the other thread's critical section
+    assert path.share(lock.lock_id) > 0.5
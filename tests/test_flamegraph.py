@@ -0,0 +1,82 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from lock_profiler.flamegraph import collapsed_stacks, main, write_svg
+from lock_profiler.lock_profiler import LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+from lock_profiler.trace_file import write_trace
+
+W, A, R = PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+STACKS = {
+    1: [StackFrame("Lockable.py", "__enter__", 5), StackFrame("app.py", "f", 10), StackFrame("app.py", "main", 30)],
+    2: [StackFrame("Lockable.py", "__enter__", 5), StackFrame("app.py", "f", 10), StackFrame("app.py", "run", 40)],
+    3: [StackFrame("app.py", "g", 20)],
+}
+
+F = "main (app.py:30);f (app.py:10)"
+
+
+def make_stats():
+    events = [
+        # (timestamp, flag, tid, lock, stack)
+        (0, W, 1, 7, 1),
+        (1, A, 1, 7, 0),
+        # Blocked until thread 1 releases
+        (2, W, 2, 7, 2),
+        (3, W, 1, 8, 3),
+        (5, A, 1, 8, 0),
+        (6, R, 1, 8, 0),
+        (10, R, 1, 7, 0),
+        (12, A, 2, 7, 0),
+        (15, R, 2, 7, 0),
+    ]
+    return LockStats({7: "lock;7", 8: "lock 8"}, STACKS, [LockEvent(*e) for e in events])
+
+
+def test_metrics():
+    stats = make_stats()
+    # `;` in names would split frames
+    assert collapsed_stacks(stats, "wait") == {
+        f"{F};lock,7": 1,
+        "run (app.py:40);f (app.py:10);lock,7": 10,
+        "g (app.py:20);lock 8": 2,
+    }
+    assert collapsed_stacks(stats, "hold") == {
+        f"{F};lock,7": 9,
+        "run (app.py:40);f (app.py:10);lock,7": 3,
+        "g (app.py:20);lock 8": 1,
+    }
+    assert collapsed_stacks(stats, "block") == {"run (app.py:40);f (app.py:10);lock,7": 10}
+    # Charged to the stack holding the lock
+    assert collapsed_stacks(stats, "blame") == {f"{F};lock,7": 10 - 2}
+    with pytest.raises(ValueError):
+        collapsed_stacks(stats, "cpu")
+
+
+def test_svg(tmp_path):
+    write_svg(tmp_path / "wait.svg", {"a;b;lock 1": 30, "a;lock <2>": 10})
+    svg = ET.parse(tmp_path / "wait.svg").getroot()
+    ns = "{http://www.w3.org/2000/svg}"
+    frames = {}
+    for g in svg.iter(ns + "g"):
+        rect = g.find(ns + "rect")
+        frames[g.find(ns + "title").text.split(":")[0]] = (float(rect.get("x")), float(rect.get("width")))
+    assert set(frames) == {"all", "a", "b", "lock 1", "lock <2>"}
+    assert frames["all"] == frames["a"]
+    assert frames["b"][1] == pytest.approx(frames["all"][1] * 0.75, abs=0.1)
+    # Children are sorted by name, so that "b" comes first
+    assert frames["lock <2>"][0] == pytest.approx(frames["b"][0] + frames["b"][1], abs=0.1)
+
+
+def test_main(tmp_path):
+    write_trace(tmp_path / "trace.lkprof", make_stats())
+    assert main([str(tmp_path / "trace.lkprof"), str(tmp_path / "hold.folded"), "--metric", "hold"]) == 0
+    with open(tmp_path / "hold.folded") as f:
+        assert f.read().splitlines() == [
+            "g (app.py:20);lock 8 1",
+            f"{F};lock,7 9",
+            "run (app.py:40);f (app.py:10);lock,7 3",
+        ]
+    assert main([str(tmp_path / "trace.lkprof"), str(tmp_path / "block.svg"), "--metric", "block"]) == 0
+    ET.parse(tmp_path / "block.svg")
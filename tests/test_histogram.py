@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from lock_profiler.histogram import Histogram, N_BUCKETS, bucket_bounds, bucket_index, bucket_indices
+
+
+def test_buckets():
+    assert [bucket_index(v) for v in range(16)] == list(range(16))
+    assert bucket_index(-5) == 0
+    assert bucket_index(2 ** 63 - 1) == N_BUCKETS - 1
+    rng = random.Random(0)
+    for _ in range(1000):
+        value = rng.randrange(1 << rng.randrange(1, 63))
+        low, high = bucket_bounds(bucket_index(value))
+        assert low <= value <= high
+        # Relative error is at most 1/16
+        assert (high - low + 1) * 16 <= max(low, 16)
+
+
+def test_bucket_indices_match():
+    np = pytest.importorskip("numpy")
+    rng = random.Random(0)
+    values = [rng.randrange(1 << rng.randrange(1, 52)) for _ in range(1000)] + list(range(-2, 40))
+    assert bucket_indices(np.array(values)).tolist() == [bucket_index(v) for v in values]
+
+
+def test_percentiles():
+    hist = Histogram()
+    assert hist.percentile(50) == 0
+    for value in range(1, 1001):
+        hist.record(value)
+    assert hist.total_count == 1000
+    p = hist.percentiles()
+    for percentile, value in p.items():
+        exact = percentile * 10
+        assert exact <= value <= exact * 17 / 16
+    assert p[50] <= p[90] <= p[99] <= p[99.9]
+
+
+def test_merge():
+    a, b, both = Histogram(), Histogram(), Histogram()
+    for value in range(0, 5000, 7):
+        a.record(value)
+        both.record(value)
+    for value in range(3, 100000, 11):
+        b.record(value)
+        both.record(value)
+    assert a.merge(b) == both
+    assert Histogram.from_dict(both.to_dict()) == both
@@ -0,0 +1,87 @@
+import queue
+import threading
+
+import pytest
+
+import lock_profiler
+from lock_profiler import LockProfiler, ProfiledLock, ProfiledRLock
+
+
+@pytest.fixture
+def installed():
+    LockProfiler.clear_trace()
+    lock_profiler.install()
+    try:
+        yield
+    finally:
+        lock_profiler.uninstall()
+        LockProfiler.clear_trace()
+
+
+def test_install_replaces_locks(installed):
+    lock = threading.Lock()
+    rlock = threading.RLock()
+    line = test_install_replaces_locks.__code__.co_firstlineno
+    assert isinstance(lock, ProfiledLock)
+    assert isinstance(rlock, ProfiledRLock)
+    assert lock.name == f"{__file__}:{line + 1}"
+    assert rlock.name == f"{__file__}:{line + 2}"
+
+    # Locks created inside threading are named after the caller
+    event = threading.Event()
+    cond = threading.Condition()
+    assert event._cond._lock.name == f"{__file__}:{line + 10}"
+    assert isinstance(cond._lock, ProfiledRLock)
+
+    lock_profiler.uninstall()
+    assert not isinstance(threading.Lock(), ProfiledLock)
+    assert not isinstance(threading.RLock(), ProfiledRLock)
+
+
+def test_replacements_are_classes():
+    lock = threading.Lock()
+    rlock = threading.RLock()
+    lock_profiler.install()
+    try:
+        assert isinstance(threading.Lock(), threading.Lock)
+        assert isinstance(threading.RLock(), threading.RLock)
+        # Also the plain locks created before
+        assert isinstance(lock, threading.Lock) and not isinstance(lock, threading.RLock)
+        assert isinstance(rlock, threading.RLock)
+
+        class NamedLock(threading.Lock):
+            def __init__(self, label):
+                super().__init__()
+                self.label = label
+
+        named = NamedLock("label")
+        with named:
+            pass
+        assert named.label == "label" and isinstance(named, ProfiledLock)
+        assert named.name.startswith(f"{__file__}:")
+        assert not isinstance(lock, NamedLock)
+    finally:
+        lock_profiler.uninstall()
+        LockProfiler.clear_trace()
+
+
+def test_stdlib_locks_are_profiled(installed):
+    q = queue.Queue()
+    line = test_stdlib_locks_are_profiled.__code__.co_firstlineno
+
+    def producer():
+        for i in range(100):
+            q.put(i)
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    assert [q.get() for _ in range(100)] == list(range(100))
+    thread.join()
+
+    names = LockProfiler.get_lock_names()
+    assert q.mutex.name.startswith(queue.__file__)
+    assert q.mutex.lock_id in names
+    contention = LockProfiler.get_contention_stats()
+    assert contention.lock_stats[q.mutex.lock_id].acquires >= 200
+    # The queue's calls are attributed to this file
+    assert any(line < l for l in contention.file_stats[__file__])
@@ -0,0 +1,164 @@
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import lock_profiler
+from lock_profiler import LockProfiler, ProfiledLock
+from lock_profiler.analysis import from_aggregates
+from lock_profiler._lock_profiler import PY_EVENT_CHUNK_SIZE, LiveAggregates
+from lock_profiler.live import StatsServer
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    LockProfiler.clear_trace()
+    yield
+    LockProfiler.clear_trace()
+
+
+def contend(lock, n=200):
+    def work():
+        for _ in range(n):
+            with lock:
+                pass
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def acquire(lock):
+    with lock:
+        pass
+
+
+def counters(contention):
+    return {lock: stat.summary()[:-2] for lock, stat in contention.lock_stats.items()}
+
+
+def site_counters(contention):
+    return {
+        (file, line, lock): stat.summary()[:-2]
+        for file, lines in contention.file_stats.items()
+        for line, locks in lines.items()
+        for lock, stat in locks.items()
+    }
+
+
+def test_live_aggregates():
+    lock = ProfiledLock()
+    live = LiveAggregates()
+    contend(lock)
+    assert len(live.update()) == 3 * 800
+    assert len(live.update()) == 0
+    contend(lock)
+    new = live.update()
+    assert len(new) == live.events - 3 * 800 == 3 * 800
+    timestamps = [e.timestamp for e in new]
+    assert timestamps == sorted(timestamps)
+
+    # The same as the analysis of all the events at once, but without blame
+    stats = LockProfiler.get_stats()
+    contention = from_aggregates(*live.get_aggregates(), stats.stack_hashes)
+    assert counters(contention) == counters(LockProfiler.get_contention_stats())
+    assert site_counters(contention) == site_counters(LockProfiler.get_contention_stats())
+    assert contention.lock_stats[lock.lock_id].hits == 1600
+
+    LockProfiler.clear_trace()
+    with lock:
+        pass
+    live.update()
+    assert (live.events, live.resets) == (3, 1)
+    assert live.get_aggregates()[0][lock.lock_id][:2] == (1, 1)
+
+
+def test_lost_events():
+    lock = ProfiledLock()
+    live = LiveAggregates()
+    LockProfiler.set_buffer_limit(max_events=2 * PY_EVENT_CHUNK_SIZE)
+    try:
+        for _ in range(10 * PY_EVENT_CHUNK_SIZE):
+            with lock:
+                pass
+        live.update()
+    finally:
+        LockProfiler.set_buffer_limit()
+    # Only the events still in memory are read
+    assert live.events <= 2 * PY_EVENT_CHUNK_SIZE
+    assert live.events + live.lost_events == 30 * PY_EVENT_CHUNK_SIZE
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def test_server():
+    lock = ProfiledLock("contended")
+    with StatsServer(interval=60, top=1, recent=3) as server:
+        url = "http://%s:%d" % server.address
+        assert get(url + "/locks") == []
+        contend(lock)
+        # Holding the lock while another thread waits for it
+        with lock:
+            thread = threading.Thread(target=acquire, args=(lock,))
+            thread.start()
+            while LockProfiler.get_stats(as_array=True).lock_list[-1].tid != thread.ident:
+                time.sleep(0.001)
+            server.refresh()
+        thread.join()
+
+        snapshot = get(url + "/")
+        assert snapshot["events"] == 3 * 800 + 2 + 1 and snapshot["lost_events"] == 0
+        [stats] = snapshot["locks"]
+        assert (stats["name"], stats["hits"], stats["acquires"]) == ("contended", 801, 801)
+        assert set(stats["percentiles"]) == {"wait", "hold", "block"}
+        [site] = snapshot["sites"]
+        assert site["file"] == __file__ and site["name"] == "contended"
+        assert get(url + "/sites") == snapshot["sites"]
+        # The latest ones, ending with the wait of the blocked thread
+        assert [e["kind"] for e in snapshot["recent"]] == ["wait", "acquire", "wait"]
+        assert snapshot["recent"][-1]["tid"] == thread.ident
+        assert snapshot["recent"][-1]["stack"][0][1] == "acquire"
+        with pytest.raises(urllib.error.HTTPError):
+            get(url + "/missing")
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "stats.sock")
+    lock = ProfiledLock("unix")
+    with lock:
+        pass
+    with LockProfiler.serve_stats(path):
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(path)
+        client.sendall(b"GET /locks HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+        head, body = response.split(b"\r\n\r\n", 1)
+        assert head.startswith(b"HTTP/1.0 200")
+        assert [stats["name"] for stats in json.loads(body)] == ["unix"]
+    assert not (tmp_path / "stats.sock").exists()
+
+
+def test_server_threads_are_not_profiled():
+    lock_profiler.install()
+    try:
+        with StatsServer(interval=0.01) as server:
+            get("http://%s:%d/locks" % server.address)
+            time.sleep(0.05)
+    finally:
+        lock_profiler.uninstall()
+    assert LockProfiler.get_stats().lock_list == []
@@ -0,0 +1,279 @@
+import threading
+import time
+
+import pytest
+
+from lock_profiler import LockProfiler, ProfiledLock, ProfiledRLock
+from lock_profiler.lock_profiler import PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_E_MASK, PY_F_SAMPLE_SHIFT, \
+    PY_F_BLOCKED
+
+W, A, R = PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+
+def flags(stats):
+    return [e.flag for e in stats.lock_list]
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    LockProfiler.clear_trace()
+    yield
+    LockProfiler.clear_trace()
+
+
+def test_lock():
+    lock = ProfiledLock("my lock")
+    with lock:
+        assert lock.locked()
+        assert not lock.acquire(blocking=False)
+        assert not lock.acquire(timeout=0.001)
+    assert lock.acquire()
+    lock.release()
+    with pytest.raises(RuntimeError):
+        lock.release()
+
+    stats = LockProfiler.get_stats()
+    # Failed acquisitions only record a wait
+    assert flags(stats)[:5] == [W, A, W, W, R]
+    assert flags(stats)[5:8] == [W, A, R]
+    assert {e.lock_hash for e in stats.lock_list} == {lock.lock_id}
+    assert stats.lock_hashes[lock.lock_id] == "my lock"
+
+    # The call stack starts at the caller, no wrapper frames
+    stack = stats.stack_hashes[stats.lock_list[0].stack_hash]
+    assert stack[0].functionName == "test_lock"
+    assert stack[0].lineNo == test_lock.__code__.co_firstlineno + 2
+
+
+def test_rlock():
+    lock = ProfiledRLock()
+    with lock:
+        with lock:
+            assert lock._is_owned()
+    assert not lock._is_owned()
+    with pytest.raises(RuntimeError):
+        lock.release()
+    assert flags(LockProfiler.get_stats()) == [W, A, W, A, R, R]
+
+    contention = LockProfiler.get_contention_stats()
+    stat = contention.lock_stats[lock.lock_id]
+    assert (stat.hits, stat.acquires) == (2, 1)
+
+
+@pytest.mark.parametrize("lock_type", [ProfiledLock, ProfiledRLock])
+def test_condition(lock_type):
+    lock = lock_type()
+    cond = threading.Condition(lock)
+    ready = []
+
+    def notify():
+        with cond:
+            ready.append(True)
+            cond.notify()
+
+    with cond:
+        if lock_type is ProfiledRLock:
+            # Waiting releases every level
+            lock.acquire()
+        thread = threading.Thread(target=notify)
+        thread.start()
+        assert cond.wait_for(lambda: ready, timeout=5)
+        if lock_type is ProfiledRLock:
+            lock.release()
+    thread.join()
+
+    contention = LockProfiler.get_contention_stats()
+    stat = contention.lock_stats[lock.lock_id]
+    # Every acquisition was released
+    assert stat.hold_histogram.total_count == stat.acquires
+    assert stat.acquires >= 3
+
+
+def test_contention():
+    lock = ProfiledLock()
+    counter = [0]
+
+    def work():
+        for _ in range(1000):
+            with lock:
+                counter[0] += 1
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter[0] == 4000
+
+    stat = LockProfiler.get_contention_stats().lock_stats[lock.lock_id]
+    assert stat.hits == stat.acquires == 4000
+
+
+@pytest.fixture
+def contention_only():
+    LockProfiler.set_contention_only()
+    yield
+    LockProfiler.set_contention_only(False)
+
+
+@pytest.mark.parametrize("lock_type", [ProfiledLock, ProfiledRLock])
+def test_unused_lock_ids(lock_type):
+    used = lock_type("used")
+    with used:
+        pass
+    unused = lock_type("unused")
+    unused_id = unused.lock_id
+    LockProfiler.set_lock_sampling(unused_id, 1 / 2)
+    del unused
+    # Nothing was recorded under its ID, so the next lock takes it, without its settings
+    assert unused_id not in LockProfiler.get_lock_names()
+    reused = lock_type("reused")
+    assert reused.lock_id == unused_id
+    assert LockProfiler.get_lock_names()[unused_id] == "reused"
+    with reused:
+        pass
+    assert len(LockProfiler.get_stats().lock_list) == 6
+    # Events were recorded under the ID of the used lock, which keeps it
+    used_id = used.lock_id
+    del used
+    assert LockProfiler.get_lock_names()[used_id] == "used"
+    assert lock_type().lock_id not in (used_id, unused_id)
+
+
+@pytest.mark.parametrize("lock_type", [ProfiledLock, ProfiledRLock])
+def test_contention_only(lock_type, contention_only):
+    lock = lock_type()
+    with lock:
+        if lock_type is ProfiledRLock:
+            with lock:
+                pass
+    assert flags(LockProfiler.get_stats()) == []
+
+    holding = threading.Event()
+    done = threading.Event()
+
+    def hold():
+        with lock:
+            holding.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait(5)
+    assert not lock.acquire(blocking=False)
+    threading.Timer(0.01, done.set).start()
+    with lock:
+        pass
+    thread.join()
+
+    stats = LockProfiler.get_stats()
+    # Only the blocked acquisition is recorded, with its release
+    assert flags(stats) == [W | PY_F_BLOCKED, A, R]
+    assert stats.uncontended_counts == {lock.lock_id: 3 if lock_type is ProfiledRLock else 2}
+
+    contention = LockProfiler.get_contention_stats()
+    stat = contention.lock_stats[lock.lock_id]
+    assert (stat.hits, stat.acquires, stat.blocks) == (1, 1, 1)
+    assert stat.total_block_time == stat.total_wait_time > 0
+    assert contention.uncontended == stats.uncontended_counts
+
+
+def test_contention_only_condition(contention_only):
+    lock = ProfiledRLock()
+    cond = threading.Condition(lock)
+    with cond:
+        with lock:
+            cond.wait(0.001)
+    assert flags(LockProfiler.get_stats()) == []
+    # Both levels, acquired again after the wait
+    assert LockProfiler.get_uncontended_counts() == {lock.lock_id: 4}
+
+
+def test_count_uncontended():
+    lock = ProfiledLock()
+    LockProfiler.count_uncontended(lock.lock_id, 3)
+    for lock_id in (-5, 0, 10**15):
+        with pytest.raises(ValueError):
+            LockProfiler.count_uncontended(lock_id)
+    assert LockProfiler.get_uncontended_counts() == {lock.lock_id: 3}
+
+
+@pytest.fixture
+def sampling():
+    yield
+    LockProfiler.set_sampling()
+
+
+@pytest.mark.parametrize("lock_type", [ProfiledLock, ProfiledRLock])
+def test_sampling(lock_type, sampling):
+    lock = lock_type()
+    LockProfiler.set_sampling(1 / 4, seed=1)
+    for _ in range(1000):
+        with lock:
+            if lock_type is ProfiledRLock:
+                with lock:
+                    pass
+
+    stats = LockProfiler.get_stats()
+    waits = [flag for flag in flags(stats) if flag & PY_E_MASK == W]
+    # Sampled with weight 4, re-entrant levels along with the outermost one
+    assert set(waits) == {W | 2 << PY_F_SAMPLE_SHIFT}
+    assert flags(stats).count(A) == flags(stats).count(R) == len(waits)
+    sampled = len(waits) // (2 if lock_type is ProfiledRLock else 1)
+    assert 150 < sampled < 350
+
+    stat = LockProfiler.get_contention_stats().lock_stats[lock.lock_id]
+    assert stat.acquires == sampled
+    estimate = stat.estimate("acquires")
+    assert estimate.value == 4 * sampled
+    assert estimate.low < 1000 < estimate.high
+
+
+def test_lock_sampling(sampling):
+    sampled, full = ProfiledLock(), ProfiledLock()
+    LockProfiler.set_lock_sampling(sampled.lock_id, 1 / 2)
+    try:
+        for _ in range(100):
+            with sampled:
+                pass
+            with full:
+                pass
+    finally:
+        LockProfiler.set_lock_sampling(sampled.lock_id)
+
+    stats = LockProfiler.get_contention_stats().lock_stats
+    assert stats[full.lock_id].acquires == 100
+    assert stats[full.lock_id].estimate("acquires") == (100, 100, 100)
+    assert stats[sampled.lock_id].acquires < 100
+    assert stats[sampled.lock_id].estimate("acquires").value == 2 * stats[sampled.lock_id].acquires
+
+
+@pytest.mark.parametrize("lock_id", [-3, 0, 10**15])
+def test_unknown_lock_id(sampling, lock_id):
+    LockProfiler.set_sampling(1 / 2)
+    with pytest.raises(ValueError):
+        LockProfiler.pre_acquire(lock_id)
+    with pytest.raises(ValueError):
+        LockProfiler.post_acquire(lock_id)
+    with pytest.raises(ValueError):
+        LockProfiler.pre_release(lock_id)
+    with pytest.raises(ValueError):
+        LockProfiler.set_lock_sampling(lock_id, 1 / 2)
+    assert LockProfiler.get_stats().lock_list == []
+
+
+def test_sampling_budget(sampling):
+    lock = ProfiledLock()
+    LockProfiler.set_sampling(budget=10_000)
+    count = 0
+    end = time.perf_counter() + 0.5
+    while time.perf_counter() < end:
+        with lock:
+            count += 1
+
+    stat = LockProfiler.get_contention_stats().lock_stats[lock.lock_id]
+    # The rate is lowered after the first 100 ms
+    assert stat.acquires < count / 2
+    # Wide enough not to be flaky
+    estimate = stat.estimate("acquires", z=5)
+    assert estimate.low < count < estimate.high
@@ -0,0 +1,100 @@
+import numpy as np
+
+from lock_profiler.lock_profiler import LockEvent, LockStats, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE, PY_F_BLOCKED
+from lock_profiler.lod import LodFile, build_lod, lod_filename, main, write_lod
+from lock_profiler.trace_file import write_trace
+
+W, A, R = PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+
+def make_stats():
+    events = [
+        # (timestamp, flag, tid, lock, stack)
+        (100, W, 1, 7, 0),
+        (102, A, 1, 7, 0),
+        # Blocked until thread 1 releases
+        (104, W, 2, 7, 0),
+        (110, A, 1, 8, 0),
+        (112, R, 1, 8, 0),
+        (120, R, 1, 7, 0),
+        (121, A, 2, 7, 0),
+        (125, R, 2, 7, 0),
+        # Flagged as blocked by the recorder
+        (130, W | PY_F_BLOCKED, 2, 8, 0),
+        (132, A, 2, 8, 0),
+        (140, R, 2, 8, 0),
+    ]
+    return LockStats({7: "lock 7", 8: "lock 8"}, {0: []}, [LockEvent(*e) for e in events])
+
+
+def test_level_0():
+    pyramid = build_lod(make_stats(), tile_buckets=4, bucket_width=8)
+    assert (pyramid.start, pyramid.duration) == (100, 40)
+    # In the order of the first events, with a row for the wait above the deepest holds
+    assert pyramid.lanes == [(1, 3), (2, 2)]
+    assert pyramid.lock_totals == {7: (18 + 4, 17), 8: (2 + 8, 2)}
+
+    level = pyramid.levels[0]
+    # Only the tiles each thread was active in
+    assert [tiles.tolist() for tiles in level.tiles] == [[0], [0, 1]]
+    thread_1, thread_2 = level.coverage
+    # Held from 102 to 120, re-entrant holds included
+    assert thread_1["hold"].tolist() == [[6, 8, 4, 0]]
+    assert thread_1["wait"].tolist() == [[2, 0, 0, 0]]
+    assert thread_2["blocked"].tolist() == [[4, 8, 5, 2], [0, 0, 0, 0]]
+    assert thread_2["hold"].tolist() == [[0, 0, 3, 1], [8, 0, 0, 0]]
+    assert level.lock[0].tolist() == [[7, 7, 7, -1]]
+    assert level.lock[1].tolist() == [[-1, -1, 7, 7], [8, -1, -1, -1]]
+
+
+def test_levels():
+    pyramid = build_lod(make_stats(), tile_buckets=4, bucket_width=8)
+    # Up to a single tile
+    assert [level.tiles[1].tolist() for level in pyramid.levels] == [[0, 1], [0]]
+    coarse = pyramid.levels[1]
+    assert coarse.coverage[1]["blocked"].tolist() == [[12, 7, 0, 0]]
+    # The lock of the half held the longest
+    assert coarse.lock[1].tolist() == [[-1, 7, 8, -1]]
+
+    tiles = {(level, lane, tile): shares for level, lane, tile, shares in pyramid.tiles()}
+    # Tiles without activity are left out
+    assert sorted(tiles) == [(0, 0, 0), (0, 1, 0), (0, 1, 1), (1, 0, 0), (1, 1, 0)]
+    assert tiles[(0, 0, 0)]["hold"].tolist() == [191, 255, 128, 0]
+    assert tiles[(0, 1, 1)]["lock"].tolist() == [8, -1, -1, -1]
+
+
+def test_sparse():
+    # Two bursts far apart: the idle time in between takes no buckets
+    events = [(0, W, 1, 7, 0), (5, A, 1, 7, 0), (9, R, 1, 7, 0)]
+    events += [(t + 10 ** 9, flag, tid, lock, stack) for t, flag, tid, lock, stack in events]
+    pyramid = build_lod(LockStats({7: "lock 7"}, {0: []}, [LockEvent(*e) for e in events]),
+                        tile_buckets=4, bucket_width=8)
+    assert [level.tiles[0].tolist() for level in pyramid.levels[:2]] == [[0, 31250000], [0, 15625000]]
+    assert pyramid.levels[0].coverage[0]["hold"].tolist() == [[3, 1, 0, 0], [3, 1, 0, 0]]
+    assert max(len(level.tiles[0]) for level in pyramid.levels) == 2
+    top = pyramid.levels[-1]
+    assert top.tiles[0].tolist() == [0]
+    assert top.coverage[0]["hold"].tolist() == [[4, 0, 0, 4]]
+    assert top.lock[0].tolist() == [[7, -1, -1, 7]]
+
+
+def test_file(tmp_path):
+    trace = tmp_path / "trace.lkprof"
+    write_trace(trace, make_stats())
+    assert main([str(trace)]) == 0
+    lod = LodFile(lod_filename(trace))
+    pyramid = build_lod(make_stats())
+    assert (lod.start, lod.bucket_width, lod.n_levels) == (pyramid.start, pyramid.bucket_width, len(pyramid.levels))
+    assert lod.lanes == pyramid.lanes
+    assert lod.lock_totals == pyramid.lock_totals
+    for level, lane, tile, shares in pyramid.tiles():
+        read = lod.tile(level, lane, tile)
+        assert all(np.array_equal(read[name], values) for name, values in shares.items())
+    assert lod.tile(0, 0, 1000) is None
+
+
+def test_empty(tmp_path):
+    pyramid = build_lod(LockStats({}, {}, []))
+    assert pyramid.lanes == [] and list(pyramid.tiles()) == []
+    write_lod(tmp_path / "empty.lod", pyramid)
+    assert LodFile(tmp_path / "empty.lod").lanes == []
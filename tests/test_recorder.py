@@ -0,0 +1,369 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from lock_profiler import LockProfiler, ProfiledLock, analysis
+from lock_profiler.analysis import analyze
+from lock_profiler.lock_profiler import PY_E_WAIT
+from lock_profiler._lock_profiler import PY_EVENT_CHUNK_SIZE, PY_F_UNCALIBRATED, TIMERS
+
+
+class Lockable:
+    """Minimal wrapper calling the profiler hooks around a lock."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._lock_id = LockProfiler.register_lock(repr(self))
+
+    def __enter__(self):
+        LockProfiler.pre_acquire(self._lock_id)
+        self._lock.acquire()
+        LockProfiler.post_acquire(self._lock_id)
+
+    def __exit__(self, *args):
+        LockProfiler.pre_release(self._lock_id)
+        self._lock.release()
+
+
+def acquire_twice(lock):
+    for _ in range(2):
+        with lock:
+            pass
+
+
+def test_call_sites_are_interned():
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    for _ in range(2):
+        acquire_twice(lock)
+    with lock:
+        pass
+
+    stats = LockProfiler.get_stats()
+    waits = [e for e in stats.lock_list if e.flag == PY_E_WAIT]
+    assert len(waits) == 5
+    # All acquisitions in `acquire_twice` share one stack ID
+    assert waits[0].stack_hash == waits[1].stack_hash == waits[3].stack_hash
+    assert waits[4].stack_hash != waits[0].stack_hash
+    assert len(stats.stack_hashes) == 2
+
+    stack = stats.stack_hashes[waits[0].stack_hash]
+    assert stack[0][1] == '__enter__'
+    assert stack[1][1] == 'acquire_twice'
+    # Line numbers are resolved lazily from the instruction offset
+    assert stack[1][2] == acquire_twice.__code__.co_firstlineno + 2
+    assert stack[2][1] == 'test_call_sites_are_interned'
+
+
+def test_clear_trace():
+    lock = Lockable()
+    with lock:
+        pass
+    LockProfiler.clear_trace()
+    stats = LockProfiler.get_stats()
+    assert stats.lock_list == []
+    assert stats.stack_hashes == {}
+    # Lock IDs stay valid
+    assert stats.lock_hashes[lock._lock_id] == repr(lock)
+
+    with lock:
+        pass
+    stats = LockProfiler.get_stats()
+    assert len(stats.stack_hashes) == 1
+
+
+def test_events_from_all_threads_are_merged():
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    n_iter = 3000
+
+    def work():
+        for _ in range(n_iter):
+            with lock:
+                pass
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    events = LockProfiler.get_stats().lock_list
+    # Several chunks were filled per thread
+    assert len(events) == 4 * n_iter * 3
+    assert {e.tid for e in events} == {t.ident for t in threads}
+    timestamps = [e.timestamp for e in events]
+    assert timestamps == sorted(timestamps)
+
+
+def test_flight_recorder_keeps_latest_events():
+    LockProfiler.clear_trace()
+    LockProfiler.set_buffer_limit(max_events=2 * PY_EVENT_CHUNK_SIZE)
+    try:
+        lock = Lockable()
+        for _ in range(10 * PY_EVENT_CHUNK_SIZE):
+            with lock:
+                pass
+        with lock:
+            marker = LockProfiler.get_stats().lock_list[-1]
+
+        events = LockProfiler.snapshot().lock_list
+        assert PY_EVENT_CHUNK_SIZE < len(events) <= 2 * PY_EVENT_CHUNK_SIZE
+        assert marker in events
+    finally:
+        LockProfiler.set_buffer_limit()
+        LockProfiler.clear_trace()
+
+
+def test_freeze():
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    LockProfiler.freeze()
+    try:
+        with lock:
+            pass
+    finally:
+        LockProfiler.unfreeze()
+    assert LockProfiler.get_stats().lock_list == []
+
+    with lock:
+        pass
+    assert len(LockProfiler.snapshot().lock_list) == 3
+    # Taking a snapshot doesn't stop the recorder
+    with lock:
+        pass
+    assert len(LockProfiler.get_stats().lock_list) == 6
+
+
+def test_streaming(tmp_path, monkeypatch):
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    with lock:
+        pass
+    in_memory = LockProfiler.get_stats()
+
+    filename = tmp_path / "trace.lkstream"
+    LockProfiler.start_streaming(filename)
+    assert LockProfiler.is_streaming()
+    try:
+        for _ in range(2 * PY_EVENT_CHUNK_SIZE):
+            with lock:
+                pass
+        # Nothing is kept in memory except the current chunk
+        assert len(LockProfiler.get_stats().lock_list) <= PY_EVENT_CHUNK_SIZE
+    finally:
+        stats = LockProfiler.stop_streaming()
+    assert not LockProfiler.is_streaming()
+
+    events = list(stats.lock_list)
+    assert len(events) == len(stats.lock_list) == 3 + 6 * PY_EVENT_CHUNK_SIZE
+    # Events recorded before streaming started are included
+    assert events[:3] == in_memory.lock_list
+    timestamps = [e.timestamp for e in events]
+    assert timestamps == sorted(timestamps)
+    assert stats.lock_hashes == LockProfiler.get_lock_names()
+    assert set(stats.stack_hashes) == {e.stack_hash for e in events if e.flag == PY_E_WAIT}
+
+    # Analyzed without loading every event, like at exit
+    def load_all(events):
+        raise AssertionError("streamed events loaded at once")
+
+    monkeypatch.setattr(analysis, "event_columns", load_all)
+    assert analyze(stats).lock_stats[lock._lock_id].hits == 1 + 2 * PY_EVENT_CHUNK_SIZE
+    LockProfiler.clear_trace()
+
+
+def test_event_array():
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    for _ in range(3):
+        with lock:
+            pass
+    events = LockProfiler.get_event_array()
+    stats = LockProfiler.get_stats()
+    assert len(events) == 9
+    assert list(events) == stats.lock_list
+    assert events[-1] == stats.lock_list[-1]
+
+    view = memoryview(events)
+    assert view.readonly
+    assert view.nbytes == 9 * 40
+
+
+def test_event_array_as_numpy():
+    np = pytest.importorskip("numpy")
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    with lock:
+        pass
+    events = LockProfiler.get_event_array()
+    arr = events.as_numpy()
+    assert arr.dtype.names == ("timestamp", "flag", "tid", "lock_hash", "stack_hash")
+    # Recorded through `post_acquire`, whose overhead isn't calibrated
+    assert arr["flag"].tolist() == [0, 1 | PY_F_UNCALIBRATED, 2]
+    assert arr["tid"].tolist() == [threading.get_ident()] * 3
+    # The array shares the memory of the EventArray
+    assert np.shares_memory(arr, np.asarray(events))
+
+
+def test_aggregate_only():
+    LockProfiler.clear_trace()
+    LockProfiler.set_aggregate_only()
+    try:
+        lock = Lockable()
+        held = threading.Event()
+
+        def hold():
+            with lock:
+                held.set()
+                time.sleep(0.01)
+
+        for _ in range(3):
+            with lock:
+                # Re-entrant
+                with lock:
+                    pass
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        with lock:
+            pass
+        thread.join()
+        contention = LockProfiler.get_contention_stats()
+    finally:
+        LockProfiler.set_aggregate_only(False)
+    assert LockProfiler.get_stats().lock_list == []
+
+    (h, stat), = contention.lock_stats.items()
+    assert (stat.hits, stat.acquires, stat.blocks) == (8, 5, 1)
+    assert stat.max_block_time > 0
+    assert stat.max_hold_time > 0
+    assert stat.wait_histogram.total_count == 8
+    assert stat.hold_histogram.total_count == 5
+    assert stat.block_histogram.percentile(100) >= stat.max_block_time
+
+    lines = contention.file_stats[__file__]
+    first_line = test_aggregate_only.__code__.co_firstlineno
+    outer, inner, blocked = lines[first_line + 13], lines[first_line + 15], lines[first_line + 20]
+    assert (outer[h].hits, outer[h].acquires) == (3, 3)
+    # Re-entrant acquisitions are hits, but their hold time belongs to the outermost acquisition
+    assert (inner[h].hits, inner[h].acquires, inner[h].total_hold_time) == (3, 0, 0)
+    assert blocked[h].blocks == 1
+    LockProfiler.clear_trace()
+
+
+def test_aggregate_cross_thread_release():
+    LockProfiler.clear_trace()
+    LockProfiler.set_aggregate_only()
+    try:
+        lock = ProfiledLock()
+        lock.acquire()
+        # Plain locks can be released by another thread than the holder
+        thread = threading.Thread(target=lock.release)
+        thread.start()
+        thread.join()
+        with lock:
+            pass
+        contention = LockProfiler.get_contention_stats()
+    finally:
+        LockProfiler.set_aggregate_only(False)
+    stat = contention.lock_stats[lock.lock_id]
+    # The second acquisition doesn't look re-entrant or blocked
+    assert (stat.hits, stat.acquires, stat.blocks) == (2, 2, 0)
+    assert stat.hold_histogram.total_count == 2
+    LockProfiler.clear_trace()
+
+
+def test_lock_ids_are_not_reused():
+    LockProfiler.clear_trace()
+    ids = set()
+    for _ in range(100):
+        lock = Lockable()
+        with lock:
+            pass
+        ids.add(lock._lock_id)
+        del lock
+    assert len(ids) == 100
+    events = LockProfiler.get_stats().lock_list
+    assert len({e.lock_hash for e in events}) == 100
+
+
+@pytest.mark.parametrize("timer", TIMERS)
+def test_timers(timer):
+    previous = LockProfiler.get_timer()
+    try:
+        LockProfiler.set_timer(timer)
+    except RuntimeError:
+        pytest.skip(f"{timer} is not available")
+    try:
+        assert LockProfiler.get_timer() == timer
+        LockProfiler.clear_trace()
+        lock = Lockable()
+        start = time.monotonic_ns()
+        time.sleep(0.01)
+        with lock:
+            pass
+        timestamps = [e.timestamp for e in LockProfiler.get_stats().lock_list]
+        assert timestamps == sorted(timestamps)
+        if timer != "monotonic_raw":
+            # Same time base as CLOCK_MONOTONIC
+            assert abs(timestamps[0] - time.monotonic_ns()) < abs(timestamps[0] - start)
+    finally:
+        LockProfiler.set_timer(previous)
+    with pytest.raises(ValueError):
+        LockProfiler.set_timer("sundial")
+
+
+def test_calibrate():
+    wait_overhead, hold_overhead = LockProfiler.calibrate()
+    assert wait_overhead > 0 and hold_overhead > 0
+    assert LockProfiler.get_overhead() == (wait_overhead, hold_overhead)
+    # Calibration doesn't record anything
+    LockProfiler.clear_trace()
+    LockProfiler.calibrate()
+    stats = LockProfiler.get_stats()
+    assert stats.lock_list == []
+    assert stats.stack_hashes == {}
+    assert (stats.wait_overhead, stats.hold_overhead) == LockProfiler.get_overhead()
+
+    LockProfiler.set_overhead(0, 0)
+    try:
+        stats = LockProfiler.get_stats()
+        assert (stats.wait_overhead, stats.hold_overhead) == (0, 0)
+    finally:
+        LockProfiler.calibrate()
+
+
+def test_calibrate_other_threads():
+    # The calibration lock isn't registered
+    names = LockProfiler.get_lock_names()
+    LockProfiler.calibrate()
+    assert LockProfiler.get_lock_names() == names
+
+    # Other threads keep recording while a thread calibrates
+    LockProfiler.clear_trace()
+    lock = Lockable()
+    thread = threading.Thread(target=LockProfiler.calibrate, args=(200_000,))
+    count = 0
+    thread.start()
+    while thread.is_alive():
+        with lock:
+            count += 1
+    thread.join()
+    assert count and len(LockProfiler.get_stats().lock_list) == 3 * count
+
+
+def test_calibrate_lazily():
+    script = (
+        "from lock_profiler import LockProfiler, ProfiledLock\n"
+        "assert LockProfiler.get_overhead() == (0, 0)\n"
+        "lock = ProfiledLock('first')\n"
+        "assert LockProfiler.get_overhead() != (0, 0)\n"
+        "assert LockProfiler.get_lock_names() == {1: 'first'}\n"
+    )
+    env = {**os.environ, "LOCK_PROFILER_CALIBRATE": "1"}
+    subprocess.run([sys.executable, "-c", script], env=env, check=True)
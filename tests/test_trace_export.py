@@ -0,0 +1,153 @@
+import gzip
+import json
+
+from lock_profiler.lock_profiler import LockEvent, LockStats, StackFrame, PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+from lock_profiler.trace_export import main, write_chrome_trace, write_perfetto_trace
+from lock_profiler.trace_file import write_trace
+
+W, A, R = PY_E_WAIT, PY_E_ACQUIRE, PY_E_RELEASE
+
+STACKS = {
+    1: [StackFrame("app.py", "f", 10), StackFrame("app.py", "main", 30)],
+    2: [StackFrame("app.py", "g", 20)],
+}
+
+
+def make_stats():
+    events = [
+        # (timestamp, flag, tid, lock, stack)
+        (1000, W, 1, 7, 1),
+        (2000, A, 1, 7, 0),
+        (3000, W, 1, 8, 2),
+        (3500, A, 1, 8, 0),
+        # Blocked until thread 1 releases
+        (4000, W, 2, 7, 2),
+        # Released out of order: lock 8 stays held on its own depth
+        (5000, R, 1, 7, 0),
+        (5500, A, 2, 7, 0),
+        (6000, R, 1, 8, 0),
+        (7000, R, 2, 7, 0),
+    ]
+    return LockStats({7: "lock 7", 8: "lock 8"}, STACKS, [LockEvent(*e) for e in events])
+
+
+EXPECTED = [
+    # (name, tid, depth, start, end)
+    ("wait lock 7", 1, 0, 1000, 2000),
+    ("wait lock 8", 1, 1, 3000, 3500),
+    ("hold lock 7", 1, 0, 2000, 5000),
+    ("blocked lock 7", 2, 0, 4000, 5500),
+    ("hold lock 8", 1, 1, 3500, 6000),
+    ("hold lock 7", 2, 0, 5500, 7000),
+]
+
+
+def test_chrome_trace(tmp_path):
+    write_chrome_trace(tmp_path / "trace.json", make_stats())
+    with open(tmp_path / "trace.json") as f:
+        events = json.load(f)["traceEvents"]
+    slices = [e for e in events if e["ph"] == "X"]
+    assert [(e["name"], e["pid"], e["tid"], e["ts"], e["ts"] + e["dur"]) for e in slices] == [
+        (name, tid, depth, start / 1000, end / 1000) for name, tid, depth, start, end in EXPECTED
+    ]
+    assert slices[0]["cat"] == "wait"
+    # The stack of the wait goes to the hold
+    assert slices[2]["args"] == {"lock": "lock 7", "stack": "f (app.py:10)\nmain (app.py:30)"}
+    names = {(e["name"], e["pid"], e.get("tid")): e["args"]["name"] for e in events if e["ph"] == "M"}
+    assert names[("process_name", 1, None)] == "thread 1"
+    assert names[("thread_name", 1, 1)] == "depth 1"
+
+
+def _fields(data):
+    """(field, value) of a protobuf message, with varints as ints and the rest as bytes."""
+    i = 0
+
+    def varint():
+        nonlocal i
+        value = shift = 0
+        while True:
+            byte = data[i]
+            i += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    while i < len(data):
+        key = varint()
+        if key & 7 == 0:
+            yield key >> 3, varint()
+        else:
+            size = varint()
+            yield key >> 3, data[i:i + size]
+            i += size
+
+
+def test_perfetto_trace(tmp_path):
+    write_perfetto_trace(tmp_path / "trace.pftrace", make_stats(), stacks=False)
+    with open(tmp_path / "trace.pftrace", "rb") as f:
+        packets = [dict(_fields(packet)) for _, packet in _fields(f.read())]
+    # {uuid: (name, parent uuid)}
+    tracks = {}
+    strings = {}
+    slices = []
+    open_slices = {}
+    for packet in packets:
+        assert packet[10] == 1
+        if 60 in packet:
+            track = dict(_fields(packet[60]))
+            tracks[track[1]] = (track[2].decode(), track.get(5))
+        for field, entry in _fields(packet.get(12, b"")):
+            entry = dict(_fields(entry))
+            strings[entry[1]] = entry[2].decode()
+        if 11 in packet:
+            event = list(_fields(packet[11]))
+            fields = dict(event)
+            if fields[9] == 1:
+                annotations = [dict(_fields(value)) for field, value in event if field == 4]
+                assert [(strings[a[1]], strings[a[17]]) for a in annotations] == [("lock", strings[fields[10]][-6:])]
+                open_slices[fields[11]] = (strings[fields[10]], packet[8])
+            else:
+                name, start = open_slices.pop(fields[11])
+                depth_name, thread_track = tracks[fields[11]]
+                tid = int(tracks[thread_track][0].split()[1])
+                slices.append((name, tid, int(depth_name.split()[1]), start, packet[8]))
+    assert not open_slices
+    assert slices == EXPECTED
+
+
+def test_cross_thread_release(tmp_path):
+    events = [
+        (0, W, 1, 7, 1),
+        (1000, A, 1, 7, 0),
+        (2000, W, 2, 7, 2),
+        # Plain locks can be released by another thread than the holder
+        (5000, R, 3, 7, 0),
+        (6000, A, 2, 7, 0),
+        (8000, R, 2, 7, 0),
+        (10000, W, 1, 7, 1),
+        (11000, A, 1, 7, 0),
+        (12000, R, 1, 7, 0),
+    ]
+    stats = LockStats({7: "lock 7"}, STACKS, [LockEvent(*e) for e in events])
+    write_chrome_trace(tmp_path / "trace.json", stats)
+    with open(tmp_path / "trace.json") as f:
+        slices = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+    assert [(e["name"], e["pid"], e["tid"], e["ts"], e["ts"] + e["dur"]) for e in slices] == [
+        ("wait lock 7", 1, 0, 0, 1),
+        # It ends the slice of the holder
+        ("hold lock 7", 1, 0, 1, 5),
+        ("blocked lock 7", 2, 0, 2, 6),
+        ("hold lock 7", 2, 0, 6, 8),
+        ("wait lock 7", 1, 0, 10, 11),
+        ("hold lock 7", 1, 0, 11, 12),
+    ]
+
+
+def test_main(tmp_path):
+    write_trace(tmp_path / "trace.lkprof", make_stats())
+    assert main([str(tmp_path / "trace.lkprof"), str(tmp_path / "trace.json.gz"), "--no-stacks"]) == 0
+    with gzip.open(tmp_path / "trace.json.gz", "rt") as f:
+        slices = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+    assert len(slices) == len(EXPECTED)
+    assert slices[2]["args"] == {"lock": "lock 7"}
@@ -0,0 +1,80 @@
+import pytest
+
+from lock_profiler import LockProfiler
+from lock_profiler.lock_profiler import LockEvent, LockStats, StackFrame
+from lock_profiler.trace_file import TraceFile, write_trace
+
+
+def make_stats(n_events=10):
+    stacks = {
+        5: [StackFrame("a.py", "f", 3), StackFrame("b.py", "<module>", 10)],
+        9: [StackFrame("a.py", "g", 7), StackFrame("b.py", "<module>", 12)],
+    }
+    events = [
+        LockEvent(1000 + i, i % 3, 100 + i % 2, 42 if i % 4 else -7, 5 if i % 2 else 9)
+        for i in range(n_events)
+    ]
+    return LockStats({42: "lock <42>", -7: "other lock ✓"}, stacks, events, 30, 20, {42: 1000})
+
+
+def test_roundtrip(tmp_path):
+    stats = make_stats()
+    filename = tmp_path / "trace.lkprof"
+    write_trace(filename, stats)
+
+    with TraceFile(filename) as trace:
+        assert len(trace) == len(stats.lock_list)
+        assert list(trace) == stats.lock_list
+        assert trace[3] == stats.lock_list[3]
+        assert trace.timestamp.tolist() == [e.timestamp for e in stats.lock_list]
+        assert trace.lock_hashes == stats.lock_hashes
+        assert trace.stack_hashes == stats.stack_hashes
+        assert (trace.wait_overhead, trace.hold_overhead) == (30, 20)
+        assert trace.uncontended_counts == {42: 1000}
+
+
+def test_batches(tmp_path, monkeypatch):
+    from lock_profiler import trace_file
+    monkeypatch.setattr(trace_file, "_BATCH_SIZE", 4)
+    stats = make_stats(n_events=11)
+    filename = tmp_path / "trace.lkprof"
+    write_trace(filename, stats)
+    with TraceFile(filename) as trace:
+        assert list(trace) == make_stats(n_events=11).lock_list
+
+
+def test_columnar_events(tmp_path, monkeypatch):
+    np = pytest.importorskip("numpy")
+    from lock_profiler import trace_file
+    monkeypatch.setattr(trace_file, "_BATCH_SIZE", 4)
+    stats = make_stats(n_events=11)
+
+    class Columns(list):
+        def as_numpy(self):
+            return np.array([tuple(e) for e in self], dtype=[(name, np.int64) for name in LockEvent._fields])
+
+    filename = tmp_path / "trace.lkprof"
+    write_trace(filename, LockStats(stats.lock_hashes, stats.stack_hashes, Columns(stats.lock_list)))
+    with TraceFile(filename) as trace:
+        assert list(trace) == stats.lock_list
+
+
+def test_empty(tmp_path):
+    filename = tmp_path / "trace.lkprof"
+    write_trace(filename, LockStats({}, {}, []))
+    with TraceFile(filename) as trace:
+        assert len(trace) == 0
+        assert list(trace) == []
+
+
+def test_dump_and_load_stats(tmp_path, monkeypatch):
+    stats = make_stats()
+    monkeypatch.setattr(LockProfiler, "get_stats", staticmethod(lambda: stats))
+    for name in ("trace.lkprof", "trace.json"):
+        filename = tmp_path / name
+        LockProfiler.dump_stats(filename)
+        loaded = LockProfiler.load_stats(filename)
+        assert list(loaded.lock_list) == stats.lock_list
+        assert loaded.lock_hashes == stats.lock_hashes
+        assert loaded.stack_hashes == stats.stack_hashes
+        assert loaded.uncontended_counts == stats.uncontended_counts